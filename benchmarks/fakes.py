@@ -0,0 +1,271 @@
+"""
+性能测试使用的本地替身：Spotify API、YouTube Music搜索、yt-dlp下载和本地媒体服务器
+"""
+import os
+import random
+import re
+import shutil
+import threading
+import time
+import urllib.request
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+PLAYLIST_ID = 'benchmark'
+# 歌单每页的歌曲数，与Spotify API相同
+PAGE_SIZE = 100
+# 每张专辑的歌曲数，同一专辑的歌曲共用封面
+TRACKS_PER_ALBUM = 12
+# 128kbps、44.1kHz的MP3帧长度
+MP3_FRAME_BYTES = 417
+
+
+@dataclass
+class FakeConfig:
+    """各替身的延迟（秒）和失败率"""
+    spotify_latency: float = 0.05
+    search_latency: float = 0.02
+    download_latency: float = 0.05
+    http_latency: float = 0.005
+    # 搜索和下载随机失败的比例
+    failure_rate: float = 0.0
+    # 本地HTTP服务器返回503的比例，会触发HttpClient的重试
+    http_failure_rate: float = 0.0
+    media_bytes: int = 256 * 1024
+    cover_bytes: int = 64 * 1024
+    # 本地媒体服务器每个连接的发送速率（字节/秒），模拟CDN对单个连接限速，0表示不限速
+    connection_rate: float = 0
+    seed: int = 0
+
+    def __post_init__(self):
+        self.random = random.Random(self.seed)
+        self._lock = threading.Lock()
+
+    def delay(self, latency: float):
+        """按 ±50% 的抖动模拟延迟"""
+        if latency > 0:
+            with self._lock:
+                factor = self.random.uniform(0.5, 1.5)
+            time.sleep(latency * factor)
+
+    def fails(self, rate: float) -> bool:
+        with self._lock:
+            return self.random.random() < rate
+
+
+def _track_id(index: int) -> str:
+    return f"bench{index:017d}"
+
+
+def _track_index(text: str) -> int:
+    match = re.search(r'(\d+)', text)
+    return int(match.group(1)) if match else 0
+
+
+class FakeSpotify:
+    """替代spotipy.Spotify，返回由序号生成的歌单"""
+
+    def __init__(self, config: FakeConfig, track_count: int, server_url: str, **kwargs):
+        self.config = config
+        self.track_count = track_count
+        self.server_url = server_url
+
+    def _track(self, index: int) -> Dict[str, Any]:
+        album = index // TRACKS_PER_ALBUM
+        return {
+            'id': _track_id(index),
+            'type': 'track',
+            'name': f"Track {index}",
+            'artists': [{'name': f"Artist {album}"}],
+            'album': {
+                'name': f"Album {album}",
+                'release_date': '2020-01-01',
+                'images': [{'url': f"{self.server_url}/cover/{album}.jpg"}],
+            },
+            'duration_ms': 180000,
+            'popularity': 50,
+            'external_ids': {'isrc': f"BENCH{index:07d}"},
+            'track_number': index % TRACKS_PER_ALBUM + 1,
+        }
+
+    def _page(self, offset: int) -> Dict[str, Any]:
+        self.config.delay(self.config.spotify_latency)
+        end = min(offset + PAGE_SIZE, self.track_count)
+        return {
+            'items': [{'track': self._track(i)} for i in range(offset, end)],
+            'next': f"{PLAYLIST_ID}?offset={end}" if end < self.track_count else None,
+        }
+
+    def playlist_items(self, playlist_id: str, **kwargs) -> Dict[str, Any]:
+        return self._page(0)
+
+    def next(self, page: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        return self._page(int(page['next'].rsplit('=', 1)[1])) if page.get('next') else None
+
+    def track(self, track_id: str) -> Dict[str, Any]:
+        self.config.delay(self.config.spotify_latency)
+        return self._track(_track_index(track_id))
+
+    def tracks(self, track_ids: List[str]) -> Dict[str, Any]:
+        self.config.delay(self.config.spotify_latency)
+        return {'tracks': [self._track(_track_index(track_id)) for track_id in track_ids]}
+
+
+class FakeYTMusic:
+    """替代ytmusicapi.YTMusic，每次搜索都返回完全匹配的结果"""
+
+    def __init__(self, config: FakeConfig):
+        self.config = config
+
+    def search(self, query: str, filter: Optional[str] = None, limit: int = 20) -> List[Dict[str, Any]]:
+        self.config.delay(self.config.search_latency)
+        if self.config.fails(self.config.failure_rate):
+            raise RuntimeError("模拟的搜索失败")
+        index = _track_index(query)
+        return [{
+            'title': f"Track {index}",
+            'artists': [{'name': f"Artist {index // TRACKS_PER_ALBUM}"}],
+            'duration_seconds': 180,
+            'videoId': f"vid{index}",
+        }]
+
+
+class FakeYoutubeDL:
+    """替代yt_dlp.YoutubeDL，从本地媒体服务器下载音频"""
+
+    def __init__(self, config: FakeConfig, server_url: str, params: Optional[Dict[str, Any]] = None):
+        self.config = config
+        self.server_url = server_url
+        self.params = dict(params or {})
+        # 与yt-dlp相同，输出模板统一保存为字典
+        outtmpl = self.params.get('outtmpl')
+        if not isinstance(outtmpl, dict):
+            self.params['outtmpl'] = {'default': outtmpl or '%(id)s.%(ext)s'}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def prepare_filename(self, info: Dict[str, Any]) -> str:
+        return self.params['outtmpl']['default'].replace('%(ext)s', info['ext'])
+
+    def extract_info(self, url: str, download: bool = True) -> Dict[str, Any]:
+        self.config.delay(self.config.download_latency)
+        if self.config.fails(self.config.failure_rate):
+            raise RuntimeError("模拟的下载失败")
+        video_id = url.rsplit('=', 1)[-1]
+        # 与yt-dlp相同，选中的音频流信息合并在返回结果中
+        info = {'id': video_id, 'ext': 'webm', 'protocol': 'http', 'url': f"{self.server_url}/media/{video_id}",
+                'http_headers': {'User-Agent': 'benchmark'}}
+        return self.process_ie_result(info, download) if download else info
+
+    def process_ie_result(self, info: Dict[str, Any], download: bool = True) -> Dict[str, Any]:
+        filepath = self.prepare_filename(info)
+        with urllib.request.urlopen(info['url']) as response, open(filepath, 'wb') as f:
+            shutil.copyfileobj(response, f)
+        info['requested_downloads'] = [{'filepath': filepath}]
+        return info
+
+
+def silent_mp3(size: int) -> bytes:
+    """生成约size字节的静音MP3（MPEG-1 Layer III, 128kbps, 44.1kHz），可以被正常读取和转码"""
+    frame = b'\xff\xfb\x90\x64' + b'\x00' * (MP3_FRAME_BYTES - 4)
+    return frame * max(1, size // MP3_FRAME_BYTES)
+
+
+def fake_transcode(source_path: str, target_path: str, format: str, quality: str,
+                   passthrough: bool = False, tags: Optional[Dict[str, str]] = None,
+                   cover: Optional[bytes] = None, cover_path: Optional[str] = None) -> bool:
+    """不调用ffmpeg，直接复制文件，用于只测试网络和调度开销"""
+    shutil.copyfile(source_path, target_path)
+    return True
+
+
+class LocalMediaServer:
+    """本地HTTP服务器，提供封面、音频文件以及Deezer/SoundCloud的空搜索结果"""
+
+    def __init__(self, config: FakeConfig, media_path: Optional[str] = None):
+        self.config = config
+        if media_path:
+            with open(media_path, 'rb') as f:
+                self.media = f.read()
+        else:
+            self.media = silent_mp3(config.media_bytes)
+        self.cover = os.urandom(config.cover_bytes)
+        self.requests = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.requests += 1
+                config = server.config
+                config.delay(config.http_latency)
+                if config.fails(config.http_failure_rate):
+                    self._send(503, b'', 'text/plain')
+                elif self.path.startswith('/cover/'):
+                    self._send(200, server.cover, 'image/jpeg')
+                elif self.path.startswith('/media/'):
+                    self._send_media(server.media)
+                elif self.path.startswith('/search'):
+                    self._send(200, b'{"data": []}', 'application/json')
+                elif self.path.startswith('/tracks'):
+                    self._send(200, b'[]', 'application/json')
+                else:
+                    self._send(404, b'', 'text/plain')
+
+            def _send_media(self, media: bytes):
+                """支持单个Range请求，按connection_rate限速发送"""
+                match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+                start, end, status = 0, len(media) - 1, 200
+                if match:
+                    start = int(match.group(1))
+                    end = min(int(match.group(2)), end) if match.group(2) else end
+                    status = 206
+                self.send_response(status)
+                self.send_header('Content-Type', 'audio/webm')
+                self.send_header('Content-Length', str(end - start + 1))
+                self.send_header('Accept-Ranges', 'bytes')
+                if status == 206:
+                    self.send_header('Content-Range', f"bytes {start}-{end}/{len(media)}")
+                self.end_headers()
+                rate = server.config.connection_rate
+                piece = max(1, int(rate / 20)) if rate else end - start + 1
+                for offset in range(start, end + 1, piece):
+                    self.wfile.write(media[offset:min(offset + piece, end + 1)])
+                    if rate:
+                        time.sleep(piece / rate)
+
+            def _send(self, status: int, body: bytes, content_type: str):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
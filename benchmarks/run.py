@@ -0,0 +1,225 @@
+"""
+离线性能测试：用本地替身代替Spotify、YouTube Music、媒体服务器和yt-dlp，测量下载吞吐量
+
+    python benchmarks/run.py                      # 依次运行 1、100、5000 首歌曲
+    python benchmarks/run.py -n 100 --pipeline    # 只运行100首，使用流水线模式
+"""
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import ExitStack
+from typing import Any, Dict, List, Optional
+from unittest import mock
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakes import (PLAYLIST_ID, FakeConfig, FakeSpotify, FakeYoutubeDL, FakeYTMusic,  # noqa: E402
+                   LocalMediaServer, fake_transcode)
+
+DEFAULT_SIZES = (1, 100, 5000)
+# 使用真实ffmpeg转码时的测试音频时长（秒）
+FIXTURE_SECONDS = 30
+
+
+def _percentile(values: List[float], percent: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+def _peak_rss_mb() -> float:
+    """进程的峰值常驻内存，Linux上ru_maxrss单位为KB，macOS上为字节"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _make_fixture(directory: str) -> str:
+    """用ffmpeg生成一段opus测试音频"""
+    path = os.path.join(directory, 'fixture.webm')
+    subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-f', 'lavfi',
+                    '-i', f"sine=frequency=440:duration={FIXTURE_SECONDS}", '-c:a', 'libopus', path],
+                   check=True)
+    return path
+
+
+def run_once(track_count: int, config: FakeConfig, workers: int, pipeline: bool, source: str,
+             format: str, real_transcode: bool, keep_rate_limits: bool, connections: int = 1,
+             chunk_size: int = 0, stream: bool = False) -> Dict[str, Any]:
+    """运行一次下载，返回统计结果"""
+    from spotifydl import downloader as downloader_module
+    from spotifydl.covers import CoverCache
+    from spotifydl.ranged import RangedDownloader
+    from spotifydl.ratelimit import DEFAULT_RATES, configure_rate_limits
+
+    # 只保留警告和错误，避免大量日志影响测量
+    logging.getLogger().setLevel(logging.WARNING)
+    if not keep_rate_limits:
+        configure_rate_limits({name: 0 for name in DEFAULT_RATES})
+
+    work_dir = tempfile.mkdtemp(prefix='spotifydl-bench-')
+    media_path = _make_fixture(work_dir) if real_transcode else None
+    server = LocalMediaServer(config, media_path).start()
+    starts: Dict[str, float] = {}
+    latencies: List[float] = []
+    lock = threading.Lock()
+    try:
+        with ExitStack() as stack:
+            # 第三方库在首次使用时才导入，直接替换其模块中的类
+            stack.enter_context(mock.patch(
+                'spotifydl.spotify_client.create_spotify_client',
+                lambda client_id, client_secret: FakeSpotify(config, track_count, server.url)))
+            stack.enter_context(mock.patch('ytmusicapi.YTMusic', lambda: FakeYTMusic(config)))
+            stack.enter_context(mock.patch(
+                'yt_dlp.YoutubeDL', lambda params: FakeYoutubeDL(config, server.url, params)))
+            if not real_transcode:
+                stack.enter_context(mock.patch.object(downloader_module, 'transcode_audio', fake_transcode))
+
+            range_downloader = RangedDownloader(chunk_size, connections) if connections > 1 else None
+            downloader = downloader_module.SpotifyDownloader('benchmark', 'benchmark',
+                                                             cover_cache=CoverCache(stream_to_disk=stream),
+                                                             range_downloader=range_downloader)
+            # 只有选中的音乐源会被创建
+            sources = downloader._select_sources(source)
+            for music_source in sources:
+                if hasattr(music_source, 'base_url'):
+                    music_source.base_url = server.url
+
+            # 单曲耗时：从开始搜索到生成最终文件
+            find_candidates = downloader._find_candidates
+
+            def timed_find_candidates(track_info, *args, **kwargs):
+                with lock:
+                    starts[track_info['spotify_id']] = time.monotonic()
+                return find_candidates(track_info, *args, **kwargs)
+
+            downloader._find_candidates = timed_find_candidates
+            for music_source in sources:
+                def timed_finalize(temp_file_path, output_path, format, track_info, _finalize=music_source.finalize):
+                    final_path = _finalize(temp_file_path, output_path, format, track_info)
+                    with lock:
+                        latencies.append(time.monotonic() - starts[track_info['spotify_id']])
+                    return final_path
+                music_source.finalize = timed_finalize
+
+            started = time.monotonic()
+            results = downloader.download_collection(
+                f"https://open.spotify.com/playlist/{PLAYLIST_ID}", os.path.join(work_dir, 'output'),
+                format=format, source=source, workers=workers, pipeline=pipeline, stream=stream)
+            elapsed = time.monotonic() - started
+            downloader.transcode_pool.shutdown()
+    finally:
+        server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    succeeded = sum(1 for r in results if r.success)
+    return {
+        'tracks': track_count,
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded,
+        'seconds': round(elapsed, 3),
+        'tracks_per_minute': round(succeeded / elapsed * 60, 1) if elapsed else None,
+        'p50_seconds': _percentile(latencies, 50),
+        'p95_seconds': _percentile(latencies, 95),
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+        'http_requests': server.requests,
+    }
+
+
+def _format_row(result: Dict[str, Any]) -> str:
+    def seconds(value):
+        return f"{value:.3f}" if value is not None else '-'
+    return (f"{result['tracks']:>7} {result['succeeded']:>7} {result['failed']:>6} {result['seconds']:>9.2f} "
+            f"{result['tracks_per_minute'] or 0:>11.1f} {seconds(result['p50_seconds']):>8} "
+            f"{seconds(result['p95_seconds']):>8} {result['peak_rss_mb']:>9.1f}")
+
+
+def _child_args() -> List[str]:
+    """子进程沿用当前的命令行参数，去掉歌曲数量和JSON输出"""
+    args: List[str] = []
+    skip = False
+    for arg in sys.argv[1:]:
+        if skip:
+            skip = False
+        elif arg in ('--tracks', '-n', '--json'):
+            skip = True
+        elif not arg.startswith(('--tracks=', '--json=')):
+            args.append(arg)
+    return args
+
+
+@click.command()
+@click.option('--tracks', '-n', 'sizes', multiple=True, type=click.IntRange(min=1),
+              help='歌曲数量，可重复指定 (默认: 1, 100, 5000)')
+@click.option('--workers', '-w', default=8, type=click.IntRange(min=1), help='并发下载数 (默认: 8)')
+@click.option('--pipeline', is_flag=True, help='使用分阶段流水线')
+@click.option('--stream', is_flag=True, help='使用流式模式')
+@click.option('--source', '-s', default='youtubemusic', help='音乐源 (默认: youtubemusic)')
+@click.option('--format', '-f', default='mp3', help='输出格式 (默认: mp3)')
+@click.option('--spotify-latency', default=0.05, type=float, help='Spotify API延迟(秒)')
+@click.option('--search-latency', default=0.02, type=float, help='搜索延迟(秒)')
+@click.option('--download-latency', default=0.05, type=float, help='yt-dlp下载延迟(秒)')
+@click.option('--http-latency', default=0.005, type=float, help='本地HTTP服务器延迟(秒)')
+@click.option('--failure-rate', default=0.0, type=click.FloatRange(0, 1), help='搜索和下载的失败率')
+@click.option('--http-failure-rate', default=0.0, type=click.FloatRange(0, 1), help='HTTP请求返回503的比例')
+@click.option('--media-kb', default=256, type=click.IntRange(min=1), help='每首歌曲的音频大小(KB)')
+@click.option('--connection-rate', default=0, type=click.IntRange(min=0),
+              help='媒体服务器每个连接的速率(KB/s)，模拟CDN限速，0表示不限速')
+@click.option('--connections', default=1, type=click.IntRange(min=1), help='每个音频流的分段下载连接数 (默认: 1)')
+@click.option('--chunk-size', default=256, type=click.IntRange(min=1), help='分段下载时每段的大小(KB) (默认: 256)')
+@click.option('--real-transcode', is_flag=True, help='使用真实的ffmpeg转码 (需要安装ffmpeg)')
+@click.option('--keep-rate-limits', is_flag=True, help='保留默认的请求限速')
+@click.option('--seed', default=0, type=int, help='随机数种子')
+@click.option('--json', 'json_path', help='把结果写入JSON文件')
+@click.option('--in-process', is_flag=True, help='在当前进程中运行，不为每个规模单独启动进程')
+@click.option('--child', is_flag=True, hidden=True)
+def main(sizes, workers, pipeline, stream, source, format, spotify_latency, search_latency, download_latency,
+         http_latency, failure_rate, http_failure_rate, media_kb, connection_rate, connections, chunk_size,
+         real_transcode, keep_rate_limits, seed, json_path, in_process, child):
+    """离线测量下载吞吐量、单曲耗时和峰值内存"""
+    sizes = sizes or DEFAULT_SIZES
+    if real_transcode and not shutil.which('ffmpeg'):
+        raise click.UsageError("未找到ffmpeg，无法使用 --real-transcode")
+    config = FakeConfig(spotify_latency, search_latency, download_latency, http_latency, failure_rate,
+                        http_failure_rate, media_kb * 1024, connection_rate=connection_rate * 1024, seed=seed)
+
+    results = []
+    for size in sizes:
+        if in_process or child:
+            result = run_once(size, config, workers, pipeline, source, format, real_transcode, keep_rate_limits,
+                              connections, chunk_size * 1024, stream)
+        else:
+            # 峰值内存是整个进程的，每个规模在单独的进程中运行才能分别测量
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), *_child_args(),
+                                     '--tracks', str(size), '--child'],
+                                    check=True, stdout=subprocess.PIPE).stdout
+            result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        results.append(result)
+        if child:
+            print(json.dumps(result))
+
+    if child:
+        return
+    mode = ('流水线' if pipeline else '线程池') + ('，流式' if stream else '')
+    click.echo(f"模式: {mode}，并发数: {workers}，每首连接数: {connections}，音乐源: {source}，"
+               f"{'真实ffmpeg转码' if real_transcode else '跳过转码'}")
+    click.echo(f"{'歌曲数':>7} {'成功':>7} {'失败':>6} {'总耗时(s)':>9} {'首/分钟':>11} "
+               f"{'p50(s)':>8} {'p95(s)':>8} {'峰值内存MB':>9}")
+    for result in results:
+        click.echo(_format_row(result))
+    if json_path:
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
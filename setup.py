@@ -12,7 +12,6 @@ setup(
         "ytmusicapi",
         "click>=8.1.7",
         "python-dotenv>=1.0.0",
-        "mutagen",
     ],
     entry_points={
         "console_scripts": [
@@ -0,0 +1,272 @@
+"""
+本地SQLite缓存
+"""
+import csv
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 歌曲信息很少变化，默认缓存30天
+DEFAULT_METADATA_TTL = 30 * 24 * 3600
+# 超过该条数时按最近访问时间淘汰
+DEFAULT_METADATA_MAX_ENTRIES = 100000
+CACHE_DB_NAME = 'cache.sqlite'
+# 匹配结果：视频可能下架，成功匹配保留180天；未找到匹配的歌曲7天后再重新搜索
+DEFAULT_MATCH_TTL = 180 * 24 * 3600
+DEFAULT_NEGATIVE_MATCH_TTL = 7 * 24 * 3600
+# SQLite单条语句的参数个数有上限，批量查询时分批执行
+_MAX_SQL_PARAMS = 500
+
+
+def default_cache_dir() -> str:
+    """默认缓存目录，遵循XDG规范"""
+    base = os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'spotifydl')
+
+
+class SQLiteStore:
+    """SQLite存储基类，多个线程共享同一个连接"""
+    SCHEMA = ''
+    JOURNAL_MODE = 'WAL'
+
+    def __init__(self, path: Optional[str] = None):
+        if path is None:
+            path = os.path.join(default_cache_dir(), CACHE_DB_NAME)
+        path = os.path.abspath(os.path.expanduser(path))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        # WAL模式允许多个进程同时读写同一个缓存文件；WAL依赖共享内存，网络文件系统上的数据库需改用DELETE
+        self._conn.execute(f'PRAGMA journal_mode={self.JOURNAL_MODE}')
+        self._conn.executescript(self.SCHEMA)
+        self._conn.commit()
+
+    def close(self):
+        """关闭数据库连接"""
+        with self._lock:
+            self._conn.close()
+
+
+class MetadataCache(SQLiteStore):
+    """按Spotify ID缓存歌曲信息"""
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS tracks (
+            spotify_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            fetched_at REAL NOT NULL,
+            accessed_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS tracks_accessed_at ON tracks (accessed_at);
+    '''
+
+    def __init__(self, path: Optional[str] = None, ttl: float = DEFAULT_METADATA_TTL,
+                 max_entries: int = DEFAULT_METADATA_MAX_ENTRIES, refresh: bool = False):
+        super().__init__(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # 刷新模式：忽略已有缓存，但仍然写入最新结果
+        self.refresh = refresh
+
+    def get(self, spotify_id: str) -> Optional[Dict[str, Any]]:
+        """读取单首歌曲的缓存"""
+        return self.get_many([spotify_id]).get(spotify_id)
+
+    def get_many(self, spotify_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """批量读取缓存，只返回未过期的条目"""
+        if self.refresh:
+            return {}
+        ids = list(dict.fromkeys(spotify_ids))
+        now = time.time()
+        found: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            for i in range(0, len(ids), _MAX_SQL_PARAMS):
+                chunk = ids[i:i + _MAX_SQL_PARAMS]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._conn.execute(
+                    f'SELECT spotify_id, data FROM tracks WHERE spotify_id IN ({placeholders}) AND fetched_at > ?',
+                    (*chunk, now - self.ttl)
+                ).fetchall()
+                for spotify_id, data in rows:
+                    found[spotify_id] = json.loads(data)
+                if rows:
+                    self._conn.execute(
+                        f'UPDATE tracks SET accessed_at = ? WHERE spotify_id IN ({",".join("?" * len(rows))})',
+                        (now, *(row[0] for row in rows))
+                    )
+            self._conn.commit()
+        return found
+
+    def put(self, track_info: Dict[str, Any]):
+        """写入单首歌曲"""
+        self.put_many([track_info])
+
+    def put_many(self, track_infos: List[Dict[str, Any]]):
+        """批量写入歌曲信息，并在超出容量时淘汰最久未访问的条目"""
+        if not track_infos:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO tracks (spotify_id, data, fetched_at, accessed_at) VALUES (?, ?, ?, ?)',
+                [(info['spotify_id'], json.dumps(info, ensure_ascii=False), now, now) for info in track_infos]
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """删除过期条目，并把总条数控制在max_entries以内"""
+        self._conn.execute('DELETE FROM tracks WHERE fetched_at <= ?', (time.time() - self.ttl,))
+        count = self._conn.execute('SELECT COUNT(*) FROM tracks').fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                'DELETE FROM tracks WHERE spotify_id IN '
+                '(SELECT spotify_id FROM tracks ORDER BY accessed_at LIMIT ?)',
+                (count - self.max_entries,)
+            )
+            logger.info(f"歌曲信息缓存已淘汰 {count - self.max_entries} 条")
+
+
+class MatchCache(SQLiteStore):
+    """缓存Spotify歌曲在各音乐源上的匹配结果，包括未找到匹配的结果"""
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS matches (
+            source TEXT NOT NULL,
+            key TEXT NOT NULL,
+            url TEXT,
+            source_id TEXT,
+            score REAL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (source, key)
+        );
+        CREATE INDEX IF NOT EXISTS matches_expires_at ON matches (expires_at);
+    '''
+
+    def __init__(self, path: Optional[str] = None, ttl: float = DEFAULT_MATCH_TTL,
+                 negative_ttl: float = DEFAULT_NEGATIVE_MATCH_TTL, refresh: bool = False):
+        super().__init__(path)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh = refresh
+
+    @staticmethod
+    def _keys(track_info: Dict[str, Any]) -> List[str]:
+        """同一首歌可以通过Spotify ID或ISRC命中缓存"""
+        keys = [f"spotify:{track_info['spotify_id']}"]
+        if track_info.get('isrc'):
+            keys.append(f"isrc:{track_info['isrc']}")
+        return keys
+
+    def lookup(self, source: str, track_info: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """查询匹配结果。未命中返回None；已知无匹配时返回url为None的结果"""
+        if self.refresh:
+            return None
+        with self._lock:
+            for key in self._keys(track_info):
+                row = self._conn.execute(
+                    'SELECT url, source_id, score FROM matches WHERE source = ? AND key = ? AND expires_at > ?',
+                    (source, key, time.time())
+                ).fetchone()
+                if row:
+                    return {'url': row[0], 'source_id': row[1], 'score': row[2]}
+        return None
+
+    def store(self, source: str, track_info: Dict[str, Any], candidate: Optional[Dict[str, Any]]):
+        """保存匹配结果，candidate为None表示该音乐源没有这首歌"""
+        now = time.time()
+        if candidate:
+            row = (candidate['url'], candidate.get('source_id'), candidate.get('score'), now + self.ttl)
+        else:
+            row = (None, None, None, now + self.negative_ttl)
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO matches (source, key, url, source_id, score, expires_at) VALUES (?, ?, ?, ?, ?, ?)',
+                [(source, key, *row) for key in self._keys(track_info)]
+            )
+            self._conn.execute('DELETE FROM matches WHERE expires_at <= ?', (now,))
+            self._conn.commit()
+
+    def invalidate(self, source: str, track_info: Dict[str, Any]):
+        """删除匹配结果，例如缓存的链接已无法下载"""
+        keys = self._keys(track_info)
+        with self._lock:
+            self._conn.execute(
+                f'DELETE FROM matches WHERE source = ? AND key IN ({",".join("?" * len(keys))})',
+                (source, *keys)
+            )
+            self._conn.commit()
+
+
+class IsrcIndex(SQLiteStore):
+    """ISRC到各音乐源歌曲的精确对应关系
+
+    来源包括音乐源的ISRC查询接口、下载成功的高分匹配以及批量导入。
+    命中时无需搜索，也不会下载到其他版本。条目不过期，下载失败时删除。
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS isrc_index (
+            isrc TEXT NOT NULL,
+            source TEXT NOT NULL,
+            url TEXT NOT NULL,
+            source_id TEXT,
+            origin TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (isrc, source)
+        );
+    '''
+
+    def __init__(self, path: Optional[str] = None, refresh: bool = False):
+        super().__init__(path)
+        self.refresh = refresh
+
+    def lookup(self, source: str, isrc: str) -> Optional[Dict[str, Any]]:
+        """查询ISRC在音乐源上对应的歌曲"""
+        if self.refresh or not isrc:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT url, source_id, origin FROM isrc_index WHERE isrc = ? AND source = ?',
+                (isrc.upper(), source)
+            ).fetchone()
+        return {'url': row[0], 'source_id': row[1], 'origin': row[2]} if row else None
+
+    def store(self, source: str, isrc: str, url: str, source_id: Optional[str], origin: str):
+        """保存单条对应关系"""
+        self.store_many([{'isrc': isrc, 'source': source, 'url': url, 'source_id': source_id, 'origin': origin}])
+
+    def store_many(self, rows: Iterable[Dict[str, Any]]) -> int:
+        """批量保存对应关系，返回写入的条数"""
+        now = time.time()
+        values = [(row['isrc'].upper(), row['source'], row['url'], row.get('source_id'), row['origin'], now)
+                  for row in rows]
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO isrc_index (isrc, source, url, source_id, origin, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                values
+            )
+            self._conn.commit()
+        return len(values)
+
+    def invalidate(self, source: str, isrc: str):
+        """删除对应关系，例如链接已无法下载"""
+        with self._lock:
+            self._conn.execute('DELETE FROM isrc_index WHERE isrc = ? AND source = ?', (isrc.upper(), source))
+            self._conn.commit()
+
+
+def read_isrc_rows(path: str) -> Iterator[Dict[str, str]]:
+    """读取批量导入文件：CSV（带表头）或JSON Lines，字段为 isrc, source, url 或 source_id"""
+    with open(path, encoding='utf-8', newline='') as f:
+        if path.endswith(('.jsonl', '.json')):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(f)
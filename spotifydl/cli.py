@@ -1,33 +1,159 @@
 import os
+import signal
+import threading
+from typing import Optional, Tuple
 import click
-from dotenv import load_dotenv
-from .downloader import SpotifyDownloader
+from .downloader import SpotifyDownloader, DEFAULT_SOURCE_TIMEOUT, import_isrc_file
+from .cache import MetadataCache, MatchCache, IsrcIndex, CACHE_DB_NAME, default_cache_dir
+from .library import LibraryIndex, LINK_MODES
+from .covers import CoverCache
+from .ranged import DEFAULT_CHUNK_SIZE, RangedDownloader, parse_size
+from .ratelimit import RATE_LIMIT_ENV, configure_rate_limits, parse_rate_limits
+from .metrics import metrics
+from .server import DEFAULT_PORT, JOBS_DB_NAME
+from .distributed import DEFAULT_LEASE_SECONDS
 import logging
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-@click.command()
-@click.option('--url', '-u', required=True, help='Spotify音乐链接')
-@click.option('--output', '-o', required=True, help='输出目录路径')
+# 退出码：全部成功 / 全部失败或发生错误 / 部分歌曲失败
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_PARTIAL = 2
+
+def parse_stage_workers(ctx, param, value):
+    """解析 --stage-workers，例如 search=8,download=4,transcode=2,finalize=2"""
+    from .pipeline import STAGES
+    if not value:
+        return None
+    stage_workers = {}
+    for item in value.split(','):
+        name, _, count = item.partition('=')
+        name = name.strip()
+        if name not in STAGES or not count.strip().isdigit() or int(count) < 1:
+            raise click.BadParameter(f"格式应为 阶段=并发数，阶段可选: {', '.join(STAGES)}")
+        stage_workers[name] = int(count)
+    return stage_workers
+
+def parse_chunk_size(ctx, param, value):
+    """解析 --chunk-size，例如 1048576、512K、4M"""
+    try:
+        return parse_size(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+def parse_rate_limit_option(ctx, param, value):
+    """解析 --rate-limit，例如 youtubemusic=2 或 deezer=8,spotify=5"""
+    try:
+        return parse_rate_limits(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+def _spotify_credentials() -> Tuple[str, str]:
+    """从环境变量读取Spotify API凭证"""
+    client_id = os.getenv('SPOTIFY_CLIENT_ID')
+    client_secret = os.getenv('SPOTIFY_CLIENT_SECRET')
+    
+    if not client_id or not client_secret:
+        raise ValueError("未找到Spotify API凭证。请确保设置了SPOTIFY_CLIENT_ID和SPOTIFY_CLIENT_SECRET环境变量。")
+    return client_id, client_secret
+
+def _create_downloader(client_id: str, client_secret: str, cache_dir: Optional[str], refresh: bool,
+                       cover_max_size: Optional[int], source_timeout: float, transcode_workers: Optional[int],
+                       passthrough: bool, link_mode: str, connections: int = 1,
+                       chunk_size: int = DEFAULT_CHUNK_SIZE, stream: bool = False) -> SpotifyDownloader:
+    """创建下载器，cache_dir为None时不使用本地缓存，connections大于1时分段并发下载音频流
+
+    stream为True时专辑封面不保存在内存中，只分块写入磁盘。
+    """
+    # 歌曲信息、匹配结果、ISRC索引和专辑封面缓存
+    metadata_cache = match_cache = isrc_index = library = None
+    cover_cache = CoverCache(max_size=cover_max_size, stream_to_disk=stream)
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, CACHE_DB_NAME)
+        metadata_cache = MetadataCache(cache_path, refresh=refresh)
+        match_cache = MatchCache(cache_path, refresh=refresh)
+        isrc_index = IsrcIndex(cache_path, refresh=refresh)
+        library = LibraryIndex(cache_path)
+        cover_cache = CoverCache(os.path.join(cache_dir, 'covers'), max_size=cover_max_size,
+                                 stream_to_disk=stream)
+
+    range_downloader = RangedDownloader(chunk_size, connections) if connections > 1 else None
+    return SpotifyDownloader(client_id, client_secret, metadata_cache, match_cache, cover_cache,
+                             source_timeout, transcode_workers, passthrough, isrc_index, library, link_mode,
+                             range_downloader)
+
+@click.group(invoke_without_command=True)
+@click.option('--url', '-u', help='Spotify链接 (支持单曲、歌单、专辑、艺术家)')
+@click.option('--output', '-o', help='输出目录路径')
 @click.option('--format', '-f', default='mp3', help='输出格式 (默认: mp3)')
 @click.option('--quality', '-q', default='320k', help='音频质量 (默认: 320k)')
 @click.option('--source', '-s', default='youtubemusic', help='指定音乐源 (可选: deezer, youtubemusic, soundcloud, auto)')
+@click.option('--source-timeout', default=DEFAULT_SOURCE_TIMEOUT, type=click.FloatRange(min=0.1),
+              help=f'自动模式下每个音乐源的搜索期限，单位秒 (默认: {DEFAULT_SOURCE_TIMEOUT:g})')
 @click.option('--cookies', '-c', help='Cookie文件路径 (用于YouTube验证)')
 @click.option('--cookies-from-browser', help='从浏览器导入cookies (chrome, firefox, edge, safari)')
-def main(url: str, output: str, format: str, quality: str, source: str, cookies: str, cookies_from_browser: str):
+@click.option('--rate-limit', multiple=True, callback=parse_rate_limit_option,
+              help=f'音乐源最大请求速率，例如 youtubemusic=2，可重复指定，0表示不限速 (也可用环境变量 {RATE_LIMIT_ENV} 设置)')
+@click.option('--workers', '-w', default=4, type=click.IntRange(min=1), help='并发下载数 (默认: 4)')
+@click.option('--cache-dir', help='缓存目录 (默认: ~/.cache/spotifydl)')
+@click.option('--no-cache', is_flag=True, help='不使用本地缓存')
+@click.option('--refresh', is_flag=True, help='忽略已有缓存，重新获取并更新缓存')
+@click.option('--import-isrc', type=click.Path(exists=True, dir_okay=False),
+              help='批量导入ISRC对应关系 (CSV或JSON Lines，字段: isrc, source, url或source_id)，可不指定 --url')
+@click.option('--link-mode', type=click.Choice(LINK_MODES), default='auto',
+              help='其他目录已下载过的歌曲放入输出目录的方式，auto依次尝试reflink、硬链接、符号链接，none表示总是重新下载 (默认: auto)')
+@click.option('--sync', is_flag=True, help='同步模式：只下载输出目录中缺失或有变化的歌曲')
+@click.option('--verify', is_flag=True, help='同步时校验已有文件的checksum')
+@click.option('--cover-max-size', type=click.IntRange(min=1), help='专辑封面最大边长(像素)，超出时缩小 (需要Pillow)')
+@click.option('--transcode-workers', type=click.IntRange(min=1), help='同时运行的转码进程数 (默认: CPU核数)')
+@click.option('--passthrough', is_flag=True,
+              help='优先下载与输出格式编码一致的音频流，编码一致时直接复制音频流而不重新编码')
+@click.option('--connections', default=1, type=click.IntRange(min=1),
+              help='每首歌曲的音频流拆成多个字节范围，用多个连接同时下载；1表示由yt-dlp单连接下载 (默认: 1)')
+@click.option('--chunk-size', default=str(DEFAULT_CHUNK_SIZE), callback=parse_chunk_size,
+              help='分段下载时每段的大小，例如 512K、4M (默认: 1M)')
+@click.option('--staging-dir', help='原始音频暂存目录 (默认: 输出目录下的 .spotifydl-staging)')
+@click.option('--pipeline', is_flag=True, help='使用分阶段流水线：搜索、下载、转码、重命名并发进行')
+@click.option('--stage-workers', callback=parse_stage_workers,
+              help='流水线各阶段并发数，例如 search=8,download=4,transcode=2,finalize=2')
+@click.option('--stream', is_flag=True,
+              help='流式模式：逐页读取歌单，同时处理的歌曲数有上限，封面只写入磁盘，适合上万首的歌单')
+@click.option('--metrics-json', type=click.Path(dir_okay=False), help='结束时把各阶段耗时和计数写入JSON文件')
+@click.option('--metrics-port', type=click.IntRange(min=0, max=65535),
+              help='在该端口提供Prometheus格式的统计接口 (/metrics)')
+def main(url: str, output: str, format: str, quality: str, source: str, source_timeout: float, cookies: str,
+         cookies_from_browser: str, rate_limit: dict, workers: int, cache_dir: str, no_cache: bool, refresh: bool, import_isrc: str, link_mode: str, sync: bool, verify: bool,
+         cover_max_size: int, transcode_workers: int, passthrough: bool, staging_dir: str, pipeline: bool, stage_workers: dict, stream: bool,
+         connections: int, chunk_size: int, metrics_json: str, metrics_port: int):
     """从Spotify链接下载音乐"""
+    ctx = click.get_current_context()
+    if ctx.invoked_subcommand:
+        return
+    if not import_isrc and not (url and output):
+        raise click.UsageError("必须指定 --url 和 --output")
     try:
         # 加载环境变量
+        from dotenv import load_dotenv
         load_dotenv()
+
+        cache_dir = None if no_cache else (cache_dir or default_cache_dir())
+        cache_path = os.path.join(cache_dir, CACHE_DB_NAME) if cache_dir else None
+        # 批量导入ISRC对应关系，不需要Spotify凭证
+        if import_isrc:
+            if not cache_path:
+                raise ValueError("ISRC索引保存在本地缓存中，不能与 --no-cache 同时使用")
+            count = import_isrc_file(IsrcIndex(cache_path), import_isrc)
+            logger.info(f"已导入 {count} 条ISRC对应关系")
+            if not url:
+                return
+            if not output:
+                raise ValueError("必须指定 --output")
         
         # 获取Spotify API凭证
-        client_id = os.getenv('SPOTIFY_CLIENT_ID')
-        client_secret = os.getenv('SPOTIFY_CLIENT_SECRET')
-        
-        if not client_id or not client_secret:
-            raise ValueError("未找到Spotify API凭证。请确保设置了SPOTIFY_CLIENT_ID和SPOTIFY_CLIENT_SECRET环境变量。")
+        client_id, client_secret = _spotify_credentials()
         
         # 检查其他音乐源的API凭证
         if source in ['deezer', 'auto'] and not os.getenv('DEEZER_API_KEY'):
@@ -36,22 +162,242 @@ def main(url: str, output: str, format: str, quality: str, source: str, cookies:
         if source in ['soundcloud', 'auto'] and not os.getenv('SOUNDCLOUD_CLIENT_ID'):
             logger.warning("未找到SoundCloud API凭证，将跳过SoundCloud源")
         
+        if metrics_port is not None:
+            metrics.serve(metrics_port)
+
+        # 命令行的限速配置优先于环境变量
+        if rate_limit:
+            configure_rate_limits(rate_limit)
+
         # 确保输出目录存在
         os.makedirs(output, exist_ok=True)
         
         # 创建下载器实例
-        downloader = SpotifyDownloader(client_id, client_secret)
+        downloader = _create_downloader(client_id, client_secret, cache_dir, refresh, cover_max_size,
+                                        source_timeout, transcode_workers, passthrough, link_mode,
+                                        connections, chunk_size, stream)
         
         # 开始下载
-        if downloader.download(url, output, format, quality, source, cookies, cookies_from_browser):
+        results = downloader.download_collection(url, output, format, quality, source, cookies,
+                                                 cookies_from_browser, workers, sync, verify,
+                                                 pipeline, stage_workers, staging_dir, stream)
+        failed = [r for r in results if not r.success]
+        if not failed:
             logger.info("下载成功完成！")
         else:
-            logger.error("下载失败。")
-            exit(1)
+            for r in failed:
+                logger.error(f"失败: {r.name or r.track_id} - {r.error}")
+            if len(failed) == len(results):
+                logger.error("下载失败。")
+                exit(EXIT_FAILED)
+            logger.warning(f"部分歌曲下载失败: {len(failed)}/{len(results)}")
+            exit(EXIT_PARTIAL)
             
     except Exception as e:
         logger.error(f"发生错误: {str(e)}")
-        exit(1)
+        exit(EXIT_FAILED)
+    finally:
+        if metrics_json:
+            metrics.write_json(metrics_json)
+
+@main.command()
+@click.option('--host', default='127.0.0.1', help='监听地址 (默认: 127.0.0.1)')
+@click.option('--port', '-p', default=DEFAULT_PORT, type=click.IntRange(min=0, max=65535),
+              help=f'监听端口 (默认: {DEFAULT_PORT})')
+@click.option('--socket', 'socket_path', help='改为监听Unix socket，只有当前用户可以访问')
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=1), help='同时运行的任务数 (默认: 1)')
+@click.option('--queue-db', help=f'任务队列数据库 (默认: 缓存目录下的 {JOBS_DB_NAME})')
+@click.option('--output-root', help='任务的输出根目录 (默认: 当前目录)，任务中的相对路径以此为基准，'
+                                    '通过TCP提交的任务只能写入其中')
+@click.option('--format', '-f', default='mp3', help='任务的默认输出格式 (默认: mp3)')
+@click.option('--quality', '-q', default='320k', help='任务的默认音频质量 (默认: 320k)')
+@click.option('--source', '-s', default='youtubemusic', help='任务的默认音乐源，启动时预热其客户端 (默认: youtubemusic)')
+@click.option('--workers', '-w', default=4, type=click.IntRange(min=1), help='每个任务的默认并发下载数 (默认: 4)')
+@click.option('--source-timeout', default=DEFAULT_SOURCE_TIMEOUT, type=click.FloatRange(min=0.1),
+              help=f'自动模式下每个音乐源的搜索期限，单位秒 (默认: {DEFAULT_SOURCE_TIMEOUT:g})')
+@click.option('--cookies', '-c', help='Cookie文件路径 (用于YouTube验证)')
+@click.option('--cookies-from-browser', help='从浏览器导入cookies (chrome, firefox, edge, safari)')
+@click.option('--rate-limit', multiple=True, callback=parse_rate_limit_option,
+              help='音乐源最大请求速率，例如 youtubemusic=2，可重复指定，0表示不限速')
+@click.option('--cache-dir', help='缓存目录 (默认: ~/.cache/spotifydl)')
+@click.option('--no-cache', is_flag=True, help='不使用本地缓存')
+@click.option('--cover-max-size', type=click.IntRange(min=1), help='专辑封面最大边长(像素)，超出时缩小 (需要Pillow)')
+@click.option('--transcode-workers', type=click.IntRange(min=1), help='同时运行的转码进程数 (默认: CPU核数)')
+@click.option('--passthrough', is_flag=True, help='编码一致时直接复制音频流而不重新编码')
+@click.option('--link-mode', type=click.Choice(LINK_MODES), default='auto',
+              help='其他目录已下载过的歌曲放入输出目录的方式 (默认: auto)')
+@click.option('--connections', default=1, type=click.IntRange(min=1),
+              help='每首歌曲的音频流拆成多个字节范围，用多个连接同时下载；1表示由yt-dlp单连接下载 (默认: 1)')
+@click.option('--chunk-size', default=str(DEFAULT_CHUNK_SIZE), callback=parse_chunk_size,
+              help='分段下载时每段的大小，例如 512K、4M (默认: 1M)')
+def serve(host: str, port: int, socket_path: str, jobs: int, queue_db: str, output_root: str, format: str,
+          quality: str, source: str, workers: int, source_timeout: float, cookies: str, cookies_from_browser: str,
+          rate_limit: dict, cache_dir: str, no_cache: bool, cover_max_size: int, transcode_workers: int,
+          passthrough: bool, link_mode: str, connections: int, chunk_size: int):
+    """常驻服务：通过本地HTTP或Unix socket的JSON接口接收下载任务"""
+    from dotenv import load_dotenv
+    from .server import DownloadService, JobStore, create_server, remove_socket
+    load_dotenv()
+    try:
+        client_id, client_secret = _spotify_credentials()
+        if rate_limit:
+            configure_rate_limits(rate_limit)
+        cache_dir = None if no_cache else (cache_dir or default_cache_dir())
+        downloader = _create_downloader(client_id, client_secret, cache_dir, False, cover_max_size,
+                                        source_timeout, transcode_workers, passthrough, link_mode,
+                                        connections, chunk_size)
+        # 任务的默认参数，提交任务时可以覆盖
+        defaults = {'format': format, 'quality': quality, 'source': source, 'workers': workers}
+        if cookies:
+            defaults['cookies'] = cookies
+        if cookies_from_browser:
+            defaults['cookies_from_browser'] = cookies_from_browser
+        store = JobStore(queue_db or os.path.join(cache_dir or default_cache_dir(), JOBS_DB_NAME))
+        service = DownloadService(downloader, store, jobs, output_root, defaults)
+        server = create_server(service, host, port, socket_path)
+    except Exception as e:
+        logger.error(f"发生错误: {str(e)}")
+        exit(EXIT_FAILED)
+
+    # 提前获取Spotify令牌、创建YTMusic客户端并导入yt-dlp，第一个任务无需等待
+    try:
+        downloader.warm_up(source)
+    except Exception as e:
+        logger.warning(f"客户端预热失败，将在第一个任务时重试: {str(e)}")
+
+    # 收到SIGTERM时停止服务，运行中的任务在下次启动时重新执行
+    signal.signal(signal.SIGTERM, lambda *args: threading.Thread(target=server.shutdown).start())
+    service.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info("正在停止服务")
+        service.stop()
+        server.server_close()
+        if socket_path:
+            try:
+                remove_socket(socket_path)
+            except ValueError as e:
+                logger.warning(str(e))
+
+@main.command()
+@click.option('--queue', 'queue_url', required=True,
+              help='共享任务队列，例如 /mnt/shared/queue.sqlite 或 sqlite:///mnt/shared/queue.sqlite')
+@click.option('--url', '-u', 'urls', multiple=True, required=True, help='Spotify链接，可重复指定')
+@click.option('--output', '-o', required=True, help='输出目录路径，各节点需挂载到相同路径')
+@click.option('--format', '-f', default='mp3', help='输出格式 (默认: mp3)')
+@click.option('--quality', '-q', default='320k', help='音频质量 (默认: 320k)')
+@click.option('--source', '-s', default='youtubemusic', help='指定音乐源 (可选: deezer, youtubemusic, soundcloud, auto)')
+@click.option('--sync', is_flag=True, help='同步模式：节点只下载输出目录中缺失或有变化的歌曲')
+@click.option('--cache-dir', help='缓存目录 (默认: ~/.cache/spotifydl)')
+@click.option('--no-cache', is_flag=True, help='不使用本地缓存')
+def enqueue(queue_url: str, urls: Tuple[str, ...], output: str, format: str, quality: str, source: str, sync: bool,
+            cache_dir: str, no_cache: bool):
+    """把歌单等链接拆成单首歌曲的任务，加入多个节点共享的队列"""
+    from dotenv import load_dotenv
+    from .distributed import enqueue_collection, open_work_queue
+    load_dotenv()
+    try:
+        client_id, client_secret = _spotify_credentials()
+        cache_dir = None if no_cache else (cache_dir or default_cache_dir())
+        downloader = _create_downloader(client_id, client_secret, cache_dir, False, None,
+                                        DEFAULT_SOURCE_TIMEOUT, None, False, 'none')
+        queue = open_work_queue(queue_url)
+        for url in urls:
+            enqueue_collection(downloader, queue, url, output, format, quality, source, sync)
+        counts = queue.counts()
+        logger.info(f"队列: 排队 {counts['queued']}，处理中 {counts['leased']}，"
+                    f"完成 {counts['done']}，失败 {counts['failed']}")
+    except Exception as e:
+        logger.error(f"发生错误: {str(e)}")
+        exit(EXIT_FAILED)
+
+@main.command()
+@click.option('--queue', 'queue_url', required=True,
+              help='共享任务队列，例如 /mnt/shared/queue.sqlite 或 sqlite:///mnt/shared/queue.sqlite')
+@click.option('--worker-id', help='节点名称 (默认: 主机名:进程号)')
+@click.option('--workers', '-w', default=4, type=click.IntRange(min=1), help='同时处理的歌曲数 (默认: 4)')
+@click.option('--lease', 'lease_seconds', default=DEFAULT_LEASE_SECONDS, type=click.FloatRange(min=3),
+              help=f'租约时长，单位秒，节点失联超过该时间后任务重新排队 (默认: {DEFAULT_LEASE_SECONDS:g})')
+@click.option('--exit-when-empty', is_flag=True, help='队列中没有未完成的任务时退出，而不是继续等待新任务')
+@click.option('--source-timeout', default=DEFAULT_SOURCE_TIMEOUT, type=click.FloatRange(min=0.1),
+              help=f'自动模式下每个音乐源的搜索期限，单位秒 (默认: {DEFAULT_SOURCE_TIMEOUT:g})')
+@click.option('--cookies', '-c', help='Cookie文件路径 (用于YouTube验证)')
+@click.option('--cookies-from-browser', help='从浏览器导入cookies (chrome, firefox, edge, safari)')
+@click.option('--rate-limit', multiple=True, callback=parse_rate_limit_option,
+              help='音乐源最大请求速率，例如 youtubemusic=2，可重复指定，0表示不限速')
+@click.option('--verify', is_flag=True, help='同步任务校验已有文件的checksum')
+@click.option('--cache-dir', help='缓存目录 (默认: ~/.cache/spotifydl)')
+@click.option('--no-cache', is_flag=True, help='不使用本地缓存')
+@click.option('--cover-max-size', type=click.IntRange(min=1), help='专辑封面最大边长(像素)，超出时缩小 (需要Pillow)')
+@click.option('--transcode-workers', type=click.IntRange(min=1), help='同时运行的转码进程数 (默认: CPU核数)')
+@click.option('--passthrough', is_flag=True, help='编码一致时直接复制音频流而不重新编码')
+@click.option('--link-mode', type=click.Choice(LINK_MODES), default='auto',
+              help='已下载过的歌曲放入输出目录的方式 (默认: auto)')
+@click.option('--connections', default=1, type=click.IntRange(min=1),
+              help='每首歌曲的音频流拆成多个字节范围，用多个连接同时下载；1表示由yt-dlp单连接下载 (默认: 1)')
+@click.option('--chunk-size', default=str(DEFAULT_CHUNK_SIZE), callback=parse_chunk_size,
+              help='分段下载时每段的大小，例如 512K、4M (默认: 1M)')
+@click.option('--metrics-port', type=click.IntRange(min=0, max=65535),
+              help='在该端口提供Prometheus格式的统计接口 (/metrics)')
+def worker(queue_url: str, worker_id: str, workers: int, lease_seconds: float, exit_when_empty: bool,
+           source_timeout: float, cookies: str, cookies_from_browser: str, rate_limit: dict, verify: bool,
+           cache_dir: str, no_cache: bool, cover_max_size: int, transcode_workers: int, passthrough: bool,
+           link_mode: str, connections: int, chunk_size: int, metrics_port: int):
+    """分布式下载节点：从共享队列领取歌曲任务并下载，可在多台主机上同时运行"""
+    from dotenv import load_dotenv
+    from .distributed import QueueWorker, open_work_queue
+    load_dotenv()
+    try:
+        client_id, client_secret = _spotify_credentials()
+        if rate_limit:
+            configure_rate_limits(rate_limit)
+        if metrics_port is not None:
+            metrics.serve(metrics_port)
+        cache_dir = None if no_cache else (cache_dir or default_cache_dir())
+        downloader = _create_downloader(client_id, client_secret, cache_dir, False, cover_max_size,
+                                        source_timeout, transcode_workers, passthrough, link_mode,
+                                        connections, chunk_size)
+        queue = open_work_queue(queue_url)
+    except Exception as e:
+        logger.error(f"发生错误: {str(e)}")
+        exit(EXIT_FAILED)
+
+    node = QueueWorker(downloader, queue, worker_id, workers, lease_seconds, cookies=cookies,
+                       cookies_from_browser=cookies_from_browser, verify=verify)
+    # 收到SIGTERM时不再领取新任务，处理中的任务完成后退出；强行退出的任务在租约过期后由其他节点接手
+    signal.signal(signal.SIGTERM, lambda *args: node.stop())
+    try:
+        counts = node.run(exit_when_empty)
+    except KeyboardInterrupt:
+        node.stop()
+        exit(EXIT_FAILED)
+    finally:
+        downloader.transcode_pool.shutdown()
+    if counts['failed'] and not counts['done']:
+        exit(EXIT_FAILED)
+    if counts['failed']:
+        exit(EXIT_PARTIAL)
+
+@main.command('merge-manifests')
+@click.option('--queue', 'queue_url', required=True,
+              help='共享任务队列，例如 /mnt/shared/queue.sqlite 或 sqlite:///mnt/shared/queue.sqlite')
+@click.option('--force', is_flag=True, help='仍有节点在处理任务时也合并')
+def merge_manifests_command(queue_url: str, force: bool):
+    """把各节点写入的下载清单合并到输出目录的主清单，在所有节点结束后执行一次"""
+    from .distributed import merge_manifests, open_work_queue
+    try:
+        queue = open_work_queue(queue_url)
+        leased = queue.counts()['leased']
+        if leased and not force:
+            raise ValueError(f"还有 {leased} 个任务正在处理，请等节点结束后再合并，或使用 --force")
+        for output, count in merge_manifests(queue).items():
+            logger.info(f"{output}: 合并了 {count} 个节点清单")
+    except Exception as e:
+        logger.error(f"发生错误: {str(e)}")
+        exit(EXIT_FAILED)
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
@@ -0,0 +1,219 @@
+"""
+专辑封面缓存
+"""
+import hashlib
+import io
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from .http_client import HttpClient, get_http_client
+from .metrics import metrics
+from .ratelimit import get_limiter
+
+logger = logging.getLogger(__name__)
+
+# 内存中最多保留的封面总字节数
+DEFAULT_MEMORY_BYTES = 64 * 1024 * 1024
+# 封面写入磁盘时每次读取的字节数
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def downscale_cover(data: bytes, max_size: int) -> bytes:
+    """把封面缩小到最长边不超过max_size像素，需要安装Pillow"""
+    try:
+        from PIL import Image
+    except ImportError:
+        logger.warning("未安装Pillow，无法缩小专辑封面")
+        return data
+
+    image = Image.open(io.BytesIO(data))
+    if max(image.size) <= max_size:
+        return data
+    image.thumbnail((max_size, max_size))
+    output = io.BytesIO()
+    image.convert('RGB').save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+
+def downscale_cover_file(path: str, max_size: int):
+    """把封面文件原地缩小到最长边不超过max_size像素，需要安装Pillow"""
+    try:
+        from PIL import Image
+    except ImportError:
+        logger.warning("未安装Pillow，无法缩小专辑封面")
+        return
+
+    with Image.open(path) as image:
+        if max(image.size) <= max_size:
+            return
+        image.thumbnail((max_size, max_size))
+        image = image.convert('RGB')
+    image.save(path, format='JPEG', quality=90)
+
+
+class CoverCache:
+    """按封面URL缓存封面数据：内存LRU + 可选的磁盘缓存
+
+    同一张专辑的多首歌曲共用一个封面URL，只需下载一次。
+    stream_to_disk为True时不在内存中保留封面，下载时分块写入磁盘，通过get_path取得文件路径；
+    没有指定cache_dir时使用临时目录，对象回收或进程退出时删除。
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, max_memory_bytes: int = DEFAULT_MEMORY_BYTES,
+                 max_size: Optional[int] = None, http: Optional[HttpClient] = None, stream_to_disk: bool = False):
+        self._http = http
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir)) if cache_dir else None
+        self.stream_to_disk = stream_to_disk
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        elif stream_to_disk:
+            self.cache_dir = tempfile.mkdtemp(prefix='spotifydl-covers-')
+            weakref.finalize(self, shutil.rmtree, self.cache_dir, True)
+        self.max_memory_bytes = max_memory_bytes
+        self.max_size = max_size
+        self._memory: 'OrderedDict[str, bytes]' = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        # 同一封面正在被其他线程下载时等待其结果，而不是重复下载
+        self._key_locks: Dict[str, threading.Lock] = {}
+
+    @property
+    def http(self) -> HttpClient:
+        """首次下载封面时才创建HTTP客户端"""
+        if self._http is None:
+            self._http = get_http_client()
+        return self._http
+
+    def _key(self, url: str) -> str:
+        """缓存键包含缩放尺寸，不同尺寸的封面分开缓存"""
+        return hashlib.sha1(f"{url}|{self.max_size or ''}".encode('utf-8')).hexdigest()
+
+    def _disk_path(self, key: str) -> Optional[str]:
+        return os.path.join(self.cache_dir, f"{key}.jpg") if self.cache_dir else None
+
+    def _remember(self, key: str, data: bytes):
+        """放入内存LRU，超出容量时淘汰最久未使用的封面"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def _from_memory(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+            return data
+
+    def get(self, url: str) -> Optional[bytes]:
+        """获取封面数据，依次查找内存、磁盘，最后从网络下载"""
+        key = self._key(url)
+        data = self._from_memory(key)
+        if data is not None:
+            metrics.incr('cover_cache', result='memory')
+            return data
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        try:
+            with key_lock:
+                # 等待期间可能已被其他线程下载
+                data = self._from_memory(key)
+                if data is not None:
+                    metrics.incr('cover_cache', result='memory')
+                    return data
+
+                disk_path = self._disk_path(key)
+                if disk_path and os.path.exists(disk_path):
+                    with open(disk_path, 'rb') as f:
+                        data = f.read()
+                    metrics.incr('cover_cache', result='disk')
+                else:
+                    data = self._fetch(url)
+                    if data is None:
+                        return None
+                    metrics.incr('cover_cache', result='fetched')
+                    if disk_path:
+                        temp_path = f"{disk_path}.{threading.get_ident()}.tmp"
+                        with open(temp_path, 'wb') as f:
+                            f.write(data)
+                        os.replace(temp_path, disk_path)
+
+                self._remember(key, data)
+            return data
+        finally:
+            with self._lock:
+                self._key_locks.pop(key, None)
+
+    def get_path(self, url: str) -> Optional[str]:
+        """获取封面文件路径，只查找磁盘，没有时分块下载到磁盘，不经过内存缓存"""
+        key = self._key(url)
+        disk_path = self._disk_path(key)
+        if disk_path is None:
+            raise ValueError("没有磁盘缓存目录，无法获取封面文件路径")
+        if os.path.exists(disk_path):
+            metrics.incr('cover_cache', result='disk')
+            return disk_path
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        try:
+            with key_lock:
+                if os.path.exists(disk_path):
+                    metrics.incr('cover_cache', result='disk')
+                    return disk_path
+                if not self._fetch_to_file(url, disk_path):
+                    return None
+                metrics.incr('cover_cache', result='fetched')
+                return disk_path
+        finally:
+            with self._lock:
+                self._key_locks.pop(key, None)
+
+    def _fetch_to_file(self, url: str, path: str) -> bool:
+        """分块下载封面到path，并按需缩小"""
+        response = self.http.get(url, limiter=get_limiter('covers'), stream=True)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            if response.status_code != 200:
+                logger.warning(f"下载专辑封面失败: HTTP {response.status_code}")
+                return False
+            size = 0
+            with open(temp_path, 'wb') as f:
+                for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                    f.write(chunk)
+                    size += len(chunk)
+            metrics.incr('cover_bytes', size)
+            if self.max_size:
+                downscale_cover_file(temp_path, self.max_size)
+            os.replace(temp_path, path)
+            return True
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        finally:
+            response.close()
+
+    def _fetch(self, url: str) -> Optional[bytes]:
+        """下载封面，并按需缩小"""
+        response = self.http.get(url, limiter=get_limiter('covers'))
+        if response.status_code != 200:
+            logger.warning(f"下载专辑封面失败: HTTP {response.status_code}")
+            return None
+        data = response.content
+        metrics.incr('cover_bytes', len(data))
+        if self.max_size:
+            data = downscale_cover(data, self.max_size)
+        return data
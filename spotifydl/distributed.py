@@ -0,0 +1,502 @@
+"""
+多机分布式下载：各节点从共享队列领取单首歌曲的任务，通过租约和心跳协调
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Type, Union
+
+from .cache import SQLiteStore
+from .manifest import DownloadManifest
+from .metrics import metrics
+
+if TYPE_CHECKING:
+    from .downloader import SpotifyDownloader, TrackResult
+
+logger = logging.getLogger(__name__)
+
+# 租约时长（秒），节点在此期间没有心跳时任务重新排队
+DEFAULT_LEASE_SECONDS = 120.0
+# 任务失败或节点失联达到该次数后不再重试
+DEFAULT_MAX_ATTEMPTS = 3
+# 队列为空时再次领取的间隔（秒）
+DEFAULT_POLL_INTERVAL = 5.0
+# 每次写入队列的歌曲数
+ENQUEUE_BATCH_SIZE = 500
+TASK_STATUSES = ('queued', 'leased', 'done', 'failed')
+
+
+def track_key(track_info: Dict[str, Any]) -> str:
+    """同一录音在不同歌单中可能有不同的Spotify ID，有ISRC时按ISRC去重"""
+    isrc = track_info.get('isrc')
+    return f"isrc:{isrc.upper()}" if isrc else f"spotify:{track_info['spotify_id']}"
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue(ABC):
+    """多个节点共享的歌曲任务队列
+
+    任务按 (Spotify ID, 输出目录, 格式, 质量) 去重。节点领取任务时获得有期限的租约，
+    处理期间定期续约；租约过期的任务重新排队，只有持有租约的节点可以提交结果。
+    """
+
+    @abstractmethod
+    def enqueue(self, tasks: Iterable[Dict[str, Any]]) -> int:
+        """添加任务，每项包含 track_info、output、format、quality、source、sync，返回新加入或重新排队的任务数
+
+        已存在的任务不重复添加，之前失败的任务重新排队。
+        """
+
+    @abstractmethod
+    def lease(self, worker_id: str, count: int, lease_seconds: float) -> List[Dict[str, Any]]:
+        """领取最多count个任务；同一录音同时只会被一个节点领取"""
+
+    @abstractmethod
+    def heartbeat(self, worker_id: str, task_ids: List[int], lease_seconds: float) -> List[int]:
+        """延长租约，返回仍由该节点持有的任务"""
+
+    @abstractmethod
+    def complete(self, task_id: int, worker_id: str, result: Dict[str, Any]) -> bool:
+        """提交结果，租约已被其他节点取得时返回False"""
+
+    @abstractmethod
+    def fail(self, task_id: int, worker_id: str, error: str) -> bool:
+        """记录失败，未达到重试次数时重新排队；租约已失效时返回False"""
+
+    @abstractmethod
+    def find_done(self, key: str, format: str, quality: str) -> Optional[Dict[str, Any]]:
+        """其他节点已下载的同一首歌，返回 {'path', 'size', 'sha256', 'source', 'source_id'}"""
+
+    @abstractmethod
+    def counts(self) -> Dict[str, int]:
+        """各状态的任务数"""
+
+    @abstractmethod
+    def outputs(self) -> List[str]:
+        """任务涉及的所有输出目录"""
+
+    def close(self):
+        pass
+
+
+class SQLiteWorkQueue(SQLiteStore, WorkQueue):
+    """保存在共享文件系统（NFS、SMB等）上的SQLite任务队列
+
+    WAL依赖共享内存，不能跨主机使用，因此改用回滚日志；领取任务时用 BEGIN IMMEDIATE
+    取得写锁，依赖文件系统的字节范围锁在节点之间互斥。每次写入都是一个短事务。
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            spotify_id TEXT NOT NULL,
+            track_key TEXT NOT NULL,
+            output TEXT NOT NULL,
+            format TEXT NOT NULL,
+            quality TEXT NOT NULL,
+            source TEXT NOT NULL,
+            sync INTEGER NOT NULL DEFAULT 0,
+            track_info TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker TEXT,
+            lease_expires REAL,
+            result TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            UNIQUE (spotify_id, output, format, quality)
+        );
+        CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, id);
+        CREATE INDEX IF NOT EXISTS tasks_track ON tasks (track_key, format, quality, status);
+    '''
+    JOURNAL_MODE = 'DELETE'
+    COLUMNS = ('id', 'spotify_id', 'track_key', 'output', 'format', 'quality', 'source', 'sync', 'track_info',
+               'status', 'attempts', 'worker', 'lease_expires', 'result', 'error')
+
+    def __init__(self, path: str, max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        super().__init__(path)
+        self.max_attempts = max_attempts
+
+    def _row(self, row) -> Dict[str, Any]:
+        task = dict(zip(self.COLUMNS, row))
+        task['sync'] = bool(task['sync'])
+        task['track_info'] = json.loads(task['track_info'])
+        task['result'] = json.loads(task['result']) if task['result'] else None
+        return task
+
+    def enqueue(self, tasks: Iterable[Dict[str, Any]]) -> int:
+        now = time.time()
+        values = [
+            (task['track_info']['spotify_id'], track_key(task['track_info']),
+             os.path.abspath(os.path.expanduser(task['output'])), task['format'], task['quality'], task['source'],
+             int(bool(task.get('sync'))), json.dumps(task['track_info'], ensure_ascii=False), now, now)
+            for task in tasks
+        ]
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                'INSERT INTO tasks (spotify_id, track_key, output, format, quality, source, sync, track_info, '
+                "status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'queued', ?, ?) "
+                'ON CONFLICT (spotify_id, output, format, quality) DO UPDATE SET '
+                "status = 'queued', attempts = 0, error = NULL, track_info = excluded.track_info, "
+                "updated_at = excluded.updated_at WHERE status = 'failed'",
+                values
+            )
+            self._conn.commit()
+            return self._conn.total_changes - before
+
+    def _requeue_expired(self, now: float) -> int:
+        """租约过期的任务重新排队，节点多次失联的任务标记为失败，需在事务中调用"""
+        self._conn.execute(
+            "UPDATE tasks SET status = 'failed', worker = NULL, lease_expires = NULL, "
+            "error = COALESCE(error, '租约多次过期'), updated_at = ? "
+            "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+            (now, now, self.max_attempts)
+        )
+        return self._conn.execute(
+            "UPDATE tasks SET status = 'queued', worker = NULL, lease_expires = NULL, updated_at = ? "
+            "WHERE status = 'leased' AND lease_expires < ?",
+            (now, now)
+        ).rowcount
+
+    def lease(self, worker_id: str, count: int, lease_seconds: float) -> List[Dict[str, Any]]:
+        if count < 1:
+            return []
+        now = time.time()
+        with self._lock:
+            # 立即取得写锁，避免两个节点读到同样的排队任务
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                requeued = self._requeue_expired(now)
+                # 多取一些，同一录音只保留一个，其余留给以后（届时可以直接链接已下载的文件）
+                rows = self._conn.execute(
+                    f"SELECT {', '.join(self.COLUMNS)} FROM tasks AS t WHERE status = 'queued' AND NOT EXISTS "
+                    "(SELECT 1 FROM tasks AS l WHERE l.status = 'leased' AND l.track_key = t.track_key "
+                    'AND l.format = t.format AND l.quality = t.quality) ORDER BY id LIMIT ?',
+                    (count * 4,)
+                ).fetchall()
+                tasks: List[Dict[str, Any]] = []
+                seen = set()
+                for row in rows:
+                    task = self._row(row)
+                    key = (task['track_key'], task['format'], task['quality'])
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    tasks.append(task)
+                    if len(tasks) == count:
+                        break
+                expires = now + lease_seconds
+                self._conn.executemany(
+                    "UPDATE tasks SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, "
+                    'updated_at = ? WHERE id = ?',
+                    [(worker_id, expires, now, task['id']) for task in tasks]
+                )
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+        if requeued:
+            logger.warning(f"{requeued} 个任务的租约已过期，重新排队")
+            metrics.incr('queue_requeued', requeued)
+        for task in tasks:
+            task.update(status='leased', worker=worker_id, lease_expires=expires, attempts=task['attempts'] + 1)
+        return tasks
+
+    def heartbeat(self, worker_id: str, task_ids: List[int], lease_seconds: float) -> List[int]:
+        if not task_ids:
+            return []
+        placeholders = ','.join('?' * len(task_ids))
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE tasks SET lease_expires = ? WHERE worker = ? AND status = 'leased' "
+                f"AND id IN ({placeholders})",
+                (time.time() + lease_seconds, worker_id, *task_ids)
+            )
+            rows = self._conn.execute(
+                f"SELECT id FROM tasks WHERE worker = ? AND status = 'leased' AND id IN ({placeholders})",
+                (worker_id, *task_ids)
+            ).fetchall()
+            self._conn.commit()
+        return [row[0] for row in rows]
+
+    def complete(self, task_id: int, worker_id: str, result: Dict[str, Any]) -> bool:
+        # 条件更新保证每个任务只提交一次
+        with self._lock:
+            updated = self._conn.execute(
+                "UPDATE tasks SET status = 'done', result = ?, error = NULL, lease_expires = NULL, updated_at = ? "
+                "WHERE id = ? AND worker = ? AND status = 'leased'",
+                (json.dumps(result, ensure_ascii=False), time.time(), task_id, worker_id)
+            ).rowcount
+            self._conn.commit()
+        return bool(updated)
+
+    def fail(self, task_id: int, worker_id: str, error: str) -> bool:
+        with self._lock:
+            updated = self._conn.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+                'worker = NULL, lease_expires = NULL, error = ?, updated_at = ? '
+                "WHERE id = ? AND worker = ? AND status = 'leased'",
+                (self.max_attempts, error, time.time(), task_id, worker_id)
+            ).rowcount
+            self._conn.commit()
+        return bool(updated)
+
+    def find_done(self, key: str, format: str, quality: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result FROM tasks WHERE track_key = ? AND format = ? AND quality = ? AND status = 'done' "
+                'ORDER BY updated_at DESC LIMIT 1',
+                (key, format, quality)
+            ).fetchone()
+        if not row or not row[0]:
+            return None
+        result = json.loads(row[0])
+        try:
+            if os.path.getsize(result['path']) == result['size']:
+                return result
+        except OSError:
+            pass
+        # 文件不在共享存储上或已被改动，重新下载
+        return None
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute('SELECT status, COUNT(*) FROM tasks GROUP BY status').fetchall()
+        return {status: dict(rows).get(status, 0) for status in TASK_STATUSES}
+
+    def outputs(self) -> List[str]:
+        with self._lock:
+            rows = self._conn.execute('SELECT DISTINCT output FROM tasks ORDER BY output').fetchall()
+        return [row[0] for row in rows]
+
+    def failures(self, limit: int = 100) -> List[Dict[str, Any]]:
+        """最近失败的任务"""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM tasks WHERE status = 'failed' ORDER BY updated_at DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+        return [self._row(row) for row in rows]
+
+
+# 队列后端，可按URL的scheme注册其他实现
+QUEUE_BACKENDS: Dict[str, Type[WorkQueue]] = {
+    'sqlite': SQLiteWorkQueue,
+}
+
+
+def open_work_queue(url: str) -> WorkQueue:
+    """打开任务队列，例如 sqlite:///mnt/shared/queue.sqlite；不带scheme时视为SQLite文件路径"""
+    scheme, sep, location = url.partition('://')
+    if not sep:
+        scheme, location = 'sqlite', url
+    backend = QUEUE_BACKENDS.get(scheme)
+    if not backend:
+        raise ValueError(f"不支持的任务队列: {scheme}，可选: {', '.join(QUEUE_BACKENDS)}")
+    return backend(location)
+
+
+def enqueue_collection(downloader: 'SpotifyDownloader', queue: WorkQueue, url: str, output: str,
+                       format: str = 'mp3', quality: str = '320k', source: str = 'auto', sync: bool = False) -> int:
+    """把单曲、歌单、专辑或艺术家热门歌曲拆成单首歌曲的任务，返回新加入或重新排队的任务数"""
+    parsed = downloader._parse_spotify_url(url)
+    if not parsed:
+        raise ValueError("无效的Spotify URL")
+    downloader._select_sources(source)
+    kind, spotify_id = parsed
+    added = total = 0
+    batch: List[Dict[str, Any]] = []
+    for track_info in downloader.metadata.iter_collection(kind, spotify_id):
+        batch.append({'track_info': track_info, 'output': output, 'format': format, 'quality': quality,
+                      'source': source, 'sync': sync})
+        if len(batch) >= ENQUEUE_BATCH_SIZE:
+            added += queue.enqueue(batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        added += queue.enqueue(batch)
+        total += len(batch)
+    if not total:
+        raise ValueError(f"链接中没有可下载的歌曲: {url}")
+    logger.info(f"{kind} {spotify_id}: 共 {total} 首，新加入队列 {added} 首")
+    return added
+
+
+def merge_manifests(queue: WorkQueue) -> Dict[str, int]:
+    """把队列中各输出目录下的节点清单并入主清单，返回 {输出目录: 合并的节点清单数}
+
+    应在所有节点结束后在一台主机上执行。
+    """
+    merged = {}
+    for output in queue.outputs():
+        if os.path.isdir(output):
+            merged[output] = DownloadManifest(output).merge_nodes()
+    return merged
+
+
+class QueueWorker:
+    """从共享队列领取任务并下载的节点
+
+    同时持有的任务数不超过workers，后台线程按租约时长的三分之一定期续约。
+    其他节点已下载过的歌曲直接链接到输出目录（输出目录需在各节点挂载到相同路径）。
+    下载记录只写入本节点的清单，节点不重写共享的主清单，由merge_manifests在所有节点结束后统一合并。
+    """
+
+    def __init__(self, downloader: 'SpotifyDownloader', queue: WorkQueue, worker_id: Optional[str] = None,
+                 workers: int = 4, lease_seconds: float = DEFAULT_LEASE_SECONDS,
+                 poll_interval: float = DEFAULT_POLL_INTERVAL, cookies: Optional[str] = None,
+                 cookies_from_browser: Optional[str] = None, verify: bool = False):
+        self.downloader = downloader
+        self.queue = queue
+        self.worker_id = worker_id or default_worker_id()
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.cookies = cookies
+        self.cookies_from_browser = cookies_from_browser
+        self.verify = verify
+        self.counts = {'done': 0, 'failed': 0, 'lost': 0}
+        self._active: Dict[int, Dict[str, Any]] = {}
+        self._manifests: Dict[str, DownloadManifest] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._slot_freed = threading.Event()
+
+    def stop(self):
+        """不再领取新任务，正在处理的任务完成后退出"""
+        self._stop.set()
+        self._slot_freed.set()
+
+    def run(self, exit_when_empty: bool = False) -> Dict[str, int]:
+        """领取并处理任务，直到调用stop，或exit_when_empty为True且队列中没有未完成的任务"""
+        logger.info(f"节点 {self.worker_id} 开始领取任务，并发数: {self.workers}")
+        heartbeat = threading.Thread(target=self._heartbeat_loop, name='lease-heartbeat', daemon=True)
+        heartbeat.start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                while not self._stop.is_set():
+                    self._slot_freed.clear()
+                    with self._lock:
+                        free = self.workers - len(self._active)
+                    if not free:
+                        self._slot_freed.wait(self.poll_interval)
+                        continue
+                    try:
+                        tasks = self.queue.lease(self.worker_id, free, self.lease_seconds)
+                    except Exception as e:
+                        logger.warning(f"领取任务失败，稍后重试: {str(e)}")
+                        self._stop.wait(self.poll_interval)
+                        continue
+                    for task in tasks:
+                        with self._lock:
+                            self._active[task['id']] = task
+                        executor.submit(self._process, task)
+                    if tasks:
+                        continue
+                    if exit_when_empty and not self._active:
+                        counts = self.queue.counts()
+                        if not counts['queued'] and not counts['leased']:
+                            break
+                    # 队列暂时为空或其余任务已被其他节点领取
+                    self._slot_freed.wait(self.poll_interval)
+        finally:
+            self._stop.set()
+            for music_source in list(self.downloader._sources.values()):
+                music_source.close()
+            from .downloader import STAGING_DIR_NAME
+            for manifest in self._manifests.values():
+                # 暂存目录为空时删除
+                try:
+                    os.rmdir(os.path.join(manifest.output_path, STAGING_DIR_NAME))
+                except OSError:
+                    pass
+        logger.info(f"节点 {self.worker_id} 结束: 完成 {self.counts['done']} 首，失败 {self.counts['failed']} 首，"
+                    f"租约失效 {self.counts['lost']} 首")
+        return dict(self.counts)
+
+    def _heartbeat_loop(self):
+        interval = self.lease_seconds / 3
+        while not self._stop.wait(interval):
+            with self._lock:
+                task_ids = list(self._active)
+            if not task_ids:
+                continue
+            try:
+                held = set(self.queue.heartbeat(self.worker_id, task_ids, self.lease_seconds))
+            except Exception as e:
+                logger.warning(f"续约失败: {str(e)}")
+                continue
+            lost = [task_id for task_id in task_ids if task_id not in held]
+            if lost:
+                logger.warning(f"任务 {lost} 的租约已失效，可能已由其他节点处理")
+
+    def _manifest(self, output: str) -> DownloadManifest:
+        """同一输出目录的任务共用一个清单，新记录写入本节点的清单文件"""
+        with self._lock:
+            manifest = self._manifests.get(output)
+            if manifest is None:
+                os.makedirs(output, exist_ok=True)
+                manifest = self._manifests[output] = DownloadManifest(output, node=self.worker_id)
+            return manifest
+
+    def _process(self, task: Dict[str, Any]):
+        from .downloader import STAGING_DIR_NAME
+        track_info = task['track_info']
+        try:
+            manifest = self._manifest(task['output'])
+            result = self._download(task, manifest, os.path.join(manifest.output_path, STAGING_DIR_NAME))
+            if isinstance(result, Future):
+                result = result.result()
+            entry = manifest.get(track_info['spotify_id']) if result.success else None
+            if result.success and entry:
+                committed = self.queue.complete(task['id'], self.worker_id, {
+                    'path': os.path.join(manifest.output_path, entry['path']),
+                    'size': entry['size'],
+                    'sha256': entry.get('sha256'),
+                    'source': entry.get('source'),
+                    'source_id': entry.get('source_id'),
+                })
+                status = 'done'
+            else:
+                committed = self.queue.fail(task['id'], self.worker_id, result.error or '下载失败')
+                status = 'failed'
+        except Exception as e:
+            logger.error(f"任务 #{task['id']} 出错 ({track_info['name']}): {str(e)}")
+            committed = self.queue.fail(task['id'], self.worker_id, str(e))
+            status = 'failed'
+        finally:
+            with self._lock:
+                self._active.pop(task['id'], None)
+            self._slot_freed.set()
+        if not committed:
+            # 文件按原子替换写入，重复处理不会损坏输出，结果以先提交的节点为准
+            status = 'lost'
+            logger.warning(f"任务 #{task['id']} 的租约已被其他节点取得，不提交结果: {track_info['name']}")
+        with self._lock:
+            self.counts[status] += 1
+        metrics.incr('queue_tasks', status=status)
+
+    def _download(self, task: Dict[str, Any], manifest: DownloadManifest,
+                  staging_path: str) -> Union['TrackResult', 'Future[TrackResult]']:
+        from .downloader import TrackResult
+        track_info = task['track_info']
+        downloader = self.downloader
+        if not (task['sync'] and manifest.is_up_to_date(track_info, task['format'], task['quality'], self.verify)):
+            # 其他节点已下载过同一首歌时直接链接
+            existing = self.queue.find_done(task['track_key'], task['format'], task['quality'])
+            if existing and downloader._place_from_library(track_info, manifest.output_path, task['format'],
+                                                           task['quality'], manifest, existing):
+                return TrackResult(track_info['spotify_id'], True, track_info['name'], linked=True)
+        os.makedirs(staging_path, exist_ok=True)
+        return downloader._download_track(track_info, manifest.output_path, task['format'], task['quality'],
+                                          task['source'], self.cookies, self.cookies_from_browser, manifest,
+                                          task['sync'], self.verify, staging_path)
@@ -1,502 +1,1127 @@
 import os
 import re
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
 import logging
-from typing import Optional, Dict, Any, List
-import requests
+import threading
+from typing import Callable, Optional, Dict, Any, Iterable, Iterator, List, Set, Tuple, Union
+import time
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
+from dataclasses import dataclass
 from abc import ABC, abstractmethod
-import json
-from ytmusicapi import YTMusic
-from yt_dlp import YoutubeDL
-from mutagen.id3 import ID3, APIC, TIT2, TPE1, TALB, TDRC, TRCK
-from mutagen.mp3 import MP3
-from mutagen import File
-import tempfile
+# spotipy、yt_dlp、ytmusicapi 导入较慢，在首次使用时才导入
+from .metadata import SpotifyMetadataFetcher
+from .cache import MetadataCache, MatchCache, IsrcIndex, read_isrc_rows
+from .manifest import DownloadManifest
+from .library import LibraryIndex, place_file
+from .covers import CoverCache
+from .http_client import HttpClient, get_http_client
+from .ranged import RangedDownloader
+from .transcode import transcode_audio, TranscodePool
+from .matching import score_match, FULL_MATCH_SCORE, ISRC_BONUS, EXACT_MATCH_SCORE
+from .ratelimit import get_limiter
+from .metrics import metrics
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 支持的Spotify链接类型：单曲、歌单、专辑、艺术家热门歌曲
+SPOTIFY_URL_PATTERN = re.compile(r'(track|playlist|album|artist)[/:]([a-zA-Z0-9]+)')
+# 自动模式下每个音乐源的搜索期限（秒），超时的音乐源不再等待
+DEFAULT_SOURCE_TIMEOUT = 10.0
+# 自动模式下每个音乐源的搜索线程数，超过期限被忽略的搜索在返回前仍占用线程
+SOURCE_SEARCH_CONCURRENCY = 8
+# 默认的原始音频暂存目录，位于输出目录下，与最终文件在同一文件系统
+STAGING_DIR_NAME = '.spotifydl-staging'
+
+def create_safe_filename(track_info: Dict[str, Any]) -> str:
+    """创建安全的文件名"""
+    title = track_info['name']
+    artist = track_info['artists'][0] if track_info['artists'] else 'Unknown Artist'
+    filename = f"{artist} - {title}"
+
+    # 移除不安全的字符
+    unsafe_chars = ['<', '>', ':', '"', '/', '\\', '|', '?', '*']
+    for char in unsafe_chars:
+        filename = filename.replace(char, '_')
+
+    return filename
+
+def _observe(items: Iterable[Dict[str, Any]], callback: Callable[[Dict[str, Any]], None]) -> Iterator[Dict[str, Any]]:
+    """逐个产出items，产出前调用callback"""
+    for item in items:
+        callback(item)
+        yield item
+
+def _unique_tracks(tracks: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """跳过重复的歌曲，同一首歌在歌单中出现多次时只下载一次，避免并发写入同一个临时文件"""
+    seen: Set[str] = set()
+    for track_info in tracks:
+        if track_info['spotify_id'] in seen:
+            logger.info(f"跳过重复的歌曲: {track_info['name']}")
+            continue
+        seen.add(track_info['spotify_id'])
+        yield track_info
+
+def _discard(path: Optional[str]):
+    """删除失败任务留下的临时文件，文件不存在时忽略"""
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def _temp_filename(track_info: Dict[str, Any]) -> str:
+    """下载过程中使用的临时文件名"""
+    return f"temp_spotify_dl_{track_info['spotify_id']}"
+
+@dataclass
+class TrackResult:
+    """单首歌曲的下载结果"""
+    track_id: str
+    success: bool
+    name: Optional[str] = None
+    error: Optional[str] = None
+    # 同步模式下已是最新而跳过
+    skipped: bool = False
+    # 曲库中已有，通过链接放置而没有重新下载
+    linked: bool = False
+
 class MusicSource(ABC):
-    """音乐源抽象基类"""
+    """音乐源抽象基类
+
+    下载分为三个步骤：fetch_audio 下载原始音频（同时用 fetch_cover 获取专辑封面），
+    transcode 转换格式并写入标签和封面，finalize 重命名为最终文件。download_track 依次执行这三步，
+    流水线模式则把它们放在不同的阶段中并发执行。
+    """
+    # 与命令行 --source 参数对应的名称
+    name = ''
+    # 是否已实现下载，自动模式下优先选择可下载的音乐源
+    downloadable = True
+    # ISRC查询本身也是一次搜索请求时为True：先模糊搜索，得分不足时才按ISRC查询，避免每首歌搜索两次
+    isrc_via_search = False
+
+    def __init__(self, cover_cache: Optional[CoverCache] = None,
+                 range_downloader: Optional[RangedDownloader] = None):
+        # 同一专辑的封面只下载一次
+        self.cover_cache = cover_cache or CoverCache()
+        # 不为None时，支持Range请求的音频流分段并发下载
+        self.range_downloader = range_downloader
+        # 同一音乐源的所有请求共用一个限速器
+        self.limiter = get_limiter(self.name)
+
     @abstractmethod
+    def find_candidate(self, track_info: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """搜索音乐并返回匹配结果 {'url', 'source_id', 'score'}，未找到时返回None，请求失败时抛出异常"""
+        pass
+
+    def lookup_isrc(self, track_info: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """通过ISRC查找歌曲，返回格式与find_candidate相同，音乐源确认ISRC一致时结果带有 'exact': True
+
+        不支持ISRC查询的音乐源返回None，由调用方退回模糊搜索。
+        """
+        return None
+
+    @classmethod
+    def source_url(cls, source_id: str) -> Optional[str]:
+        """根据音乐源的歌曲ID生成下载链接，无法生成时返回None"""
+        return None
+
+    def warm_up(self):
+        """提前创建客户端，常驻服务启动时调用，避免第一个任务承担初始化开销"""
+        pass
+
+    def close(self):
+        """释放已结束的下载线程持有的下载器实例等资源，之后仍可继续使用"""
+        pass
+
     def search_track(self, track_info: Dict[str, Any]) -> Optional[str]:
         """搜索音乐并返回下载链接"""
-        pass
+        try:
+            candidate = self.find_candidate(track_info)
+            return candidate['url'] if candidate else None
+        except Exception as e:
+            logger.error(f"{self.__class__.__name__}搜索失败: {str(e)}")
+            return None
 
     @abstractmethod
+    def fetch_audio(self, url: str, output_path: str, track_info: Dict[str, Any],
+                    cookies: Optional[str] = None, cookies_from_browser: Optional[str] = None,
+                    preferred_format: Optional[str] = None) -> Optional[str]:
+        """下载原始音频到输出目录下的临时文件，返回文件路径，失败时返回None
+
+        preferred_format不为空时，优先选择编码与该格式一致的音频流，以便直接复制而不重新编码。
+        """
+        pass
+
+    def fetch_cover(self, track_info: Dict[str, Any]) -> Tuple[Optional[bytes], Optional[str]]:
+        """获取专辑封面，返回 (封面数据, 封面文件路径)，流式模式下封面只保存在磁盘上，只返回路径
+
+        在下载阶段调用，转码池中只做转码，不等待网络请求。
+        """
+        cover_data = cover_path = None
+        with metrics.span('cover'):
+            if self.cover_cache.stream_to_disk:
+                cover_path = self._album_cover_path(track_info)
+            else:
+                cover_data = self._download_album_cover(track_info)
+        if not cover_data and not cover_path:
+            logger.warning("专辑封面获取失败")
+        return cover_data, cover_path
+
+    def transcode(self, source_path: str, output_path: str, format: str, quality: str,
+                  track_info: Dict[str, Any], passthrough: bool = False,
+                  cover: Optional[bytes] = None, cover_path: Optional[str] = None) -> str:
+        """把原始音频转换为指定格式，返回转换后的临时文件路径
+
+        passthrough为True且原始音频编码已符合目标格式时只重新封装，不重新编码。
+        标签和专辑封面（fetch_cover的结果）由ffmpeg在转换时一并写入，转换后的文件不再重新读写。
+        """
+        temp_file_path = os.path.join(output_path, f"{_temp_filename(track_info)}.{format}")
+        try:
+            logger.info(f"开始转换格式: {os.path.basename(source_path)} -> {format} {quality}")
+            with metrics.span('transcode', format=format):
+                copied = transcode_audio(source_path, temp_file_path, format, quality, passthrough,
+                                         self._audio_tags(track_info), cover, cover_path)
+        except BaseException:
+            # 删除转换了一半的输出
+            _discard(temp_file_path)
+            raise
+        finally:
+            # 原始音频转换后不再需要，转换失败时也删除，不留在暂存目录中
+            _discard(source_path)
+        if copied:
+            metrics.incr('transcode_passthrough', format=format)
+        return temp_file_path
+
+    def finalize(self, temp_file_path: str, output_path: str, format: str, track_info: Dict[str, Any]) -> str:
+        """重命名为最终文件，返回最终文件路径"""
+        safe_filename = self._create_safe_filename(track_info)
+        final_output_path = os.path.join(output_path, f"{safe_filename}.{format}")
+
+        # 重命名文件为最终名称，原子地覆盖可能存在的同名文件
+        with metrics.span('rename'):
+            os.replace(temp_file_path, final_output_path)
+        metrics.incr('output_bytes', os.path.getsize(final_output_path), format=format)
+        logger.info(f"下载完成并已设置标签: {safe_filename}.{format}")
+        return final_output_path
+
     def download_track(self, url: str, output_path: str, format: str, quality: str, track_info: Dict[str, Any], 
-                      cookies: Optional[str] = None, cookies_from_browser: Optional[str] = None) -> bool:
+                      cookies: Optional[str] = None, cookies_from_browser: Optional[str] = None,
+                      passthrough: bool = False) -> bool:
         """下载音乐"""
-        pass
+        try:
+            # 确保输出路径是绝对路径
+            output_path = os.path.abspath(os.path.expanduser(output_path))
+            source_path = self.fetch_audio(url, output_path, track_info, cookies, cookies_from_browser,
+                                           format if passthrough else None)
+            if not source_path:
+                return False
+            cover, cover_path = self.fetch_cover(track_info)
+            temp_file_path = self.transcode(source_path, output_path, format, quality, track_info, passthrough,
+                                            cover, cover_path)
+            self.finalize(temp_file_path, output_path, format, track_info)
+            return True
+        except Exception as e:
+            logger.error(f"使用{self.__class__.__name__}下载失败: {str(e)}")
+            import traceback
+            logger.error(f"详细错误信息: {traceback.format_exc()}")
+            return False
+
+    def _download_album_cover(self, track_info: Dict[str, Any]) -> Optional[bytes]:
+        """获取专辑封面数据"""
+        try:
+            if track_info.get('album_cover_url'):
+                return self.cover_cache.get(track_info['album_cover_url'])
+        except Exception as e:
+            logger.warning(f"下载专辑封面失败: {str(e)}")
+        return None
+
+    def _album_cover_path(self, track_info: Dict[str, Any]) -> Optional[str]:
+        """获取专辑封面文件路径"""
+        try:
+            if track_info.get('album_cover_url'):
+                return self.cover_cache.get_path(track_info['album_cover_url'])
+        except Exception as e:
+            logger.warning(f"下载专辑封面失败: {str(e)}")
+        return None
+
+    def _audio_tags(self, track_info: Dict[str, Any]) -> Dict[str, str]:
+        """写入音频文件的标签，键名为ffmpeg通用的元数据名称"""
+        tags = {
+            'title': track_info['name'],
+            'artist': ', '.join(track_info['artists']),
+            'album': track_info.get('album') or '',
+            # 发行年份
+            'date': (track_info.get('release_date') or '')[:4],
+            'track': str(track_info.get('track_number') or ''),
+            'isrc': track_info.get('isrc') or '',
+        }
+        return {key: value for key, value in tags.items() if value}
+
+    def _create_safe_filename(self, track_info: Dict[str, Any]) -> str:
+        """创建安全的文件名"""
+        return create_safe_filename(track_info)
 
 class DeezerSource(MusicSource):
-    def __init__(self):
+    name = 'deezer'
+    downloadable = False
+
+    def __init__(self, http: Optional[HttpClient] = None, cover_cache: Optional[CoverCache] = None,
+                 range_downloader: Optional[RangedDownloader] = None):
+        super().__init__(cover_cache, range_downloader)
         self.base_url = "https://api.deezer.com"
         # 这里需要添加 Deezer API 凭证
         self.api_key = os.getenv('DEEZER_API_KEY')
+        self.http = http or get_http_client()
 
-    def search_track(self, track_info: Dict[str, Any]) -> Optional[str]:
-        try:
-            query = f"{track_info['name']} {track_info['artists'][0]}"
-            response = requests.get(f"{self.base_url}/search", params={
-                'q': query,
-                'output': 'json'
-            })
-            if response.status_code == 200:
-                data = response.json()
-                if data.get('data'):
-                    # 返回第一个匹配结果的下载链接
-                    return data['data'][0].get('link')
-        except Exception as e:
-            logger.error(f"Deezer搜索失败: {str(e)}")
+    def find_candidate(self, track_info: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        query = f"{track_info['name']} {track_info['artists'][0]}"
+        response = self.http.get(f"{self.base_url}/search", params={
+            'q': query,
+            'output': 'json'
+        }, limiter=self.limiter)
+        data = self._json(response)
+        # 选择得分最高的结果，得分相同时保留靠前的结果
+        best_match = None
+        highest_score = -1
+        for result in data.get('data') or []:
+            score = score_match(track_info, result.get('title', ''), [(result.get('artist') or {}).get('name', '')],
+                                result.get('duration'), result.get('isrc'))
+            if score > highest_score and result.get('link'):
+                highest_score = score
+                best_match = result
+        if best_match:
+            return {'url': best_match['link'], 'source_id': str(best_match.get('id')), 'score': highest_score}
         return None
 
-    def download_track(self, url: str, output_path: str, format: str, quality: str, track_info: Dict[str, Any], 
-                      cookies: Optional[str] = None, cookies_from_browser: Optional[str] = None) -> bool:
+    def lookup_isrc(self, track_info: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        response = self.http.get(f"{self.base_url}/track/isrc:{track_info['isrc']}", limiter=self.limiter)
+        data = self._json(response, missing_ok=True)
+        if not data or not data.get('link'):
+            return None
+        return {'url': data['link'], 'source_id': str(data.get('id')), 'score': EXACT_MATCH_SCORE, 'exact': True}
+
+    @classmethod
+    def source_url(cls, source_id: str) -> Optional[str]:
+        return f"https://www.deezer.com/track/{source_id}"
+
+    def _json(self, response, missing_ok: bool = False) -> Optional[Dict[str, Any]]:
+        """解析Deezer的响应，API错误时抛出异常；missing_ok为True时找不到数据返回None"""
+        response.raise_for_status()
+        data = response.json()
+        error = data.get('error') or {}
+        if not error:
+            return data
+        # Deezer超出配额时返回HTTP 200和错误码4，找不到数据时错误码为800
+        if error.get('code') == 4:
+            self.limiter.on_throttle()
+        elif error.get('code') == 800 and missing_ok:
+            return None
+        raise ValueError(f"Deezer API错误: {error.get('message')}")
+
+    def fetch_audio(self, url: str, output_path: str, track_info: Dict[str, Any],
+                    cookies: Optional[str] = None, cookies_from_browser: Optional[str] = None,
+                    preferred_format: Optional[str] = None) -> Optional[str]:
         # 实现 Deezer 下载逻辑
         logger.warning("Deezer下载功能尚未完全实现。")
-        return False
+        return None
 
 class SoundCloudSource(MusicSource):
-    def __init__(self):
+    name = 'soundcloud'
+    downloadable = False
+
+    def __init__(self, http: Optional[HttpClient] = None, cover_cache: Optional[CoverCache] = None,
+                 range_downloader: Optional[RangedDownloader] = None):
+        super().__init__(cover_cache, range_downloader)
         self.client_id = os.getenv('SOUNDCLOUD_CLIENT_ID')
         self.base_url = "https://api.soundcloud.com"
+        self.http = http or get_http_client()
 
-    def search_track(self, track_info: Dict[str, Any]) -> Optional[str]:
-        try:
-            query = f"{track_info['name']} {track_info['artists'][0]}"
-            response = requests.get(f"{self.base_url}/tracks", params={
-                'q': query,
-                'client_id': self.client_id
-            })
-            if response.status_code == 200:
-                data = response.json()
-                if data:
-                    # 返回第一个匹配结果的下载链接
-                    return data[0].get('download_url')
-        except Exception as e:
-            logger.error(f"SoundCloud搜索失败: {str(e)}")
+    def find_candidate(self, track_info: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        query = f"{track_info['name']} {track_info['artists'][0]}"
+        response = self.http.get(f"{self.base_url}/tracks", params={
+            'q': query,
+            'client_id': self.client_id
+        }, limiter=self.limiter)
+        response.raise_for_status()
+        # 选择得分最高的结果，SoundCloud的时长单位为毫秒
+        best_match = None
+        highest_score = -1
+        for result in response.json() or []:
+            duration_ms = result.get('duration')
+            score = score_match(track_info, result.get('title', ''), [(result.get('user') or {}).get('username', '')],
+                                duration_ms / 1000 if duration_ms else None)
+            if score > highest_score and result.get('download_url'):
+                highest_score = score
+                best_match = result
+        if best_match:
+            return {'url': best_match['download_url'], 'source_id': str(best_match.get('id')), 'score': highest_score}
         return None
 
-    def download_track(self, url: str, output_path: str, format: str, quality: str, track_info: Dict[str, Any], 
-                      cookies: Optional[str] = None, cookies_from_browser: Optional[str] = None) -> bool:
+    def fetch_audio(self, url: str, output_path: str, track_info: Dict[str, Any],
+                    cookies: Optional[str] = None, cookies_from_browser: Optional[str] = None,
+                    preferred_format: Optional[str] = None) -> Optional[str]:
         # 实现 SoundCloud 下载逻辑
         logger.warning("SoundCloud下载功能尚未完全实现。")
-        return False
+        return None
 
 class YouTubeMusicSource(MusicSource):
     """YouTube Music音乐源"""
-    def __init__(self):
-        self.ytmusic = YTMusic()
+    name = 'youtubemusic'
+    isrc_via_search = True
+    # 各输出格式优先选择的音频流，YouTube通常同时提供opus(webm)和aac(m4a)两种音频流
+    STREAM_FORMATS = {
+        'opus': 'bestaudio[acodec=opus]',
+        'm4a': 'bestaudio[ext=m4a]',
+        'aac': 'bestaudio[acodec^=mp4a]',
+        'ogg': 'bestaudio[acodec=vorbis]',
+        'vorbis': 'bestaudio[acodec=vorbis]',
+        'mp3': 'bestaudio[acodec=mp3]',
+    }
 
-    def search_track(self, track_info: Dict[str, Any]) -> Optional[str]:
+    def __init__(self, cover_cache: Optional[CoverCache] = None,
+                 range_downloader: Optional[RangedDownloader] = None):
+        super().__init__(cover_cache, range_downloader)
+        self._ytmusic = None
+        self._ytmusic_lock = threading.Lock()
+        # 每个下载线程复用自己的YoutubeDL实例，避免每首歌重复初始化提取器和加载cookies
+        self._ydl_local = threading.local()
+        self._ydl_instances: List[Tuple[threading.Thread, Any]] = []
+        self._ydl_lock = threading.Lock()
+
+    @property
+    def ytmusic(self):
+        """YTMusic客户端，首次搜索时才创建"""
+        if self._ytmusic is None:
+            with self._ytmusic_lock:
+                if self._ytmusic is None:
+                    from ytmusicapi import YTMusic
+                    self._ytmusic = YTMusic()
+        return self._ytmusic
+
+    def find_candidate(self, track_info: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         query = f"{track_info['name']} {track_info['artists'][0]}"
-        try:
-            search_results = self.ytmusic.search(query, filter="songs", limit=5)
-            
-            # 简单的匹配逻辑：选择第一个结果
-            if search_results:
-                best_match = None
-                highest_score = -1
-
-                for result in search_results:
-                    score = 0
-                    # 检查标题匹配度
-                    if track_info['name'].lower() in result['title'].lower():
-                        score += 2
-                    
-                    # 检查艺术家匹配度
-                    if result.get('artists') and any(a['name'].lower() in artist.lower() for a in result['artists'] for artist in track_info['artists']):
-                        score += 2
-
-                    # 检查时长匹配度 (允许10秒误差)
-                    if result.get('duration_seconds') and abs(result['duration_seconds'] - track_info['duration_ms'] / 1000) < 10:
-                        score += 3
-                    
-                    if score > highest_score:
-                        highest_score = score
-                        best_match = result
-
-                if best_match:
-                    logger.info(f"在YouTube Music上找到匹配: {best_match['title']} - {[a['name'] for a in best_match['artists']]}")
-                    return f"https://music.youtube.com/watch?v={best_match['videoId']}"
+        search_results = self.limiter.call(self.ytmusic.search, query, filter="songs", limit=5)
+        return self._best_result(track_info, search_results)
 
-        except Exception as e:
-            logger.error(f"YouTube Music搜索失败: {str(e)}")
-        return None
+    def lookup_isrc(self, track_info: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """用ISRC作为搜索词，YouTube Music通常直接返回对应的歌曲
 
-    def _download_album_cover(self, track_info: Dict[str, Any]) -> Optional[str]:
-        """下载专辑封面"""
-        try:
-            if track_info.get('album_cover_url'):
-                response = requests.get(track_info['album_cover_url'])
-                if response.status_code == 200:
-                    # 创建临时文件保存封面
-                    with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_file:
-                        temp_file.write(response.content)
-                        return temp_file.name
-        except Exception as e:
-            logger.warning(f"下载专辑封面失败: {str(e)}")
+        搜索结果不包含ISRC，只有标题、艺术家和时长都一致时才采用，否则退回模糊搜索。
+        """
+        search_results = self.limiter.call(self.ytmusic.search, track_info['isrc'], filter="songs", limit=5)
+        candidate = self._best_result(track_info, search_results)
+        if not candidate or candidate['score'] < FULL_MATCH_SCORE:
+            return None
+        candidate['score'] += ISRC_BONUS
+        return candidate
+
+    @classmethod
+    def source_url(cls, source_id: str) -> Optional[str]:
+        return f"https://music.youtube.com/watch?v={source_id}"
+
+    def _best_result(self, track_info: Dict[str, Any], search_results) -> Optional[Dict[str, Any]]:
+        """从搜索结果中选择得分最高的歌曲"""
+        # 简单的匹配逻辑：选择得分最高的结果
+        best_match = None
+        highest_score = -1
+
+        for result in search_results or []:
+            score = score_match(track_info, result['title'], [a['name'] for a in result.get('artists') or []],
+                                result.get('duration_seconds'))
+            if score > highest_score and result.get('videoId'):
+                highest_score = score
+                best_match = result
+
+        if best_match:
+            logger.info(f"在YouTube Music上找到匹配: {best_match['title']} - {[a['name'] for a in best_match.get('artists') or []]}")
+            return {
+                'url': self.source_url(best_match['videoId']),
+                'source_id': best_match['videoId'],
+                'score': highest_score
+            }
         return None
 
-    def _set_audio_tags(self, file_path: str, track_info: Dict[str, Any], cover_path: Optional[str] = None):
-        """设置音频文件的元数据标签"""
-        try:
-            audio_file = File(file_path)
-            if audio_file is None:
-                logger.warning(f"无法读取音频文件: {file_path}")
-                return
-
-            # 如果是MP3文件，使用ID3标签
-            if isinstance(audio_file, MP3):
-                if audio_file.tags is None:
-                    audio_file.add_tags()
-                
-                tags = audio_file.tags
-                tags.clear()  # 清除现有标签
-                
-                # 设置基本信息
-                tags.add(TIT2(encoding=3, text=track_info['name']))  # 标题
-                tags.add(TPE1(encoding=3, text=', '.join(track_info['artists'])))  # 艺术家
-                tags.add(TALB(encoding=3, text=track_info['album']))  # 专辑
-                
-                # 设置发行年份（如果有）
-                if track_info.get('release_date'):
-                    tags.add(TDRC(encoding=3, text=track_info['release_date'][:4]))
-                
-                # 设置曲目编号（如果有）
-                if track_info.get('track_number'):
-                    tags.add(TRCK(encoding=3, text=str(track_info['track_number'])))
-                
-                # 添加专辑封面
-                if cover_path and os.path.exists(cover_path):
-                    with open(cover_path, 'rb') as cover_file:
-                        tags.add(APIC(
-                            encoding=3,
-                            mime='image/jpeg',
-                            type=3,  # Cover (front)
-                            desc='Cover',
-                            data=cover_file.read()
-                        ))
-                
-                audio_file.save()
-                logger.info(f"已设置音频标签: {track_info['name']}")
-            
+    def _format_selector(self, preferred_format: Optional[str]) -> str:
+        """yt-dlp的格式选择：优先与目标格式编码一致的音频流，没有时退回最佳音质"""
+        preferred = self.STREAM_FORMATS.get(preferred_format or '')
+        return f"{preferred}/bestaudio/best" if preferred else 'bestaudio/best'
+
+    def _ydl_options(self, format_selector: str, cookies: Optional[str],
+                     cookies_from_browser: Optional[str]) -> Dict[str, Any]:
+        """创建YoutubeDL实例的参数，输出路径每首歌单独设置"""
+        ydl_opts = {
+            'format': format_selector,
+            'quiet': False,
+            'no_warnings': False,
+            # 添加反检测措施
+            'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+            'referer': 'https://music.youtube.com/',
+            'extractor_retries': 3,
+            'fragment_retries': 3,
+            # 重试间隔按指数退避，且不短于限速器当前的请求间隔
+            'retry_sleep_functions': {
+                'http': lambda n: self._retry_delay('http', n),
+                'fragment': lambda n: self._retry_delay('fragment', n),
+                'extractor': lambda n: self._retry_delay('extractor', n),
+            },
+            # HTTP headers
+            'http_headers': {
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+                'Accept-Language': 'en-us,en;q=0.5',
+                'Accept-Encoding': 'gzip,deflate',
+                'DNT': '1',
+                'Connection': 'keep-alive',
+                'Upgrade-Insecure-Requests': '1',
+            }
+        }
+
+        # 添加 cookies 支持
+        if cookies:
+            ydl_opts['cookiefile'] = cookies
+            logger.info(f"使用 cookies 文件: {cookies}")
+        elif cookies_from_browser:
+            ydl_opts['cookiesfrombrowser'] = (cookies_from_browser,)
+            logger.info(f"从浏览器导入 cookies: {cookies_from_browser}")
+        return ydl_opts
+
+    def _get_ydl(self, preferred_format: Optional[str], cookies: Optional[str],
+                 cookies_from_browser: Optional[str]):
+        """当前线程的YoutubeDL实例，按格式选择和cookies区分，首次使用时创建"""
+        key = (self._format_selector(preferred_format), cookies, cookies_from_browser)
+        instances = getattr(self._ydl_local, 'instances', None)
+        if instances is None:
+            instances = self._ydl_local.instances = {}
+        ydl = instances.get(key)
+        if ydl is None:
+            from yt_dlp import YoutubeDL
+            ydl = instances[key] = YoutubeDL(self._ydl_options(*key))
+            with self._ydl_lock:
+                self._ydl_instances.append((threading.current_thread(), ydl))
+            metrics.incr('ytdlp_instances', source=self.name)
+        return ydl
+
+    def warm_up(self):
+        # yt_dlp导入较慢，YTMusic创建时需要请求网页
+        import yt_dlp  # noqa: F401
+        return self.ytmusic
+
+    def close(self):
+        """关闭已结束线程的YoutubeDL实例：保存cookies并关闭连接
+
+        同时运行多个下载任务时（如常驻服务），其他任务的线程仍在使用的实例不受影响。
+        """
+        with self._ydl_lock:
+            finished = [ydl for thread, ydl in self._ydl_instances if not thread.is_alive()]
+            self._ydl_instances = [(thread, ydl) for thread, ydl in self._ydl_instances if thread.is_alive()]
+        for ydl in finished:
+            try:
+                # 与with语句退出时相同
+                ydl.__exit__(None, None, None)
+            except Exception as e:
+                logger.warning(f"关闭yt-dlp实例失败: {str(e)}")
+
+    def fetch_audio(self, url: str, output_path: str, track_info: Dict[str, Any],
+                    cookies: Optional[str] = None, cookies_from_browser: Optional[str] = None,
+                    preferred_format: Optional[str] = None) -> Optional[str]:
+        """使用yt-dlp下载原始音频流，不做格式转换"""
+        # 原始音频与转换后的文件使用不同的后缀，避免扩展名相同时互相覆盖
+        temp_output_template = os.path.join(output_path, f"{_temp_filename(track_info)}.source.%(ext)s")
+
+        logger.info(f"输出目录: {output_path}")
+        logger.info(f"临时文件模板: {temp_output_template}")
+
+        ydl = self._get_ydl(preferred_format, cookies, cookies_from_browser)
+        # 实例只在当前线程中使用，直接修改输出路径，无需重新创建
+        ydl.params['outtmpl']['default'] = temp_output_template
+        # 下载音频，遇到429或人机验证时限速器会降低请求速率
+        with metrics.span('download', source=self.name):
+            if self.range_downloader:
+                # 先只解析出音频流地址，能分段下载时不再由yt-dlp单连接下载
+                info = self.limiter.call(ydl.extract_info, url, download=False)
+                source_path = self._download_ranges(ydl, info)
+                if not source_path:
+                    info = self.limiter.call(ydl.process_ie_result, info, download=True)
             else:
-                # 对于其他格式，使用通用标签
-                audio_file['TITLE'] = track_info['name']
-                audio_file['ARTIST'] = ', '.join(track_info['artists'])
-                audio_file['ALBUM'] = track_info['album']
-                if track_info.get('release_date'):
-                    audio_file['DATE'] = track_info['release_date'][:4]
-                audio_file.save()
-                
-        except Exception as e:
-            logger.warning(f"设置音频标签失败: {str(e)}")
+                info = self.limiter.call(ydl.extract_info, url, download=True)
+                source_path = None
+        if not source_path:
+            # yt-dlp会返回实际写入的文件路径，无需再扫描输出目录
+            downloads = info.get('requested_downloads') or []
+            source_path = downloads[0].get('filepath') if downloads else ydl.prepare_filename(info)
 
-    def download_track(self, url: str, output_path: str, format: str, quality: str, track_info: Dict[str, Any], 
-                      cookies: Optional[str] = None, cookies_from_browser: Optional[str] = None) -> bool:
+        if not source_path or not os.path.exists(source_path):
+            logger.error("无法找到下载的音频文件")
+            return None
+        logger.info(f"音频下载完成: {source_path}")
+        metrics.incr('download_bytes', os.path.getsize(source_path), source=self.name)
+        return source_path
+
+    def _download_ranges(self, ydl, info: Dict[str, Any]) -> Optional[str]:
+        """选中的音频流是普通HTTP(S)文件时分段并发下载，返回文件路径；DASH、HLS等分片格式或下载失败时返回None"""
+        if info.get('requested_formats') or info.get('protocol') not in ('http', 'https') or not info.get('url'):
+            return None
+        source_path = ydl.prepare_filename(info)
         try:
-            # 确保输出路径是绝对路径
-            output_path = os.path.abspath(os.path.expanduser(output_path))
-            
-            # 使用Spotify信息创建文件名
-            safe_filename = self._create_safe_filename(track_info)
-            final_output_path = os.path.join(output_path, f"{safe_filename}.{format}")
-            
-            # 使用一个更简单的临时文件命名策略
-            temp_filename = f"temp_spotify_dl_{track_info['spotify_id']}"
-            temp_output_template = os.path.join(output_path, f"{temp_filename}.%(ext)s")
-            
-            logger.info(f"输出目录: {output_path}")
-            logger.info(f"临时文件模板: {temp_output_template}")
-            
-            ydl_opts = {
-                'format': 'bestaudio/best',
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': format,
-                    'preferredquality': quality,
-                }],
-                'outtmpl': temp_output_template,
-                'quiet': False,
-                'no_warnings': False,
-                'keepvideo': False,
-                # 添加反检测措施
-                'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'referer': 'https://music.youtube.com/',
-                'extractor_retries': 3,
-                'fragment_retries': 3,
-                'retry_sleep': 2,
-                # HTTP headers
-                'http_headers': {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                    'Accept-Language': 'en-us,en;q=0.5',
-                    'Accept-Encoding': 'gzip,deflate',
-                    'DNT': '1',
-                    'Connection': 'keep-alive',
-                    'Upgrade-Insecure-Requests': '1',
-                }
-            }
-            
-            # 添加 cookies 支持
-            if cookies:
-                ydl_opts['cookiefile'] = cookies
-                logger.info(f"使用 cookies 文件: {cookies}")
-            elif cookies_from_browser:
-                ydl_opts['cookiesfrombrowser'] = (cookies_from_browser,)
-                logger.info(f"从浏览器导入 cookies: {cookies_from_browser}")
-            
-            with YoutubeDL(ydl_opts) as ydl:
-                # 下载音频
-                info = ydl.extract_info(url, download=True)
-                logger.info("音频下载完成，开始处理文件...")
-                
-                # 预期的临时文件路径
-                temp_file_path = os.path.join(output_path, f"{temp_filename}.{format}")
-                logger.info(f"预期文件路径: {temp_file_path}")
-                
-                # 检查文件是否存在
-                if os.path.exists(temp_file_path):
-                    logger.info(f"找到下载的文件: {temp_file_path}")
-                    
-                    # 下载专辑封面
-                    cover_path = self._download_album_cover(track_info)
-                    if cover_path:
-                        logger.info("专辑封面下载成功")
-                    else:
-                        logger.warning("专辑封面下载失败")
-                    
-                    # 设置音频标签
-                    self._set_audio_tags(temp_file_path, track_info, cover_path)
-                    
-                    # 重命名文件为最终名称
-                    if os.path.exists(final_output_path):
-                        os.remove(final_output_path)  # 删除可能存在的同名文件
-                    
-                    os.rename(temp_file_path, final_output_path)
-                    logger.info(f"文件已重命名为: {final_output_path}")
-                    
-                    # 清理临时封面文件
-                    if cover_path and os.path.exists(cover_path):
-                        os.remove(cover_path)
-                        logger.info("临时封面文件已清理")
-                    
-                    logger.info(f"下载完成并已设置标签: {safe_filename}.{format}")
-                    return True
-                else:
-                    # 如果预期的文件不存在，尝试查找所有可能的文件
-                    logger.warning(f"预期文件不存在: {temp_file_path}")
-                    logger.info("正在查找下载的文件...")
-                    
-                    # 列出目录中的所有文件
-                    try:
-                        all_files = os.listdir(output_path)
-                        logger.info(f"目录中的所有文件: {all_files}")
-                    except Exception as e:
-                        logger.error(f"无法列出目录文件: {e}")
-                        return False
-                    
-                    found_files = []
-                    for file in all_files:
-                        file_path = os.path.join(output_path, file)
-                        logger.info(f"检查文件: {file}")
-                        if file.endswith(f'.{format}') and temp_filename in file:
-                            found_files.append(file_path)
-                            logger.info(f"匹配的文件: {file_path}")
-                    
-                    if found_files:
-                        # 使用找到的第一个文件
-                        temp_file_path = found_files[0]
-                        logger.info(f"使用找到的文件: {temp_file_path}")
-                        
-                        # 下载专辑封面
-                        cover_path = self._download_album_cover(track_info)
-                        
-                        # 设置音频标签
-                        self._set_audio_tags(temp_file_path, track_info, cover_path)
-                        
-                        # 重命名文件为最终名称
-                        if os.path.exists(final_output_path):
-                            os.remove(final_output_path)
-                        
-                        os.rename(temp_file_path, final_output_path)
-                        
-                        # 清理临时封面文件
-                        if cover_path and os.path.exists(cover_path):
-                            os.remove(cover_path)
-                        
-                        logger.info(f"下载完成并已设置标签: {safe_filename}.{format}")
-                        return True
-                    else:
-                        logger.error("无法找到下载的音频文件")
-                        return False
-            
+            self.range_downloader.download(info['url'], source_path, info.get('filesize'), info.get('http_headers'))
         except Exception as e:
-            logger.error(f"使用yt-dlp从YouTube Music下载失败: {str(e)}")
-            import traceback
-            logger.error(f"详细错误信息: {traceback.format_exc()}")
-            return False
+            logger.warning(f"分段下载失败，改用yt-dlp下载: {str(e)}")
+            metrics.incr('range_fallbacks', source=self.name)
+            return None
+        return source_path
+
+    def _retry_delay(self, kind: str, attempt: int) -> float:
+        """yt-dlp重试前调用，记录重试次数并返回等待时间"""
+        metrics.incr('ytdlp_retries', kind=kind)
+        return self.limiter.retry_delay(attempt)
+
+# 音乐源名称与实现，自动模式下按此顺序尝试
+SOURCE_CLASSES = {
+    DeezerSource.name: DeezerSource,
+    YouTubeMusicSource.name: YouTubeMusicSource,
+    SoundCloudSource.name: SoundCloudSource,
+    # 可以添加更多音乐源
+}
+
+def import_isrc_file(isrc_index: IsrcIndex, path: str) -> int:
+    """批量导入ISRC对应关系，返回导入的条数
+
+    每行包含 isrc、source 以及 url 或 source_id，只有 source_id 时由音乐源生成链接。
+    """
+    rows = []
+    for line_number, row in enumerate(read_isrc_rows(path), 1):
+        isrc = (row.get('isrc') or '').strip()
+        source = (row.get('source') or '').strip().lower()
+        source_id = (row.get('source_id') or '').strip() or None
+        if source not in SOURCE_CLASSES:
+            raise ValueError(f"第{line_number}条: 不支持的音乐源 '{source}'")
+        url = (row.get('url') or '').strip() or (SOURCE_CLASSES[source].source_url(source_id) if source_id else None)
+        if not isrc or not url:
+            raise ValueError(f"第{line_number}条: 缺少 isrc 或 url/source_id")
+        rows.append({'isrc': isrc, 'source': source, 'url': url, 'source_id': source_id, 'origin': 'import'})
+    return isrc_index.store_many(rows)
 
-    def _create_safe_filename(self, track_info: Dict[str, Any]) -> str:
-        """创建安全的文件名"""
-        title = track_info['name']
-        artist = track_info['artists'][0] if track_info['artists'] else 'Unknown Artist'
-        filename = f"{artist} - {title}"
-        
-        # 移除不安全的字符
-        unsafe_chars = ['<', '>', ':', '"', '/', '\\', '|', '?', '*']
-        for char in unsafe_chars:
-            filename = filename.replace(char, '_')
-        
-        return filename
 
 class SpotifyDownloader:
-    def __init__(self, client_id: str, client_secret: str):
-        """初始化下载器"""
-        self.sp = spotipy.Spotify(
-            client_credentials_manager=SpotifyClientCredentials(
-                client_id=client_id,
-                client_secret=client_secret
-            )
-        )
-        # 初始化音乐源列表
-        self.sources: List[MusicSource] = [
-            DeezerSource(),
-            YouTubeMusicSource(),
-            SoundCloudSource(),
-            # 可以添加更多音乐源
-        ]
-    
+    def __init__(self, client_id: str, client_secret: str, metadata_cache: Optional[MetadataCache] = None,
+                 match_cache: Optional[MatchCache] = None, cover_cache: Optional[CoverCache] = None,
+                 source_timeout: float = DEFAULT_SOURCE_TIMEOUT, transcode_workers: Optional[int] = None,
+                 passthrough: bool = False, isrc_index: Optional[IsrcIndex] = None,
+                 library: Optional[LibraryIndex] = None, link_mode: str = 'auto',
+                 range_downloader: Optional[RangedDownloader] = None):
+        """初始化下载器
+
+        passthrough为True时优先下载与输出格式编码一致的音频流，并在编码一致时跳过重新编码。
+        Spotify客户端和各音乐源都在首次使用时才创建。
+        isrc_index不为None时优先通过ISRC精确查找，找不到时才模糊搜索。
+        library不为None时，其他目录中已下载过的歌曲按link_mode链接到输出目录，不再重新下载。
+        range_downloader不为None时，音频流拆成多个字节范围并发下载。
+        """
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._sp = None
+        self._metadata: Optional[SpotifyMetadataFetcher] = None
+        # metadata_cache为None时不使用缓存
+        self.metadata_cache = metadata_cache
+        self.cover_cache = cover_cache or CoverCache()
+        self._sources: Dict[str, MusicSource] = {}
+        self._lock = threading.Lock()
+        # 音乐源匹配结果缓存
+        self.match_cache = match_cache
+        self.isrc_index = isrc_index
+        # 自动模式下并发搜索各音乐源，每个音乐源使用单独的线程池，慢的音乐源不会占满其他音乐源的线程
+        self.source_timeout = source_timeout
+        self._search_executors: Dict[str, ThreadPoolExecutor] = {}
+        # 各音乐源正在执行的搜索：线程ID -> 开始时间
+        self._running_searches: Dict[str, Dict[int, float]] = {}
+        # 转码占用CPU，与下载线程分开，并发数默认为CPU核数
+        self.transcode_pool = TranscodePool(transcode_workers)
+        self.passthrough = passthrough
+        # 跨歌单的曲库索引
+        self.library = library if link_mode != 'none' else None
+        self.link_mode = link_mode
+        self.range_downloader = range_downloader
+
+    @property
+    def sp(self):
+        """Spotify API客户端，首次使用时才导入spotipy并创建"""
+        if self._sp is None:
+            with self._lock:
+                if self._sp is None:
+                    from .spotify_client import create_spotify_client
+                    self._sp = create_spotify_client(self._client_id, self._client_secret)
+        return self._sp
+
+    @property
+    def metadata(self) -> SpotifyMetadataFetcher:
+        """批量获取歌曲信息"""
+        if self._metadata is None:
+            self._metadata = SpotifyMetadataFetcher(self.sp, self.metadata_cache)
+        return self._metadata
+
+    def warm_up(self, source: str = 'auto'):
+        """提前获取Spotify访问令牌并创建音乐源的客户端，常驻服务启动时调用"""
+        auth_manager = getattr(self.sp, 'auth_manager', None)
+        if auth_manager is not None:
+            auth_manager.get_access_token(as_dict=False)
+        for music_source in self._select_sources(source):
+            music_source.warm_up()
+
+    def _get_source(self, name: str) -> MusicSource:
+        """获取音乐源实例，只有被选中的音乐源才会创建"""
+        music_source = self._sources.get(name)
+        if music_source is None:
+            with self._lock:
+                music_source = self._sources.get(name)
+                if music_source is None:
+                    music_source = self._sources[name] = SOURCE_CLASSES[name](
+                        cover_cache=self.cover_cache, range_downloader=self.range_downloader)
+        return music_source
+
+    def _parse_spotify_url(self, url: str) -> Optional[Tuple[str, str]]:
+        """从Spotify URL中解析链接类型和ID"""
+        match = SPOTIFY_URL_PATTERN.search(url)
+        return (match.group(1), match.group(2)) if match else None
+
     def _extract_track_id(self, url: str) -> Optional[str]:
         """从Spotify URL中提取track ID"""
-        pattern = r'track/([a-zA-Z0-9]+)'
-        match = re.search(pattern, url)
-        return match.group(1) if match else None
-    
+        parsed = self._parse_spotify_url(url)
+        return parsed[1] if parsed and parsed[0] == 'track' else None
+
     def _get_track_info(self, track_id: str) -> Dict[str, Any]:
         """获取歌曲信息"""
         try:
-            track = self.sp.track(track_id)
-            
-            # 获取专辑封面URL（选择最高质量的）
-            album_cover_url = None
-            if track['album']['images']:
-                album_cover_url = track['album']['images'][0]['url']  # 第一个通常是最高质量的
-            
-            return {
-                'name': track['name'],
-                'artists': [artist['name'] for artist in track['artists']],
-                'album': track['album']['name'],
-                'duration_ms': track['duration_ms'],
-                'popularity': track['popularity'],
-                'isrc': track['external_ids'].get('isrc', ''),
-                'spotify_id': track_id,
-                'release_date': track['album']['release_date'],
-                'track_number': track['track_number'],
-                'album_cover_url': album_cover_url
-            }
+            return self.metadata.get_track(track_id)
         except Exception as e:
             logger.error(f"获取歌曲信息失败: {str(e)}")
             raise
 
-    def _find_best_match(self, track_info: Dict[str, Any], search_results: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
-        """找到最佳匹配的音乐"""
-        if not search_results:
+    def _select_sources(self, source: str) -> List[MusicSource]:
+        """根据指定的音乐源选择下载源"""
+        if source == 'auto':
+            # 自动模式：按优先级尝试所有源
+            names = list(SOURCE_CLASSES)
+        elif source in SOURCE_CLASSES:
+            names = [source]
+        else:
+            raise ValueError(f"不支持的音乐源: {source}")
+        return [self._get_source(name) for name in names]
+
+    def _resolve(self, music_source: MusicSource, track_info: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """在音乐源上查找匹配：ISRC索引 → 匹配缓存 → 音乐源的ISRC查询 → 模糊搜索
+
+        isrc_via_search的音乐源先模糊搜索，没有完全匹配时才按ISRC查询。
+        """
+        isrc = track_info.get('isrc')
+        if isrc and self.isrc_index:
+            exact = self.isrc_index.lookup(music_source.name, isrc)
+            if exact:
+                logger.info(f"ISRC索引命中: {music_source.__class__.__name__} {exact['source_id']}")
+                metrics.incr('isrc_index_hits', source=music_source.name)
+                exact.update(score=EXACT_MATCH_SCORE, exact=True, cached=True)
+                return exact
+
+        if self.match_cache:
+            cached = self.match_cache.lookup(music_source.name, track_info)
+            if cached:
+                if not cached['url']:
+                    logger.info(f"{music_source.__class__.__name__} 已知没有这首歌，跳过搜索")
+                    return None
+                logger.info(f"使用缓存的匹配结果: {music_source.__class__.__name__} {cached['source_id']}")
+                metrics.incr('match_cache_hits', source=music_source.name)
+                cached['cached'] = True
+                return cached
+
+        candidate = self._lookup_isrc(music_source, track_info) if isrc and not music_source.isrc_via_search else None
+        if not candidate:
+            with metrics.span('search', source=music_source.name):
+                candidate = music_source.find_candidate(track_info)
+            if isrc and music_source.isrc_via_search and (not candidate or candidate['score'] < FULL_MATCH_SCORE):
+                candidate = self._lookup_isrc(music_source, track_info) or candidate
+        if self.match_cache:
+            self.match_cache.store(music_source.name, track_info, candidate)
+        return candidate
+
+    def _lookup_isrc(self, music_source: MusicSource, track_info: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """通过音乐源的接口按ISRC查找，失败时返回None以便退回模糊搜索"""
+        try:
+            with metrics.span('isrc_lookup', source=music_source.name):
+                candidate = music_source.lookup_isrc(track_info)
+        except Exception as e:
+            logger.warning(f"{music_source.__class__.__name__} ISRC查询失败: {str(e)}")
             return None
+        if candidate and candidate.get('exact') and self.isrc_index:
+            self.isrc_index.store(music_source.name, track_info['isrc'], candidate['url'],
+                                  candidate.get('source_id'), 'api')
+        return candidate
 
-        best_match = None
-        highest_score = 0
-
-        for result in search_results:
-            score = 0
-            # 检查标题匹配度
-            if track_info['name'].lower() in result['title'].lower():
-                score += 3
-            # 检查艺术家匹配度
-            if any(artist.lower() in result['artist'].lower() for artist in track_info['artists']):
-                score += 2
-            # 检查时长匹配度（允许30秒误差）
-            if abs(result.get('duration', 0) - track_info['duration_ms']/1000) < 30:
-                score += 2
-            # 检查ISRC匹配（如果可用）
-            if result.get('isrc') == track_info['isrc']:
-                score += 5
-
-            if score > highest_score:
-                highest_score = score
-                best_match = result
+    def _remember_match(self, music_source: MusicSource, candidate: Dict[str, Any], track_info: Dict[str, Any]):
+        """下载成功后，把可信的匹配结果加入ISRC索引，下次无需再搜索"""
+        isrc = track_info.get('isrc')
+        # 带有origin的结果本身就来自ISRC索引
+        if not isrc or not self.isrc_index or candidate.get('origin'):
+            return
+        if candidate.get('exact') or (candidate.get('score') or 0) >= FULL_MATCH_SCORE:
+            self.isrc_index.store(music_source.name, isrc, candidate['url'], candidate.get('source_id'), 'match')
+
+    def _forget_match(self, music_source: MusicSource, candidate: Dict[str, Any], track_info: Dict[str, Any]):
+        """缓存的链接无法下载时删除，下次重新查找"""
+        if not candidate.get('cached'):
+            return
+        if self.match_cache:
+            self.match_cache.invalidate(music_source.name, track_info)
+        if self.isrc_index and track_info.get('isrc'):
+            self.isrc_index.invalidate(music_source.name, track_info['isrc'])
+
+    def _submit_search(self, music_source: MusicSource, track_info: Dict[str, Any],
+                       started: Dict[str, float]) -> Optional[Future]:
+        """在音乐源自己的线程池中搜索，线程全部被超过期限的搜索占用时返回None"""
+        name = music_source.name
+        now = time.monotonic()
+        with self._lock:
+            running = self._running_searches.setdefault(name, {})
+            overdue = sum(1 for start in running.values() if now - start > self.source_timeout)
+            if overdue >= SOURCE_SEARCH_CONCURRENCY:
+                return None
+            executor = self._search_executors.get(name)
+            if executor is None:
+                executor = self._search_executors[name] = ThreadPoolExecutor(
+                    max_workers=SOURCE_SEARCH_CONCURRENCY, thread_name_prefix=f"search-{name}")
+
+        def search() -> Optional[Dict[str, Any]]:
+            thread_id = threading.get_ident()
+            with self._lock:
+                running[thread_id] = started[name] = time.monotonic()
+            try:
+                return self._resolve(music_source, track_info)
+            finally:
+                with self._lock:
+                    del running[thread_id]
+
+        return executor.submit(search)
+
+    def _resolve_hedged(self, sources: List[MusicSource], track_info: Dict[str, Any]) -> List[Tuple[MusicSource, Dict[str, Any]]]:
+        """并发查询所有音乐源，返回按优先级排序的匹配结果
+
+        可下载的音乐源排在前面，其次按得分、音乐源顺序排序。某个可下载的音乐源完全匹配时立即返回，
+        开始执行后超过期限仍未返回的音乐源会被忽略，不会拖慢已经找到匹配的歌曲；
+        排队超过期限仍未开始的搜索会被取消，线程全部被未返回的搜索占用的音乐源本首歌曲不再查询。
+        """
+        # 每个搜索开始执行的时间，期限从开始执行时计算，在线程池中排队的时间另计
+        started: Dict[str, float] = {}
+        submitted = time.monotonic()
+        futures: Dict[Future, MusicSource] = {}
+        for music_source in sources:
+            future = self._submit_search(music_source, track_info, started)
+            if future is None:
+                logger.info(f"{music_source.__class__.__name__} 的搜索线程都被未返回的搜索占用，本首歌曲不再查询")
+            else:
+                futures[future] = music_source
+        found: List[Tuple[MusicSource, Dict[str, Any]]] = []
+        errors: List[str] = []
+        pending = set(futures)
+        while pending:
+            now = time.monotonic()
+            deadlines = {future: started.get(futures[future].name, submitted) + self.source_timeout
+                         for future in pending}
+            waiting = {future for future in pending if deadlines[future] > now}
+            if not waiting:
+                break
+            timeout = min(deadlines[future] for future in waiting) - now
+            done, _ = wait(waiting, timeout=timeout, return_when=FIRST_COMPLETED)
+            pending -= done
+            for future in done:
+                music_source = futures[future]
+                try:
+                    candidate = future.result()
+                except Exception as e:
+                    errors.append(f"从 {music_source.__class__.__name__} 搜索失败: {str(e)}")
+                    logger.warning(errors[-1])
+                    continue
+                if candidate:
+                    found.append((music_source, candidate))
+            if any(music_source.downloadable and (candidate.get('score') or 0) >= FULL_MATCH_SCORE
+                   for music_source, candidate in found):
+                break
+
+        for future in pending:
+            # 仍在排队的搜索直接取消
+            future.cancel()
+            logger.info(f"{futures[future].__class__.__name__} 搜索未在期限内完成，已忽略")
+
+        found.sort(key=lambda item: (not item[0].downloadable, -(item[1].get('score') or 0),
+                                     sources.index(item[0])))
+        if not found:
+            detail = errors[-1] if errors else '未找到匹配的音乐'
+            raise ValueError(f"所有音乐源都无法下载该歌曲。最后错误: {detail}")
+        return found
 
-        return best_match if highest_score >= 5 else None
+    def _find_candidates(self, track_info: Dict[str, Any], source: str) -> List[Tuple[MusicSource, Dict[str, Any]]]:
+        """查找可用于下载的匹配结果，按尝试顺序排列"""
+        sources_to_try = self._select_sources(source)
+        if source == 'auto':
+            return self._resolve_hedged(sources_to_try, track_info)
 
-    def download(self, url: str, output_path: str, format: str = 'mp3', quality: str = '320k', 
-                source: str = 'auto', cookies: Optional[str] = None, cookies_from_browser: Optional[str] = None) -> bool:
-        """下载歌曲"""
+        music_source = sources_to_try[0]
+        candidate = self._resolve(music_source, track_info)
+        if not candidate:
+            raise ValueError(f"无法从指定的音乐源 '{source}' 下载该歌曲。错误: "
+                             f"{music_source.__class__.__name__} 未找到匹配的音乐")
+        return [(music_source, candidate)]
+
+    def _finish_track(self, music_source: MusicSource, candidate: Dict[str, Any], source_path: str,
+                      output_path: str, format: str, quality: str, track_info: Dict[str, Any],
+                      manifest: DownloadManifest, cover: Optional[bytes] = None,
+                      cover_path: Optional[str] = None) -> TrackResult:
+        """转码（同时写入标签和封面）、重命名并记录到清单，在转码池中执行"""
+        track_id = track_info['spotify_id']
+        temp_file_path = None
         try:
-            # 提取track ID
-            track_id = self._extract_track_id(url)
-            if not track_id:
-                raise ValueError("无效的Spotify URL")
-            
-            # 获取歌曲信息
-            track_info = self._get_track_info(track_id)
-            logger.info(f"正在下载: {track_info['name']} - {', '.join(track_info['artists'])}")
-            
-            # 根据指定的音乐源选择下载源
-            sources_to_try = []
-            
-            if source == 'auto':
-                # 自动模式：按优先级尝试所有源
-                sources_to_try = self.sources
-            elif source == 'deezer':
-                sources_to_try = [s for s in self.sources if isinstance(s, DeezerSource)]
-            elif source == 'youtubemusic':
-                sources_to_try = [s for s in self.sources if isinstance(s, YouTubeMusicSource)]
-            elif source == 'soundcloud':
-                sources_to_try = [s for s in self.sources if isinstance(s, SoundCloudSource)]
+            temp_file_path = music_source.transcode(source_path, output_path, format, quality, track_info,
+                                                    self.passthrough, cover, cover_path)
+            final_output_path = music_source.finalize(temp_file_path, output_path, format, track_info)
+            entry = manifest.record(track_info, music_source.name, candidate.get('source_id'),
+                                    format, quality, final_output_path)
+            self._add_to_library(manifest, entry)
+            self._remember_match(music_source, candidate, track_info)
+            logger.info(f"下载完成: {track_info['name']}")
+            return TrackResult(track_id, True, track_info['name'])
+        except Exception as e:
+            logger.error(f"下载失败 ({track_info['name']}): {str(e)}")
+            # 重命名前失败时删除转换后的临时文件
+            _discard(temp_file_path)
+            return TrackResult(track_id, False, track_info['name'], str(e))
+
+    def _place_from_library(self, track_info: Dict[str, Any], output_path: str, format: str, quality: str,
+                            manifest: DownloadManifest, existing: Optional[Dict[str, Any]] = None) -> Optional[str]:
+        """曲库中已有同一首歌时链接到输出目录并记录到清单，返回文件路径；没有或无法链接时返回None
+
+        existing可直接给出已下载的文件（格式同LibraryIndex.find的返回值），例如其他节点下载的文件。
+        """
+        if existing is None and self.library:
+            existing = self.library.find(track_info, format, quality)
+        if not existing:
+            return None
+        target_path = os.path.join(output_path, f"{create_safe_filename(track_info)}.{format}")
+        try:
+            if os.path.exists(target_path) and os.path.samefile(existing['path'], target_path):
+                mode = 'existing'
             else:
-                raise ValueError(f"不支持的音乐源: {source}")
-            
-            if not sources_to_try:
-                raise ValueError(f"指定的音乐源 '{source}' 不可用")
-            
+                mode = place_file(existing['path'], target_path, self.link_mode)
+        except OSError as e:
+            logger.warning(f"无法从曲库链接 {existing['path']}，将重新下载: {str(e)}")
+            return None
+        # 文件内容相同，沿用曲库中的checksum
+        manifest.record(track_info, existing['source'], existing['source_id'], format, quality,
+                        target_path, existing['sha256'])
+        metrics.incr('library_links', mode=mode)
+        logger.info(f"曲库中已有，{mode}: {existing['path']} -> {target_path}")
+        return target_path
+
+    def _add_to_library(self, manifest: DownloadManifest, entry: Dict[str, Any]):
+        """把新下载的文件登记到曲库，其他歌单可以直接链接"""
+        if self.library:
+            self.library.add(entry, manifest.output_path)
+
+    def _download_track(self, track_info: Dict[str, Any], output_path: str, format: str, quality: str,
+                        source: str, cookies: Optional[str], cookies_from_browser: Optional[str],
+                        manifest: DownloadManifest, sync: bool = False, verify: bool = False,
+                        staging_path: Optional[str] = None) -> Union[TrackResult, 'Future[TrackResult]']:
+        """下载单首歌曲的原始音频
+
+        下载成功后在下载线程中获取专辑封面，再把转码交给转码池，返回其Future，下载线程可以立即处理下一首；
+        跳过或失败时直接返回下载结果。
+        """
+        track_id = track_info['spotify_id']
+        track_name = track_info['name']
+        output_path = os.path.abspath(os.path.expanduser(output_path))
+        staging_path = staging_path or output_path
+        try:
+            if sync and manifest.is_up_to_date(track_info, format, quality, verify):
+                logger.info(f"已是最新，跳过: {track_name}")
+                return TrackResult(track_id, True, track_name, skipped=True)
+            if self._place_from_library(track_info, output_path, format, quality, manifest):
+                return TrackResult(track_id, True, track_name, linked=True)
+
+            logger.info(f"正在下载: {track_info['name']} - {', '.join(track_info['artists'])}")
+
             # 记录最后的错误信息
             last_error = None
-            
-            # 尝试从指定的音乐源下载
-            for music_source in sources_to_try:
+
+            # 按顺序尝试找到的匹配结果
+            for music_source, candidate in self._find_candidates(track_info, source):
+                logger.info(f"尝试使用音乐源: {music_source.__class__.__name__} (得分: {candidate.get('score')})")
                 try:
-                    logger.info(f"尝试使用音乐源: {music_source.__class__.__name__}")
-                    download_url = music_source.search_track(track_info)
-                    if download_url:
-                        logger.info(f"找到音乐源: {music_source.__class__.__name__}")
-                        if music_source.download_track(download_url, output_path, format, quality, track_info, cookies, cookies_from_browser):
-                            logger.info(f"下载完成: {track_info['name']}")
-                            return True
-                        else:
-                            last_error = f"{music_source.__class__.__name__} 下载失败"
-                    else:
-                        last_error = f"{music_source.__class__.__name__} 未找到匹配的音乐"
-                        
+                    source_path = music_source.fetch_audio(candidate['url'], staging_path, track_info,
+                                                           cookies, cookies_from_browser,
+                                                           format if self.passthrough else None)
                 except Exception as e:
-                    last_error = f"从 {music_source.__class__.__name__} 下载失败: {str(e)}"
-                    logger.warning(last_error)
-                    
-                    # 如果不是自动模式，直接抛出错误
                     if source != 'auto':
                         raise
-                    
-                    continue
-            
+                    logger.warning(f"从 {music_source.__class__.__name__} 下载失败: {str(e)}")
+                    source_path = None
+
+                if source_path:
+                    # 封面在下载线程中获取，转码池只做转码
+                    cover, cover_path = music_source.fetch_cover(track_info)
+                    return self.transcode_pool.submit(self._finish_track, music_source, candidate, source_path,
+                                                      output_path, format, quality, track_info, manifest,
+                                                      cover, cover_path)
+
+                last_error = f"{music_source.__class__.__name__} 下载失败"
+                logger.warning(last_error)
+                # 缓存的链接可能已失效，下次重新搜索
+                self._forget_match(music_source, candidate, track_info)
+
             # 所有源都失败了
             if source == 'auto':
                 raise ValueError(f"所有音乐源都无法下载该歌曲。最后错误: {last_error}")
             else:
                 raise ValueError(f"无法从指定的音乐源 '{source}' 下载该歌曲。错误: {last_error}")
-            
+
+        except Exception as e:
+            logger.error(f"下载失败 ({track_name}): {str(e)}")
+            return TrackResult(track_id, False, track_name, str(e))
+
+    def download_collection(self, url: str, output_path: str, format: str = 'mp3', quality: str = '320k',
+                            source: str = 'auto', cookies: Optional[str] = None,
+                            cookies_from_browser: Optional[str] = None, workers: int = 1,
+                            sync: bool = False, verify: bool = False, pipeline: bool = False,
+                            stage_workers: Optional[Dict[str, int]] = None,
+                            staging_path: Optional[str] = None, stream: bool = False,
+                            on_track: Optional[Callable[[Dict[str, Any]], None]] = None,
+                            on_result: Optional[Callable[[TrackResult], None]] = None) -> List[TrackResult]:
+        """下载单曲、歌单、专辑或艺术家热门歌曲，返回每首歌曲的下载结果
+
+        sync为True时只下载清单中缺失或有变化的歌曲，verify为True时还会校验已有文件的checksum。
+        pipeline为True时使用分阶段流水线，stage_workers可单独设置各阶段的并发数。
+        原始音频先下载到staging_path（默认为输出目录下的 .spotifydl-staging），转码后写入输出目录。
+        stream为True时使用流式模式：歌曲信息保存为TrackRecord，边翻页边提交且同时处理的歌曲数有上限，
+        内存占用与歌单长度无关。
+        on_track在每首歌曲开始处理时调用，on_result在每首歌曲结束时调用，用于报告进度。
+        """
+        parsed = self._parse_spotify_url(url)
+        if not parsed:
+            raise ValueError("无效的Spotify URL")
+        # 提前校验音乐源，避免每首歌重复报同样的错误
+        self._select_sources(source)
+
+        kind, spotify_id = parsed
+        logger.info(f"开始处理{kind}: {spotify_id}，并发数: {workers}")
+        manifest = DownloadManifest(output_path)
+        staging_path = os.path.abspath(os.path.expanduser(
+            staging_path or os.path.join(manifest.output_path, STAGING_DIR_NAME)))
+        os.makedirs(staging_path, exist_ok=True)
+        # 输出目录中已有的歌曲也登记到曲库，不覆盖其他目录中的条目
+        if self.library and manifest.entries:
+            self.library.add_many(manifest.entries.values(), manifest.output_path, replace=False)
+
+        results: List[TrackResult] = []
+        tracks = _unique_tracks(self.metadata.iter_collection(kind, spotify_id, compact=stream))
+        if on_track:
+            tracks = _observe(tracks, on_track)
+        try:
+            if pipeline:
+                import asyncio
+                from .pipeline import DownloadPipeline
+                runner = DownloadPipeline(self, output_path, format, quality, source, cookies, cookies_from_browser,
+                                          manifest, sync, verify, workers, stage_workers, staging_path=staging_path,
+                                          on_result=on_result)
+                results = asyncio.run(runner.run(tracks))
+            elif stream:
+                with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                    download_args = (output_path, format, quality, source, cookies, cookies_from_browser,
+                                     manifest, sync, verify, staging_path)
+                    # 下载线程和转码池各保留一批待处理的歌曲，避免空闲
+                    limit = 2 * (max(1, workers) + self.transcode_pool.max_workers)
+                    results = self._download_bounded(executor, tracks, download_args, limit, on_result)
+            else:
+                with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                    # 边翻页边提交，前面的歌曲在后续页面获取期间就开始下载
+                    futures = [
+                        executor.submit(self._download_track, track_info, output_path, format, quality,
+                                        source, cookies, cookies_from_browser, manifest, sync, verify, staging_path)
+                        for track_info in tracks
+                    ]
+                    # 下载完成的歌曲还需要等待转码池处理
+                    pending = []
+                    for future in as_completed(futures):
+                        result = future.result()
+                        if isinstance(result, Future):
+                            pending.append(result)
+                            continue
+                        results.append(result)
+                        if on_result:
+                            on_result(result)
+                        logger.info(f"进度: {len(results)}/{len(futures)}")
+                    for future in as_completed(pending):
+                        results.append(future.result())
+                        if on_result:
+                            on_result(results[-1])
+                        logger.info(f"进度: {len(results)}/{len(futures)}")
+        finally:
+            # 各下载线程已结束，关闭其复用的下载器实例
+            for music_source in list(self._sources.values()):
+                music_source.close()
+
+        # 暂存目录为空时删除
+        try:
+            os.rmdir(staging_path)
+        except OSError:
+            pass
+        if not results:
+            raise ValueError(f"链接中没有可下载的歌曲: {url}")
+
+        if manifest.entries:
+            manifest.compact()
+        succeeded = sum(1 for r in results if r.success)
+        skipped = sum(1 for r in results if r.skipped)
+        linked = sum(1 for r in results if r.linked)
+        metrics.incr('tracks', succeeded - skipped - linked, status='downloaded')
+        metrics.incr('tracks', skipped, status='skipped')
+        metrics.incr('tracks', linked, status='linked')
+        metrics.incr('tracks', len(results) - succeeded, status='failed')
+        logger.info(f"下载结束: 成功 {succeeded} 首 (其中跳过 {skipped} 首，从曲库链接 {linked} 首)，"
+                    f"失败 {len(results) - succeeded} 首")
+        return results
+
+    def _download_bounded(self, executor: ThreadPoolExecutor, tracks: Iterable[Dict[str, Any]],
+                          download_args: Tuple, limit: int,
+                          on_result: Optional[Callable[[TrackResult], None]]) -> List[TrackResult]:
+        """边读取歌曲边提交，同时处理（包括等待转码）的歌曲不超过limit首，满额时等待有歌曲完成再读取下一首"""
+        results: List[TrackResult] = []
+        in_flight: Set[Future] = set()
+
+        def collect(done: Iterable[Future]):
+            for future in done:
+                in_flight.discard(future)
+                result = future.result()
+                if isinstance(result, Future):
+                    # 下载完成，继续等待转码
+                    in_flight.add(result)
+                    continue
+                results.append(result)
+                if on_result:
+                    on_result(result)
+                logger.info(f"进度: 已完成 {len(results)} 首")
+
+        for track_info in tracks:
+            while len(in_flight) >= limit:
+                collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+            in_flight.add(executor.submit(self._download_track, track_info, *download_args))
+        while in_flight:
+            collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+        return results
+
+    def download(self, url: str, output_path: str, format: str = 'mp3', quality: str = '320k',
+                source: str = 'auto', cookies: Optional[str] = None, cookies_from_browser: Optional[str] = None,
+                workers: int = 1, sync: bool = False) -> bool:
+        """下载歌曲，全部成功时返回True"""
+        try:
+            results = self.download_collection(url, output_path, format, quality, source,
+                                               cookies, cookies_from_browser, workers, sync)
+            return all(r.success for r in results)
         except Exception as e:
             logger.error(f"下载失败: {str(e)}")
-            return False 
\ No newline at end of file
+            return False
@@ -0,0 +1,117 @@
+"""
+共享的HTTP客户端
+"""
+import logging
+import random
+import threading
+import time
+from typing import TYPE_CHECKING, Optional
+
+from .metrics import metrics
+from .ratelimit import AdaptiveRateLimiter
+
+if TYPE_CHECKING:
+    import requests
+
+logger = logging.getLogger(__name__)
+
+# (连接超时, 读取超时)，单位秒
+DEFAULT_TIMEOUT = (5, 30)
+# 每个主机最多保持的连接数
+DEFAULT_POOL_MAXSIZE = 16
+# 遇到这些状态码时退避重试
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+# 这些状态码表示被限流，需要降低请求速率
+THROTTLE_STATUS_CODES = frozenset({429, 503})
+
+
+class HttpClient:
+    """线程安全的HTTP客户端：连接池复用、超时、带抖动的指数退避重试
+
+    所有线程共用一个Session，同一主机的连接通过keep-alive复用，
+    连接池满时请求会等待空闲连接，从而限制每个主机的并发连接数。
+    """
+
+    def __init__(self, pool_maxsize: int = DEFAULT_POOL_MAXSIZE, pool_connections: int = 16,
+                 timeout=DEFAULT_TIMEOUT, max_retries: int = 3,
+                 backoff_base: float = 0.5, backoff_max: float = 30.0):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # requests在创建客户端时才导入，加快命令行启动
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.session = requests.Session()
+        # pool_connections为缓存的主机连接池数量，pool_maxsize为每个主机的连接上限
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                              pool_block=True, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @staticmethod
+    def _retry_after(response: 'requests.Response') -> Optional[float]:
+        """读取响应头中的Retry-After（秒）"""
+        retry_after = response.headers.get('Retry-After', '')
+        return float(retry_after) if retry_after.isdigit() else None
+
+    def _backoff(self, attempt: int, response: Optional['requests.Response'] = None) -> float:
+        """计算重试等待时间，优先使用服务端的Retry-After"""
+        retry_after = self._retry_after(response) if response is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        # full jitter：在 [0, base * 2^attempt] 内随机等待，避免多个线程同时重试
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def request(self, method: str, url: str, limiter: Optional[AdaptiveRateLimiter] = None,
+                **kwargs) -> 'requests.Response':
+        """发送请求，遇到连接错误、超时、429和5xx时重试，重试用尽后返回最后一次响应或抛出异常
+
+        指定limiter时每次请求前先取得令牌，并把限流响应反馈给限速器。
+        """
+        import requests
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            if limiter:
+                limiter.acquire()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                metrics.incr('http_retries', reason=type(e).__name__)
+                logger.warning(f"请求失败，{delay:.1f}秒后重试 ({attempt + 1}/{self.max_retries}): {url} {str(e)}")
+            else:
+                if limiter:
+                    if response.status_code in THROTTLE_STATUS_CODES:
+                        limiter.on_throttle(self._retry_after(response))
+                    else:
+                        limiter.on_success()
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    return response
+                delay = self._backoff(attempt, response)
+                metrics.incr('http_retries', reason=response.status_code)
+                response.close()
+                logger.warning(f"HTTP {response.status_code}，{delay:.1f}秒后重试 "
+                               f"({attempt + 1}/{self.max_retries}): {url}")
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, url: str, limiter: Optional[AdaptiveRateLimiter] = None, **kwargs) -> 'requests.Response':
+        return self.request('GET', url, limiter, **kwargs)
+
+
+_default_client: Optional[HttpClient] = None
+_default_client_lock = threading.Lock()
+
+
+def get_http_client() -> HttpClient:
+    """获取进程内共享的HTTP客户端"""
+    global _default_client
+    if _default_client is None:
+        with _default_client_lock:
+            if _default_client is None:
+                _default_client = HttpClient()
+    return _default_client
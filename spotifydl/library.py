@@ -0,0 +1,147 @@
+"""
+跨歌单的曲库索引：同一首歌只下载一次，其他输出目录通过链接放置
+"""
+import errno
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from .cache import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+# 命令行 --link-mode 的可选值，none表示不使用曲库
+LINK_MODES = ('auto', 'reflink', 'hardlink', 'symlink', 'copy', 'none')
+# auto模式依次尝试：写时复制的独立文件 → 硬链接 → 符号链接（可以跨文件系统）
+AUTO_LINK_ORDER = ('reflink', 'hardlink', 'symlink')
+# Linux的FICLONE ioctl，btrfs、xfs等文件系统支持
+FICLONE = 0x40049409
+
+
+class LibraryIndex(SQLiteStore):
+    """Spotify ID和ISRC到已下载文件的索引，所有输出目录共用
+
+    按格式和质量分别记录。查询时只检查文件大小是否一致，不扫描目录；
+    文件已被删除或改动时删除对应条目。
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS library (
+            key TEXT NOT NULL,
+            format TEXT NOT NULL,
+            quality TEXT NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            sha256 TEXT,
+            source TEXT,
+            source_id TEXT,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (key, format, quality)
+        );
+        CREATE INDEX IF NOT EXISTS library_path ON library (path);
+    '''
+
+    @staticmethod
+    def _keys(spotify_id: Optional[str], isrc: Optional[str]) -> List[str]:
+        """同一录音在不同歌单中可能有不同的Spotify ID，但ISRC相同"""
+        keys = [f"spotify:{spotify_id}"] if spotify_id else []
+        if isrc:
+            keys.append(f"isrc:{isrc.upper()}")
+        return keys
+
+    def find(self, track_info: Dict[str, Any], format: str, quality: str) -> Optional[Dict[str, Any]]:
+        """查找已下载的同一首歌，返回 {'path', 'size', 'sha256', 'source', 'source_id'}"""
+        for key in self._keys(track_info['spotify_id'], track_info.get('isrc')):
+            with self._lock:
+                row = self._conn.execute(
+                    'SELECT path, size, sha256, source, source_id FROM library '
+                    'WHERE key = ? AND format = ? AND quality = ?',
+                    (key, format, quality)
+                ).fetchone()
+            if not row:
+                continue
+            entry = dict(zip(('path', 'size', 'sha256', 'source', 'source_id'), row))
+            try:
+                if os.path.getsize(entry['path']) == entry['size']:
+                    return entry
+            except OSError:
+                pass
+            logger.info(f"曲库中的文件已不存在或已改动: {entry['path']}")
+            self.remove_path(entry['path'])
+        return None
+
+    def add_many(self, entries: Iterable[Dict[str, Any]], base_path: str, replace: bool = True) -> int:
+        """登记下载清单中的记录，路径相对于base_path；replace为False时不覆盖已有条目"""
+        now = time.time()
+        values = []
+        for entry in entries:
+            path = os.path.join(base_path, entry['path'])
+            for key in self._keys(entry.get('spotify_id'), entry.get('isrc')):
+                values.append((key, entry['format'], entry['quality'], path, entry['size'], entry.get('sha256'),
+                               entry.get('source'), entry.get('source_id'), now))
+        verb = 'INSERT OR REPLACE' if replace else 'INSERT OR IGNORE'
+        with self._lock:
+            self._conn.executemany(
+                f'{verb} INTO library (key, format, quality, path, size, sha256, source, source_id, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                values
+            )
+            self._conn.commit()
+        return len(values)
+
+    def add(self, entry: Dict[str, Any], base_path: str):
+        """登记一首刚下载完成的歌曲"""
+        self.add_many([entry], base_path)
+
+    def remove_path(self, path: str):
+        """删除指向该文件的所有条目"""
+        with self._lock:
+            self._conn.execute('DELETE FROM library WHERE path = ?', (path,))
+            self._conn.commit()
+
+
+def _reflink(source_path: str, target_path: str):
+    if not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, "当前系统不支持reflink")
+    import fcntl
+    with open(source_path, 'rb') as source, open(target_path, 'xb') as target:
+        fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+
+
+def _symlink(source_path: str, target_path: str):
+    # 使用相对路径，整个曲库移动后链接仍然有效
+    os.symlink(os.path.relpath(source_path, os.path.dirname(target_path)), target_path)
+
+
+_LINKERS: Dict[str, Callable[[str, str], None]] = {
+    'reflink': _reflink,
+    'hardlink': os.link,
+    'symlink': _symlink,
+    'copy': shutil.copyfile,
+}
+
+
+def place_file(source_path: str, target_path: str, mode: str = 'auto') -> str:
+    """把曲库中已有的文件放到target_path，返回实际使用的方式，全部失败时抛出OSError
+
+    先在同一目录下创建临时链接，再原子地替换可能存在的同名文件。
+    """
+    modes = AUTO_LINK_ORDER if mode == 'auto' else (mode,)
+    temp_path = f"{target_path}.{os.getpid()}.{threading.get_ident()}.link"
+    last_error: Optional[OSError] = None
+    for name in modes:
+        try:
+            _LINKERS[name](source_path, temp_path)
+        except OSError as e:
+            last_error = e
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            continue
+        os.replace(temp_path, target_path)
+        return name
+    raise last_error or OSError(errno.EINVAL, f"不支持的链接方式: {mode}")
@@ -0,0 +1,170 @@
+"""
+输出目录中的下载清单
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = '.spotifydl-manifest.jsonl'
+# 分布式节点各自的清单，例如 .spotifydl-manifest.host1_1234.jsonl
+NODE_MANIFEST_PATTERN = '.spotifydl-manifest.*.jsonl'
+# 合并期间节点清单改名为该后缀，合并中断时下次继续合并
+MERGING_SUFFIX = '.merging'
+# 这些字段变化时认为歌曲信息有更新，需要重新下载
+_FINGERPRINT_FIELDS = ('name', 'artists', 'album')
+
+
+def node_manifest_name(node: str) -> str:
+    """节点清单的文件名，节点名中文件名不允许的字符替换为下划线"""
+    return f".spotifydl-manifest.{re.sub(r'[^A-Za-z0-9_.-]', '_', node)}.jsonl"
+
+
+def file_checksum(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """计算文件的SHA-256校验和"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DownloadManifest:
+    """记录输出目录中每首歌曲的下载结果
+
+    清单为追加写入的JSON Lines文件，每下载完成一首就追加一行，
+    任务中断后重新运行可以从中断处继续。同一首歌以最新的记录为准。
+
+    多台主机同时追加共享文件系统上的同一个文件并不安全，因此分布式节点指定node，
+    只追加写入自己的节点清单；读取时合并主清单和所有节点清单，merge_nodes把节点清单并入主清单。
+    """
+
+    def __init__(self, output_path: str, node: Optional[str] = None):
+        self.output_path = os.path.abspath(os.path.expanduser(output_path))
+        self.path = os.path.join(self.output_path, MANIFEST_NAME)
+        # 新记录追加写入的文件
+        self.write_path = os.path.join(self.output_path, node_manifest_name(node)) if node else self.path
+        self._lock = threading.Lock()
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self._load()
+
+    def _node_paths(self) -> List[str]:
+        """各节点的清单，包括上次合并中断时留下的文件"""
+        pattern = os.path.join(glob.escape(self.output_path), NODE_MANIFEST_PATTERN)
+        return sorted(glob.glob(pattern) + glob.glob(pattern + MERGING_SUFFIX))
+
+    def _load(self):
+        """读取主清单和各节点的清单"""
+        for path in [self.path] + self._node_paths():
+            self._read(path)
+        if self.entries:
+            logger.info(f"已读取下载清单: {len(self.entries)} 首歌曲")
+
+    def _read(self, path: str):
+        """读取一个清单文件，同一首歌保留下载时间最新的记录"""
+        try:
+            f = open(path, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 中断时可能留下写了一半的行
+                    logger.warning(f"忽略清单中损坏的记录: {line[:80]}")
+                    continue
+                current = self.entries.get(entry['spotify_id'])
+                if current is None or entry.get('downloaded_at', 0) >= current.get('downloaded_at', 0):
+                    self.entries[entry['spotify_id']] = entry
+
+    def get(self, spotify_id: str) -> Optional[Dict[str, Any]]:
+        """获取歌曲的下载记录"""
+        return self.entries.get(spotify_id)
+
+    def is_up_to_date(self, track_info: Dict[str, Any], format: str, quality: str, verify: bool = False) -> bool:
+        """判断歌曲是否已按相同格式和质量下载，且文件未被改动"""
+        entry = self.get(track_info['spotify_id'])
+        if not entry or entry['format'] != format or entry['quality'] != quality:
+            return False
+        if any(entry.get(field) != track_info.get(field) for field in _FINGERPRINT_FIELDS):
+            return False
+
+        file_path = os.path.join(self.output_path, entry['path'])
+        try:
+            if os.path.getsize(file_path) != entry['size']:
+                return False
+        except OSError:
+            return False
+        return not verify or file_checksum(file_path) == entry['sha256']
+
+    def record(self, track_info: Dict[str, Any], source: str, source_id: Optional[str],
+               format: str, quality: str, file_path: str, sha256: Optional[str] = None) -> Dict[str, Any]:
+        """追加一条下载记录并返回该记录，已知文件的checksum时通过sha256传入，无需重新计算"""
+        entry = {
+            'spotify_id': track_info['spotify_id'],
+            'isrc': track_info.get('isrc', ''),
+            'name': track_info['name'],
+            'artists': track_info['artists'],
+            'album': track_info['album'],
+            'source': source,
+            'source_id': source_id,
+            'format': format,
+            'quality': quality,
+            'path': os.path.relpath(file_path, self.output_path),
+            'size': os.path.getsize(file_path),
+            'sha256': sha256 or file_checksum(file_path),
+            'downloaded_at': time.time(),
+        }
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self._lock:
+            with open(self.write_path, 'a', encoding='utf-8') as f:
+                f.write(line)
+            self.entries[entry['spotify_id']] = entry
+        return entry
+
+    def compact(self):
+        """重写主清单，只保留每首歌曲的最新记录；节点清单保持不变，由merge_nodes合并"""
+        with self._lock:
+            self._write_main()
+
+    def _write_main(self):
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        os.replace(temp_path, self.path)
+
+    def merge_nodes(self) -> int:
+        """把各节点的清单并入主清单后删除，返回合并的文件数；应在一处执行，不要在各节点上同时执行
+
+        先重新读取主清单，节点清单改名后再读取：合并期间节点写入的新记录会进入新的节点清单，不会丢失。
+        """
+        with self._lock:
+            self.entries = {}
+            self._read(self.path)
+            merging = []
+            for path in self._node_paths():
+                if not path.endswith(MERGING_SUFFIX):
+                    try:
+                        os.replace(path, path + MERGING_SUFFIX)
+                    except FileNotFoundError:
+                        continue
+                    path += MERGING_SUFFIX
+                self._read(path)
+                merging.append(path)
+            if merging:
+                self._write_main()
+                for path in merging:
+                    os.remove(path)
+            return len(merging)
@@ -0,0 +1,33 @@
+"""
+搜索结果与Spotify歌曲的匹配打分
+"""
+from typing import Any, Dict, Iterable, Optional
+
+# 标题、艺术家、时长全部匹配时的得分
+FULL_MATCH_SCORE = 7
+# ISRC一致时额外加分
+ISRC_BONUS = 5
+# 通过ISRC精确对应的结果的得分
+EXACT_MATCH_SCORE = FULL_MATCH_SCORE + ISRC_BONUS
+
+
+def score_match(track_info: Dict[str, Any], title: str, artists: Iterable[str],
+                duration_seconds: Optional[float] = None, isrc: Optional[str] = None) -> int:
+    """计算搜索结果与歌曲的匹配得分，各音乐源使用相同的标准以便互相比较"""
+    score = 0
+    # 检查标题匹配度
+    if track_info['name'].lower() in (title or '').lower():
+        score += 2
+
+    # 检查艺术家匹配度
+    if any(a.lower() in artist.lower() for a in artists if a for artist in track_info['artists']):
+        score += 2
+
+    # 检查时长匹配度 (允许10秒误差)
+    if duration_seconds and abs(duration_seconds - track_info['duration_ms'] / 1000) < 10:
+        score += 3
+
+    # 检查ISRC匹配（如果可用）
+    if isrc and track_info.get('isrc') and isrc.upper() == track_info['isrc'].upper():
+        score += ISRC_BONUS
+    return score
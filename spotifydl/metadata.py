@@ -0,0 +1,192 @@
+"""
+Spotify元数据批量获取
+"""
+import logging
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Union
+
+from .cache import MetadataCache
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# sp.tracks() 单次请求最多接受50个ID
+MAX_TRACKS_PER_REQUEST = 50
+# track_info包含的字段，与normalize_track的返回值一致
+TRACK_FIELDS = ('name', 'artists', 'album', 'duration_ms', 'popularity', 'isrc', 'spotify_id', 'release_date',
+                'track_number', 'album_cover_url')
+
+
+def normalize_track(track: Dict[str, Any], track_id: Optional[str] = None) -> Dict[str, Any]:
+    """将Spotify返回的歌曲对象转换为下载器使用的track_info字典"""
+    album = track.get('album') or {}
+
+    # 获取专辑封面URL（选择最高质量的）
+    album_cover_url = None
+    if album.get('images'):
+        album_cover_url = album['images'][0]['url']  # 第一个通常是最高质量的
+
+    return {
+        'name': track['name'],
+        'artists': [artist['name'] for artist in track['artists']],
+        'album': album.get('name', ''),
+        'duration_ms': track['duration_ms'],
+        'popularity': track.get('popularity', 0),
+        'isrc': (track.get('external_ids') or {}).get('isrc', ''),
+        # 歌曲被重新关联(relink)时，保留调用方请求的ID
+        'spotify_id': track_id or track['id'],
+        'release_date': album.get('release_date', ''),
+        'track_number': track.get('track_number'),
+        'album_cover_url': album_cover_url
+    }
+
+
+class TrackRecord:
+    """紧凑的歌曲信息，流式模式下代替track_info字典
+
+    使用__slots__，没有每个实例的字典。支持 record['name'] 和 record.get('isrc')，
+    可以直接传给接受track_info的函数。
+    """
+    __slots__ = TRACK_FIELDS
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_dict(cls, track_info: Dict[str, Any]) -> 'TrackRecord':
+        return cls(**track_info)
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.__slots__
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def to_dict(self) -> Dict[str, Any]:
+        track_info = {name: getattr(self, name) for name in self.__slots__}
+        track_info['artists'] = list(self.artists or [])
+        return track_info
+
+    def __repr__(self) -> str:
+        return f"TrackRecord({self.spotify_id!r}, {self.name!r})"
+
+
+TrackInfo = Union[Dict[str, Any], TrackRecord]
+
+
+def _chunked(items: Iterable[str], size: int) -> Iterator[List[str]]:
+    """按固定大小切分ID序列"""
+    chunk: List[str] = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _is_track(track: Optional[Dict[str, Any]]) -> bool:
+    """跳过本地文件、播客等无法下载的条目"""
+    return bool(track and track.get('id') and track.get('type', 'track') == 'track')
+
+
+class SpotifyMetadataFetcher:
+    """批量获取Spotify歌曲信息，按需翻页，优先使用本地缓存"""
+
+    def __init__(self, sp, cache: Optional[MetadataCache] = None):
+        self.sp = sp
+        self.cache = cache
+
+    def get_track(self, track_id: str) -> Dict[str, Any]:
+        """获取单首歌曲信息"""
+        cached = self.cache.get(track_id) if self.cache else None
+        if cached:
+            return cached
+        with metrics.span('metadata', request='track'):
+            track = self.sp.track(track_id)
+        track_info = normalize_track(track, track_id)
+        if self.cache:
+            self.cache.put(track_info)
+        return track_info
+
+    def _iter_pages(self, page: Optional[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """逐页遍历分页结果，只有用到下一页时才发起请求"""
+        while page:
+            yield from page['items']
+            page = self._next_page(page)
+
+    def _next_page(self, page: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """请求下一页，没有下一页时返回None"""
+        if not page.get('next'):
+            return None
+        with metrics.span('metadata', request='next'):
+            return self.sp.next(page)
+
+    def iter_tracks(self, track_ids: Iterable[str]) -> Iterator[Dict[str, Any]]:
+        """按每批50个ID获取歌曲信息，已缓存的歌曲不再请求"""
+        for batch in _chunked(track_ids, MAX_TRACKS_PER_REQUEST):
+            found = self.cache.get_many(batch) if self.cache else {}
+            missing = [track_id for track_id in batch if track_id not in found]
+            if missing:
+                fetched = []
+                with metrics.span('metadata', request='tracks'):
+                    tracks = self.sp.tracks(missing)['tracks']
+                for track_id, track in zip(missing, tracks):
+                    if track is None:
+                        logger.warning(f"无效的歌曲ID，已跳过: {track_id}")
+                        continue
+                    fetched.append(normalize_track(track, track_id))
+                if self.cache:
+                    self.cache.put_many(fetched)
+                found.update((info['spotify_id'], info) for info in fetched)
+            for track_id in batch:
+                if track_id in found:
+                    yield found[track_id]
+
+    def iter_playlist_tracks(self, playlist_id: str) -> Iterator[Dict[str, Any]]:
+        """遍历歌单中的歌曲，歌单条目已包含完整的歌曲信息"""
+        with metrics.span('metadata', request='playlist_items'):
+            page = self.sp.playlist_items(playlist_id, additional_types=('track',))
+        while page:
+            track_infos = [normalize_track(item['track']) for item in page['items'] if _is_track(item.get('track'))]
+            # 顺便写入缓存，之后单独下载这些歌曲时无需再请求
+            if self.cache:
+                self.cache.put_many(track_infos)
+            yield from track_infos
+            page = self._next_page(page)
+
+    def iter_album_tracks(self, album_id: str) -> Iterator[Dict[str, Any]]:
+        """遍历专辑中的歌曲，专辑条目缺少ISRC等信息，需要再批量获取"""
+        with metrics.span('metadata', request='album_tracks'):
+            page = self.sp.album_tracks(album_id)
+        track_ids = (item['id'] for item in self._iter_pages(page) if _is_track(item))
+        yield from self.iter_tracks(track_ids)
+
+    def iter_artist_top_tracks(self, artist_id: str) -> Iterator[Dict[str, Any]]:
+        """遍历艺术家的热门歌曲"""
+        with metrics.span('metadata', request='artist_top_tracks'):
+            tracks = self.sp.artist_top_tracks(artist_id)['tracks']
+        track_infos = [normalize_track(track) for track in tracks if _is_track(track)]
+        if self.cache:
+            self.cache.put_many(track_infos)
+        yield from track_infos
+
+    def iter_collection(self, kind: str, spotify_id: str, compact: bool = False) -> Iterator[TrackInfo]:
+        """根据链接类型遍历歌曲信息，compact为True时返回TrackRecord，每页的字典用完即释放"""
+        if kind == 'track':
+            tracks = iter([self.get_track(spotify_id)])
+        elif kind == 'playlist':
+            tracks = self.iter_playlist_tracks(spotify_id)
+        elif kind == 'album':
+            tracks = self.iter_album_tracks(spotify_id)
+        elif kind == 'artist':
+            tracks = self.iter_artist_top_tracks(spotify_id)
+        else:
+            raise ValueError(f"不支持的链接类型: {kind}")
+        return map(TrackRecord.from_dict, tracks) if compact else tracks
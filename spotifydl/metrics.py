@@ -0,0 +1,211 @@
+"""
+各阶段耗时和计数统计，可输出为JSON或Prometheus文本格式
+"""
+import json
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Prometheus直方图的分桶上限（秒）
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# 每个序列保留的耗时样本数，用于计算分位数
+MAX_SAMPLES = 2048
+PROMETHEUS_PREFIX = 'spotifydl'
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+
+def _quantile(samples: List[float], q: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+class SpanStats:
+    """单个耗时序列的统计"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+        self.errors = 0
+        self.buckets = [0] * len(BUCKETS)
+        self.samples: List[float] = []
+
+    def observe(self, seconds: float, error: bool = False):
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+        if error:
+            self.errors += 1
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        # 蓄水池抽样，样本数有上限
+        if len(self.samples) < MAX_SAMPLES:
+            self.samples.append(seconds)
+        else:
+            index = random.randrange(self.count)
+            if index < MAX_SAMPLES:
+                self.samples[index] = seconds
+
+
+class Metrics:
+    """线程安全的耗时和计数统计
+
+    span记录一段代码的耗时，按名称和标签（如音乐源）分别统计；incr累加计数，如下载字节数、重试次数。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spans: Dict[Tuple[str, Labels], SpanStats] = {}
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self.started = time.time()
+
+    def reset(self):
+        with self._lock:
+            self._spans.clear()
+            self._counters.clear()
+            self.started = time.time()
+
+    def observe(self, name: str, seconds: float, error: bool = False, **labels):
+        """记录一次耗时"""
+        key = (name, _labels(labels))
+        with self._lock:
+            stats = self._spans.get(key)
+            if stats is None:
+                stats = self._spans[key] = SpanStats()
+            stats.observe(seconds, error)
+
+    @contextmanager
+    def span(self, name: str, **labels) -> Iterator[None]:
+        """记录with块的耗时，抛出异常时计为失败"""
+        started = time.monotonic()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.observe(name, time.monotonic() - started, error, **labels)
+
+    def incr(self, name: str, value: float = 1, **labels):
+        """累加计数"""
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def snapshot(self) -> Dict[str, object]:
+        """当前统计的快照，可直接序列化为JSON"""
+        with self._lock:
+            spans = [
+                {
+                    'name': name,
+                    'labels': dict(labels),
+                    'count': stats.count,
+                    'errors': stats.errors,
+                    'total_seconds': round(stats.total, 6),
+                    'mean_seconds': round(stats.total / stats.count, 6) if stats.count else None,
+                    'min_seconds': stats.min,
+                    'max_seconds': stats.max,
+                    'p50_seconds': _quantile(stats.samples, 0.5),
+                    'p95_seconds': _quantile(stats.samples, 0.95),
+                }
+                for (name, labels), stats in sorted(self._spans.items())
+            ]
+            counters = [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+        return {
+            'started_at': self.started,
+            'elapsed_seconds': round(time.time() - self.started, 3),
+            'spans': spans,
+            'counters': counters,
+        }
+
+    def write_json(self, path: str):
+        """把统计写入JSON文件"""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+        logger.info(f"统计数据已写入: {path}")
+
+    def prometheus_text(self) -> str:
+        """Prometheus文本格式：耗时为 spotifydl_span_seconds 直方图，计数为 spotifydl_<name>_total"""
+        def fmt(labels: Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+            pairs = labels + extra
+            if not pairs:
+                return ''
+            escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                       for _, value in pairs)
+            return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+        lines = []
+        with self._lock:
+            family = f"{PROMETHEUS_PREFIX}_span_seconds"
+            lines.append(f"# HELP {family} 各阶段耗时")
+            lines.append(f"# TYPE {family} histogram")
+            for (name, labels), stats in sorted(self._spans.items()):
+                series = (('span', name),) + labels
+                cumulative = 0
+                for bound, count in zip(BUCKETS, stats.buckets):
+                    cumulative += count
+                    lines.append(f"{family}_bucket{fmt(series, (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{family}_bucket{fmt(series, (('le', '+Inf'),))} {stats.count}")
+                lines.append(f"{family}_sum{fmt(series)} {stats.total}")
+                lines.append(f"{family}_count{fmt(series)} {stats.count}")
+
+            families: Dict[str, List[str]] = {}
+            for (name, labels), value in sorted(self._counters.items()):
+                families.setdefault(name, []).append(f"{PROMETHEUS_PREFIX}_{name}_total{fmt(labels)} {value}")
+            for name, series in families.items():
+                lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name}_total counter")
+                lines.extend(series)
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int, host: str = '127.0.0.1') -> 'ThreadingHTTPServer':
+        """在后台线程中提供 /metrics 接口"""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        logger.info(f"统计接口: http://{host}:{server.server_address[1]}/metrics")
+        return server
+
+
+# 进程内共享的统计
+metrics = Metrics()
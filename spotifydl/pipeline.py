@@ -0,0 +1,296 @@
+"""
+异步分阶段下载流水线：元数据 → 搜索 → 下载（同时获取专辑封面） → 转码（同时写入标签和封面） → 重命名并记录清单
+"""
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from .manifest import DownloadManifest
+
+if TYPE_CHECKING:
+    from .downloader import MusicSource, SpotifyDownloader, TrackResult
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('search', 'download', 'transcode', 'finalize')
+# 阶段之间队列的容量
+DEFAULT_QUEUE_SIZE = 16
+# 定期输出各阶段队列状态的间隔（秒）
+REPORT_INTERVAL = 10
+
+# 通知下游阶段没有更多任务
+_DONE = object()
+
+
+def default_stage_workers(workers: int) -> Dict[str, int]:
+    """根据 --workers 计算网络阶段的默认并发数，转码阶段的并发数由转码池决定"""
+    return {
+        'search': workers,
+        'download': workers,
+        'finalize': 2,
+    }
+
+
+@dataclass
+class StageStats:
+    """单个阶段的运行统计"""
+    name: str
+    workers: int
+    processed: int = 0
+    failed: int = 0
+    # 处理任务的累计耗时
+    busy_seconds: float = 0.0
+    # 等待上游输入的累计时间，过高说明上游是瓶颈
+    idle_seconds: float = 0.0
+    # 因下游队列已满而等待的累计时间，过高说明下游是瓶颈（背压）
+    blocked_seconds: float = 0.0
+    # 输入队列的最大深度
+    max_queue_depth: int = 0
+
+
+@dataclass
+class TrackJob:
+    """在各阶段之间传递的单首歌曲任务"""
+    track_info: Dict[str, Any]
+    # 尚未尝试的匹配结果，按优先级排列
+    candidates: List[Tuple['MusicSource', Dict[str, Any]]] = field(default_factory=list)
+    source: Optional['MusicSource'] = None
+    candidate: Optional[Dict[str, Any]] = None
+    source_path: Optional[str] = None
+    # 下载阶段获取的专辑封面，流式模式下只有文件路径
+    cover: Optional[bytes] = None
+    cover_path: Optional[str] = None
+    temp_file_path: Optional[str] = None
+    last_error: Optional[str] = None
+
+
+class DownloadPipeline:
+    """分阶段并发下载
+
+    各阶段之间用有界队列连接，每个阶段有独立的并发数和线程池。
+    前面的歌曲在下载、转码时，后面的歌曲已经在搜索；
+    队列满时上游阶段会等待，因此无论输入多长，内存占用都是有界的。
+    """
+
+    def __init__(self, downloader: 'SpotifyDownloader', output_path: str, format: str, quality: str,
+                 source: str, cookies: Optional[str], cookies_from_browser: Optional[str],
+                 manifest: DownloadManifest, sync: bool = False, verify: bool = False, workers: int = 4,
+                 stage_workers: Optional[Dict[str, int]] = None, queue_size: int = DEFAULT_QUEUE_SIZE,
+                 staging_path: Optional[str] = None,
+                 on_result: Optional[Callable[['TrackResult'], None]] = None):
+        self.downloader = downloader
+        self.output_path = os.path.abspath(os.path.expanduser(output_path))
+        # 原始音频的暂存目录
+        self.staging_path = staging_path or self.output_path
+        self.format = format
+        self.quality = quality
+        self.source = source
+        self.auto = source == 'auto'
+        self.cookies = cookies
+        self.cookies_from_browser = cookies_from_browser
+        self.manifest = manifest
+        self.sync = sync
+        self.verify = verify
+        # stage_workers 覆盖部分阶段的默认并发数
+        stage_workers = {**default_stage_workers(workers),
+                         'transcode': downloader.transcode_pool.max_workers,
+                         **(stage_workers or {})}
+        self.queue_size = queue_size
+        self.stats: Dict[str, StageStats] = {
+            name: StageStats(name, stage_workers.get(name, 1)) for name in ('metadata',) + STAGES
+        }
+        self.results: List['TrackResult'] = []
+        self.on_result = on_result
+
+    def _result(self, job: TrackJob, success: bool, error: Optional[str] = None,
+                skipped: bool = False, linked: bool = False) -> 'TrackResult':
+        from .downloader import TrackResult
+        info = job.track_info
+        return TrackResult(info['spotify_id'], success, info['name'], error, skipped, linked)
+
+    def _add_result(self, result: 'TrackResult'):
+        self.results.append(result)
+        if self.on_result:
+            self.on_result(result)
+
+    def _discard(self, job: TrackJob):
+        """任务失败时删除已下载的原始音频和转换后的临时文件"""
+        from .downloader import _discard
+        _discard(job.source_path)
+        _discard(job.temp_file_path)
+
+    def _next_candidate(self, job: TrackJob) -> bool:
+        """取出下一个待尝试的匹配结果，没有剩余时返回False"""
+        if not job.candidates:
+            return False
+        job.source, job.candidate = job.candidates.pop(0)
+        logger.info(f"尝试使用音乐源: {job.source.__class__.__name__} ({job.track_info['name']})")
+        return True
+
+    # 以下各阶段函数在线程池中执行，返回TrackJob交给下一阶段，返回TrackResult表示任务结束
+
+    def _search(self, job: TrackJob):
+        if self.sync and self.manifest.is_up_to_date(job.track_info, self.format, self.quality, self.verify):
+            logger.info(f"已是最新，跳过: {job.track_info['name']}")
+            return self._result(job, True, skipped=True)
+        if self.downloader._place_from_library(job.track_info, self.output_path, self.format, self.quality,
+                                               self.manifest):
+            return self._result(job, True, linked=True)
+        # 自动模式下并发查询所有音乐源
+        job.candidates = self.downloader._find_candidates(job.track_info, self.source)
+        self._next_candidate(job)
+        return job
+
+    def _download(self, job: TrackJob):
+        while True:
+            try:
+                job.source_path = job.source.fetch_audio(job.candidate['url'], self.staging_path, job.track_info,
+                                                         self.cookies, self.cookies_from_browser,
+                                                         self.format if self.downloader.passthrough else None)
+            except Exception as e:
+                if not self.auto:
+                    raise
+                logger.warning(f"从 {job.source.__class__.__name__} 下载失败: {str(e)}")
+            if job.source_path:
+                job.cover, job.cover_path = job.source.fetch_cover(job.track_info)
+                return job
+
+            job.last_error = f"{job.source.__class__.__name__} 下载失败"
+            logger.warning(job.last_error)
+            # 缓存的链接可能已失效，下次重新搜索
+            self.downloader._forget_match(job.source, job.candidate, job.track_info)
+            # 继续尝试剩余的匹配结果
+            if not self._next_candidate(job):
+                raise ValueError(job.last_error)
+
+    def _transcode(self, job: TrackJob):
+        job.temp_file_path = job.source.transcode(job.source_path, self.output_path, self.format,
+                                                  self.quality, job.track_info, self.downloader.passthrough,
+                                                  job.cover, job.cover_path)
+        # 封面已写入，不再随任务保留
+        job.cover = None
+        return job
+
+    def _finalize(self, job: TrackJob):
+        final_output_path = job.source.finalize(job.temp_file_path, self.output_path, self.format, job.track_info)
+        entry = self.manifest.record(job.track_info, job.source.name, job.candidate.get('source_id'),
+                                     self.format, self.quality, final_output_path)
+        self.downloader._add_to_library(self.manifest, entry)
+        self.downloader._remember_match(job.source, job.candidate, job.track_info)
+        return self._result(job, True)
+
+    async def _put(self, queue: asyncio.Queue, item, stats: StageStats, next_stats: Optional[StageStats]):
+        """放入下游队列，并记录因队列已满而等待的时间"""
+        if queue.full():
+            started = time.monotonic()
+            await queue.put(item)
+            stats.blocked_seconds += time.monotonic() - started
+        else:
+            queue.put_nowait(item)
+        if next_stats:
+            next_stats.max_queue_depth = max(next_stats.max_queue_depth, queue.qsize())
+
+    async def _produce(self, tracks: Iterable[Dict[str, Any]], queue: asyncio.Queue, executor: ThreadPoolExecutor):
+        """元数据阶段：逐个读取歌曲信息，翻页请求在线程池中执行"""
+        loop = asyncio.get_running_loop()
+        stats = self.stats['metadata']
+        iterator = iter(tracks)
+        while True:
+            started = time.monotonic()
+            track_info = await loop.run_in_executor(executor, next, iterator, _DONE)
+            stats.busy_seconds += time.monotonic() - started
+            if track_info is _DONE:
+                return
+            stats.processed += 1
+            await self._put(queue, TrackJob(track_info), stats, self.stats['search'])
+
+    async def _worker(self, name: str, fn: Callable, queue_in: asyncio.Queue,
+                      queue_out: Optional[asyncio.Queue], executor: ThreadPoolExecutor):
+        """阶段工作协程：从输入队列取任务，在线程池中处理后放入输出队列"""
+        loop = asyncio.get_running_loop()
+        stats = self.stats[name]
+        next_stats = self.stats[STAGES[STAGES.index(name) + 1]] if queue_out is not None else None
+        while True:
+            started = time.monotonic()
+            job = await queue_in.get()
+            stats.idle_seconds += time.monotonic() - started
+            if job is _DONE:
+                return
+
+            started = time.monotonic()
+            try:
+                output = await loop.run_in_executor(executor, fn, job)
+            except Exception as e:
+                stats.failed += 1
+                logger.error(f"下载失败 ({job.track_info['name']}): [{name}] {str(e)}")
+                self._discard(job)
+                self._add_result(self._result(job, False, str(e)))
+                continue
+            finally:
+                stats.busy_seconds += time.monotonic() - started
+
+            stats.processed += 1
+            if isinstance(output, TrackJob):
+                await self._put(queue_out, output, stats, next_stats)
+            else:
+                self._add_result(output)
+                logger.info(f"进度: 已完成 {len(self.results)} 首")
+
+    async def _report(self, queues: Dict[str, asyncio.Queue]):
+        """定期输出各阶段的队列深度"""
+        while True:
+            await asyncio.sleep(REPORT_INTERVAL)
+            depths = ', '.join(f"{name}={queues[name].qsize()}/{self.queue_size}" for name in STAGES)
+            logger.info(f"流水线队列: {depths}，已完成 {len(self.results)} 首")
+
+    def log_stats(self):
+        """输出各阶段统计，blocked较高的阶段下游是瓶颈"""
+        for stats in self.stats.values():
+            logger.info(
+                f"阶段 {stats.name}: 并发 {stats.workers}，处理 {stats.processed}，失败 {stats.failed}，"
+                f"忙碌 {stats.busy_seconds:.1f}s，等待输入 {stats.idle_seconds:.1f}s，"
+                f"下游阻塞 {stats.blocked_seconds:.1f}s，最大队列 {stats.max_queue_depth}"
+            )
+
+    async def run(self, tracks: Iterable[Dict[str, Any]]) -> List['TrackResult']:
+        """运行流水线，返回每首歌曲的下载结果"""
+        queues = {name: asyncio.Queue(maxsize=self.queue_size) for name in STAGES}
+        functions = {'search': self._search, 'download': self._download,
+                     'transcode': self._transcode, 'finalize': self._finalize}
+        executors = {name: ThreadPoolExecutor(max_workers=self.stats[name].workers, thread_name_prefix=name)
+                     for name in ('metadata', 'search', 'download', 'finalize')}
+        # 转码阶段使用下载器共享的转码池，总并发受转码池限制
+        executors['transcode'] = self.downloader.transcode_pool.executor
+
+        async def run_stage(index: int, name: str):
+            queue_out = queues[STAGES[index + 1]] if index + 1 < len(STAGES) else None
+            await asyncio.gather(*(
+                self._worker(name, functions[name], queues[name], queue_out, executors[name])
+                for _ in range(self.stats[name].workers)
+            ))
+            # 本阶段全部结束后通知下游阶段
+            if queue_out is not None:
+                for _ in range(self.stats[STAGES[index + 1]].workers):
+                    await queue_out.put(_DONE)
+
+        async def produce():
+            try:
+                await self._produce(tracks, queues['search'], executors['metadata'])
+            finally:
+                for _ in range(self.stats['search'].workers):
+                    await queues['search'].put(_DONE)
+
+        reporter = asyncio.ensure_future(self._report(queues))
+        try:
+            await asyncio.gather(produce(), *(run_stage(i, name) for i, name in enumerate(STAGES)))
+        finally:
+            reporter.cancel()
+            for name, executor in executors.items():
+                if name != 'transcode':
+                    executor.shutdown(wait=False)
+            self.log_stats()
+        return self.results
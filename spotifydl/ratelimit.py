@@ -0,0 +1,203 @@
+"""
+按音乐源划分的自适应限速器
+"""
+import logging
+import os
+import random
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional, TypeVar
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# 通过环境变量配置各音乐源的请求速率，例如 "youtubemusic=2,deezer=8"
+RATE_LIMIT_ENV = 'SPOTIFYDL_RATE_LIMITS'
+# 各音乐源默认的最大请求速率（每秒请求数），0表示不限速
+DEFAULT_RATES = {
+    'spotify': 10.0,
+    'youtubemusic': 2.0,
+    'deezer': 8.0,
+    'soundcloud': 4.0,
+    'covers': 20.0,
+}
+# 未列出的音乐源使用的速率
+DEFAULT_RATE = 5.0
+# 限流时速率最低降到这个值
+MIN_RATE = 0.2
+# 错误信息中出现这些内容时视为被限流
+THROTTLE_SIGNATURES = (
+    '429',
+    'too many requests',
+    'rate limit',
+    'rate-limit',
+    'ratelimit',
+    'quota limit exceeded',
+    'sign in to confirm',
+)
+
+
+def is_throttle_error(error: BaseException) -> bool:
+    """根据异常信息判断是否被限流"""
+    message = str(error).lower()
+    return any(signature in message for signature in THROTTLE_SIGNATURES)
+
+
+class AdaptiveRateLimiter:
+    """令牌桶限速器，按AIMD方式调整速率
+
+    每次请求前调用acquire取得令牌。请求成功时速率缓慢线性增加，直到配置的最大速率；
+    遇到429或限流提示时速率减半，并按Retry-After暂停。多个线程共用同一个限速器，
+    因此并发数再高，对同一音乐源的请求速率也不会超过当前速率。
+    """
+
+    def __init__(self, name: str, max_rate: float, min_rate: float = MIN_RATE,
+                 decrease_factor: float = 0.5, increase_step: Optional[float] = None):
+        self.name = name
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate) if max_rate > 0 else min_rate
+        self.rate = max_rate
+        self.decrease_factor = decrease_factor
+        # 连续成功时每秒增加的速率，默认约20秒从一半恢复到最大速率
+        self.increase_step = increase_step or max(0.05, max_rate * 0.025)
+        self.throttled = 0
+        self._tokens = max(1.0, max_rate)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.max_rate <= 0
+
+    def _refill(self, now: float):
+        # 令牌桶容量为一秒的请求数，允许短暂的突发
+        capacity = max(1.0, self.rate)
+        self._tokens = min(capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def set_max_rate(self, max_rate: float):
+        """修改最大速率，当前速率同时重置为最大速率"""
+        with self._lock:
+            self.max_rate = self.rate = max_rate
+            self.min_rate = min(MIN_RATE, max_rate) if max_rate > 0 else MIN_RATE
+            self.increase_step = max(0.05, max_rate * 0.025)
+            self._tokens = min(self._tokens, max(1.0, max_rate))
+
+    def acquire(self):
+        """取得一个令牌，必要时等待"""
+        if self.unlimited:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def on_success(self):
+        """请求成功：加性增加速率"""
+        if self.unlimited:
+            return
+        with self._lock:
+            if self.rate < self.max_rate:
+                # 每个请求增加 step/rate，按当前速率持续请求时每秒约增加 step
+                self.rate = min(self.max_rate, self.rate + self.increase_step / self.rate)
+
+    def on_throttle(self, retry_after: Optional[float] = None):
+        """被限流：乘性降低速率，并在retry_after秒内暂停请求"""
+        if self.unlimited:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self.throttled += 1
+            metrics.incr('throttled', source=self.name)
+            self._tokens = 0.0
+            self._updated = now
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+            # 多个并发请求同时被限流时只降速一次
+            if now - self._last_decrease >= max(1.0, 1 / self.rate):
+                self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+                self._last_decrease = now
+                logger.warning(f"{self.name} 触发限流，请求速率降至 {self.rate:.2f}/秒")
+
+    def retry_delay(self, attempt: int, base: float = 1.0, maximum: float = 60.0) -> float:
+        """第attempt次重试前的等待时间：带抖动的指数退避，且不短于当前的请求间隔"""
+        delay = random.uniform(0, min(maximum, base * (2 ** attempt)))
+        if not self.unlimited:
+            delay = max(delay, 1 / self.rate)
+        return delay
+
+    def call(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """在限速下调用fn，根据结果调整速率"""
+        self.acquire()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if is_throttle_error(e):
+                self.on_throttle()
+            raise
+        self.on_success()
+        return result
+
+
+def parse_rate_limits(specs: Iterable[str]) -> Dict[str, float]:
+    """解析 "source=rps" 形式的配置，多项可用逗号分隔"""
+    limits: Dict[str, float] = {}
+    for spec in specs:
+        for item in (spec or '').split(','):
+            item = item.strip()
+            if not item:
+                continue
+            name, sep, value = item.partition('=')
+            try:
+                rate = float(value)
+            except ValueError:
+                rate = -1.0
+            if not sep or not name.strip() or rate < 0:
+                raise ValueError(f"无效的限速配置: {item}，应为 source=每秒请求数")
+            limits[name.strip().lower()] = rate
+    return limits
+
+
+_limiters: Dict[str, AdaptiveRateLimiter] = {}
+_configured: Dict[str, float] = {}
+_limiters_lock = threading.Lock()
+
+
+def _configured_rate(name: str) -> float:
+    if name in _configured:
+        return _configured[name]
+    env_limits = parse_rate_limits([os.getenv(RATE_LIMIT_ENV, '')])
+    if name in env_limits:
+        return env_limits[name]
+    return DEFAULT_RATES.get(name, DEFAULT_RATE)
+
+
+def configure_rate_limits(limits: Dict[str, float]):
+    """设置各音乐源的最大请求速率，优先于环境变量和默认值"""
+    with _limiters_lock:
+        _configured.update(limits)
+        for name, rate in limits.items():
+            # 已创建的限速器可能被音乐源持有，直接修改其速率
+            if name in _limiters:
+                _limiters[name].set_max_rate(rate)
+
+
+def get_limiter(name: str) -> AdaptiveRateLimiter:
+    """获取音乐源共享的限速器"""
+    limiter = _limiters.get(name)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(name)
+            if limiter is None:
+                limiter = _limiters[name] = AdaptiveRateLimiter(name, _configured_rate(name))
+    return limiter
@@ -0,0 +1,484 @@
+"""
+常驻服务：Spotify和音乐源的客户端保持常驻，通过本地HTTP或Unix socket的JSON接口接收下载任务
+"""
+import json
+import logging
+import os
+import socketserver
+import stat
+import threading
+import time
+import urllib.parse
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+from .cache import SQLiteStore, default_cache_dir
+from .metrics import metrics
+
+if TYPE_CHECKING:
+    from .downloader import SpotifyDownloader, TrackResult
+
+logger = logging.getLogger(__name__)
+
+JOBS_DB_NAME = 'jobs.sqlite'
+DEFAULT_PORT = 8765
+# 任务可以设置的下载参数及其类型，未指定的使用服务启动时的默认值
+JOB_OPTIONS = {
+    'format': str,
+    'quality': str,
+    'source': str,
+    'cookies': str,
+    'cookies_from_browser': str,
+    'workers': int,
+    'sync': bool,
+    'verify': bool,
+    'pipeline': bool,
+    'stage_workers': dict,
+    'staging_path': str,
+    'stream': bool,
+}
+# 只有通过Unix socket提交的任务才能覆盖的参数：TCP接口上任何本机用户都可以提交任务，
+# 不能让他们指定服务进程读取和写回的cookies
+LOCAL_ONLY_OPTIONS = ('cookies', 'cookies_from_browser')
+# 列表接口默认返回的任务数
+DEFAULT_LIST_LIMIT = 100
+
+
+class JobStore(SQLiteStore):
+    """持久化的下载任务队列，服务重启后未完成的任务重新排队"""
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            url TEXT NOT NULL,
+            output TEXT NOT NULL,
+            options TEXT NOT NULL,
+            status TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            completed INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            failures TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+    '''
+    COLUMNS = ('id', 'url', 'output', 'options', 'status', 'total', 'completed', 'failed', 'error', 'failures',
+               'created_at', 'started_at', 'finished_at')
+
+    def __init__(self, path: Optional[str] = None):
+        if path is None:
+            path = os.path.join(default_cache_dir(), JOBS_DB_NAME)
+        super().__init__(path)
+        with self._lock:
+            # 上次退出时正在运行的任务没有完成，重新排队
+            requeued = self._conn.execute(
+                "UPDATE jobs SET status = 'queued', started_at = NULL WHERE status = 'running'"
+            ).rowcount
+            self._conn.commit()
+        if requeued:
+            logger.info(f"{requeued} 个未完成的任务已重新排队")
+
+    def _row(self, row) -> Dict[str, Any]:
+        job = dict(zip(self.COLUMNS, row))
+        job['options'] = json.loads(job['options'])
+        job['failures'] = json.loads(job['failures']) if job['failures'] else []
+        return job
+
+    def submit(self, url: str, output: str, options: Dict[str, Any]) -> Dict[str, Any]:
+        """添加任务"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO jobs (url, output, options, status, created_at) VALUES (?, ?, ?, 'queued', ?)",
+                (url, output, json.dumps(options, ensure_ascii=False), time.time())
+            )
+            self._conn.commit()
+        return self.get(cursor.lastrowid)
+
+    def get(self, job_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return self._row(row) if row else None
+
+    def list(self, status: Optional[str] = None, limit: int = DEFAULT_LIST_LIMIT) -> List[Dict[str, Any]]:
+        """最近的任务，可按状态筛选"""
+        query = f"SELECT {', '.join(self.COLUMNS)} FROM jobs"
+        params: List[Any] = []
+        if status:
+            query += ' WHERE status = ?'
+            params.append(status)
+        query += ' ORDER BY id DESC LIMIT ?'
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [self._row(row) for row in rows]
+
+    def counts(self) -> Dict[str, int]:
+        """各状态的任务数"""
+        with self._lock:
+            rows = self._conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        return dict(rows)
+
+    def claim(self) -> Optional[Dict[str, Any]]:
+        """取出最早的排队任务并标记为运行中
+
+        同一输出目录的任务依次执行，避免同时写入同一个下载清单。
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' AND output NOT IN "
+                "(SELECT output FROM jobs WHERE status = 'running') ORDER BY id LIMIT 1"
+            ).fetchone()
+            if not row:
+                return None
+            self._conn.execute("UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?",
+                               (time.time(), row[0]))
+            self._conn.commit()
+        return self.get(row[0])
+
+    def finish(self, job_id: int, status: str, total: int, completed: int, failed: int,
+               failures: List[Dict[str, Any]], error: Optional[str] = None):
+        """记录任务结果"""
+        with self._lock:
+            self._conn.execute(
+                'UPDATE jobs SET status = ?, total = ?, completed = ?, failed = ?, failures = ?, error = ?, '
+                'finished_at = ? WHERE id = ?',
+                (status, total, completed, failed, json.dumps(failures, ensure_ascii=False), error,
+                 time.time(), job_id)
+            )
+            self._conn.commit()
+
+    def cancel(self, job_id: int) -> bool:
+        """取消排队中的任务，已开始的任务无法取消"""
+        with self._lock:
+            cancelled = self._conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'queued'",
+                (time.time(), job_id)
+            ).rowcount
+            self._conn.commit()
+        return bool(cancelled)
+
+
+class JobProgress:
+    """运行中任务的进度，只保存在内存中，任务结束时写入数据库"""
+
+    def __init__(self):
+        self.total = 0
+        self.completed = 0
+        self.failed = 0
+        self.failures: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def on_track(self, track_info: Dict[str, Any]):
+        with self._lock:
+            self.total += 1
+
+    def on_result(self, result: 'TrackResult'):
+        with self._lock:
+            self.completed += 1
+            if not result.success:
+                self.failed += 1
+                self.failures.append({'track_id': result.track_id, 'name': result.name, 'error': result.error})
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {'total': self.total, 'completed': self.completed, 'failed': self.failed}
+
+
+class DownloadService:
+    """常驻的下载服务
+
+    所有任务共用同一个SpotifyDownloader，Spotify访问令牌、YTMusic客户端、各音乐源的连接、
+    缓存和转码池都只创建一次。任务按提交顺序执行，job_workers个任务可以同时运行。
+    """
+
+    def __init__(self, downloader: 'SpotifyDownloader', store: JobStore, job_workers: int = 1,
+                 output_root: Optional[str] = None, defaults: Optional[Dict[str, Any]] = None):
+        self.downloader = downloader
+        self.store = store
+        self.job_workers = job_workers
+        # 未指定时以启动时的当前目录为根目录，通过TCP提交的任务只能写入其中
+        self.output_root = os.path.abspath(os.path.expanduser(output_root or os.getcwd()))
+        self.defaults = defaults or {}
+        self._progress: Dict[int, JobProgress] = {}
+        self._progress_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def start(self):
+        for i in range(self.job_workers):
+            thread = threading.Thread(target=self._work, name=f"job-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """停止领取新任务；运行中的任务在下次启动时重新执行"""
+        self._stopped.set()
+        self._wakeup.set()
+
+    def _confine(self, name: str, path: str, local: bool = False) -> str:
+        """以output_root为基准解析为绝对路径；不是来自Unix socket的请求，路径必须位于output_root中
+        （按经过符号链接后的实际位置判断）"""
+        path = os.path.realpath(os.path.join(self.output_root, os.path.expanduser(path)))
+        root = os.path.realpath(self.output_root)
+        if not local and os.path.commonpath([root, path]) != root:
+            raise ValueError(f"{name} 必须位于输出根目录 {self.output_root} 中")
+        return path
+
+    def submit(self, payload: Dict[str, Any], local: bool = False) -> List[Dict[str, Any]]:
+        """校验并添加任务，payload包含 url（或 urls 列表）、output 和下载参数
+
+        local表示请求来自Unix socket（只有当前用户可以访问），只有这时才能覆盖cookies参数，
+        以及把output和staging_path设置在输出根目录之外。
+        """
+        if not isinstance(payload, dict):
+            raise ValueError("请求内容应为JSON对象")
+        payload = dict(payload)
+        url = payload.pop('url', None)
+        urls = payload.pop('urls', None) or [url]
+        if not isinstance(urls, list) or not all(isinstance(url, str) and url for url in urls):
+            raise ValueError("必须指定 url 或 urls")
+        for url in urls:
+            if not self.downloader._parse_spotify_url(url):
+                raise ValueError(f"无效的Spotify URL: {url}")
+
+        output = payload.pop('output', None)
+        if output is not None and not isinstance(output, str):
+            raise ValueError("output 应为字符串")
+        output = self._confine('output', output or '', local)
+
+        options = {**self.defaults}
+        for key, value in payload.items():
+            expected = JOB_OPTIONS.get(key)
+            if expected is None:
+                raise ValueError(f"不支持的参数: {key}")
+            # bool是int的子类，需要单独排除
+            if not isinstance(value, expected) or (expected is int and isinstance(value, bool)):
+                raise ValueError(f"参数 {key} 应为 {expected.__name__}")
+            if key in LOCAL_ONLY_OPTIONS and not local:
+                raise PermissionError(f"参数 {key} 只能通过Unix socket设置")
+            options[key] = value
+        if payload.get('staging_path'):
+            options['staging_path'] = self._confine('staging_path', options['staging_path'], local)
+        if options.get('workers') is not None and options['workers'] < 1:
+            raise ValueError("workers 应大于0")
+        from .pipeline import STAGES
+        for name, count in (options.get('stage_workers') or {}).items():
+            if name not in STAGES or not isinstance(count, int) or isinstance(count, bool) or count < 1:
+                raise ValueError(f"stage_workers 格式应为 {{阶段: 并发数}}，阶段可选: {', '.join(STAGES)}")
+        self.downloader._select_sources(options.get('source', 'auto'))
+
+        jobs = [self.store.submit(url, output, options) for url in urls]
+        metrics.incr('jobs', len(jobs), status='submitted')
+        self._wakeup.set()
+        return jobs
+
+    def job(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """任务详情，运行中的任务带有实时进度"""
+        job = self.store.get(job_id)
+        if job and job['status'] == 'running':
+            with self._progress_lock:
+                progress = self._progress.get(job_id)
+            if progress:
+                job.update(progress.snapshot())
+        return job
+
+    def jobs(self, status: Optional[str] = None, limit: int = DEFAULT_LIST_LIMIT) -> List[Dict[str, Any]]:
+        jobs = self.store.list(status, limit)
+        with self._progress_lock:
+            for job in jobs:
+                progress = self._progress.get(job['id'])
+                if progress and job['status'] == 'running':
+                    job.update(progress.snapshot())
+        return jobs
+
+    def health(self) -> Dict[str, Any]:
+        return {'status': 'ok', 'jobs': self.store.counts(), 'job_workers': self.job_workers}
+
+    def _work(self):
+        while not self._stopped.is_set():
+            job = self.store.claim()
+            if job is None:
+                self._wakeup.wait(1.0)
+                self._wakeup.clear()
+                continue
+            self._run(job)
+
+    def _run(self, job: Dict[str, Any]):
+        job_id = job['id']
+        progress = JobProgress()
+        with self._progress_lock:
+            self._progress[job_id] = progress
+        logger.info(f"开始任务 #{job_id}: {job['url']} -> {job['output']}")
+        error = None
+        try:
+            os.makedirs(job['output'], exist_ok=True)
+            results = self.downloader.download_collection(job['url'], job['output'], on_track=progress.on_track,
+                                                          on_result=progress.on_result, **job['options'])
+            failed = sum(1 for r in results if not r.success)
+            status = 'done' if not failed else ('failed' if failed == len(results) else 'partial')
+        except Exception as e:
+            logger.error(f"任务 #{job_id} 失败: {str(e)}")
+            status, error = 'failed', str(e)
+        finally:
+            with self._progress_lock:
+                self._progress.pop(job_id, None)
+        snapshot = progress.snapshot()
+        self.store.finish(job_id, status, snapshot['total'], snapshot['completed'], snapshot['failed'],
+                          progress.failures, error)
+        metrics.incr('jobs', status=status)
+        logger.info(f"任务 #{job_id} 结束: {status}，完成 {snapshot['completed']}/{snapshot['total']} 首，"
+                    f"失败 {snapshot['failed']} 首")
+
+
+def _handler(service: DownloadService):
+    from http.server import BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+        def _send(self, status: int, payload: Any, content_type: str = 'application/json'):
+            if content_type == 'application/json':
+                body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            else:
+                body = payload.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', f"{content_type}; charset=utf-8")
+            self.send_header('Content-Length', str(len(body)))
+            if self.close_connection:
+                self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _error(self, status: int, message: str):
+            self._send(status, {'error': message})
+
+        def _forbidden_origin(self) -> bool:
+            """浏览器中的网页发起的请求带有Origin，一律拒绝，避免任意网页向本机服务提交任务"""
+            if self.headers.get('Origin') is None:
+                return False
+            # 未读取请求体，不能继续复用连接
+            self.close_connection = True
+            self._error(403, "不接受浏览器跨站请求")
+            return True
+
+        def _route(self):
+            """解析路径，返回 (路径各段, 查询参数)"""
+            url = urllib.parse.urlsplit(self.path)
+            params = {key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()}
+            return [part for part in url.path.split('/') if part], params
+
+        def _job_id(self, parts: List[str]) -> Optional[int]:
+            return int(parts[1]) if len(parts) == 2 and parts[0] == 'jobs' and parts[1].isdigit() else None
+
+        def do_GET(self):
+            if self._forbidden_origin():
+                return
+            parts, params = self._route()
+            if parts == ['health']:
+                self._send(200, service.health())
+            elif parts == ['metrics']:
+                self._send(200, metrics.prometheus_text(), 'text/plain; version=0.0.4')
+            elif parts == ['jobs']:
+                limit = params.get('limit', '')
+                self._send(200, service.jobs(params.get('status') or None,
+                                             int(limit) if limit.isdigit() else DEFAULT_LIST_LIMIT))
+            elif self._job_id(parts) is not None:
+                job = service.job(self._job_id(parts))
+                if job:
+                    self._send(200, job)
+                else:
+                    self._error(404, "任务不存在")
+            else:
+                self._error(404, "未知的路径")
+
+        def do_POST(self):
+            if self._forbidden_origin():
+                return
+            parts, _ = self._route()
+            if parts != ['jobs']:
+                self._error(404, "未知的路径")
+                return
+            # 网页可以不经预检发送text/plain等“简单请求”，要求application/json则必须预检，而服务不响应预检
+            content_type = (self.headers.get('Content-Type') or '').split(';')[0].strip().lower()
+            if content_type != 'application/json':
+                self.close_connection = True
+                self._error(415, "Content-Type 必须为 application/json")
+                return
+            try:
+                length = int(self.headers.get('Content-Length') or 0)
+                payload = json.loads(self.rfile.read(length) or b'{}')
+                jobs = service.submit(payload, local=isinstance(self.server, UnixHTTPServer))
+            except PermissionError as e:
+                self._error(403, str(e))
+                return
+            except ValueError as e:
+                self._error(400, str(e))
+                return
+            self._send(201, jobs)
+
+        def do_DELETE(self):
+            if self._forbidden_origin():
+                return
+            parts, _ = self._route()
+            job_id = self._job_id(parts)
+            if job_id is None:
+                self._error(404, "未知的路径")
+            elif service.store.get(job_id) is None:
+                self._error(404, "任务不存在")
+            elif service.store.cancel(job_id):
+                self._send(200, service.job(job_id))
+            else:
+                self._error(409, "只能取消排队中的任务")
+
+    return Handler
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """监听Unix socket的HTTP服务"""
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler 需要 (host, port) 形式的客户端地址
+        return request, ('local', 0)
+
+
+def remove_socket(socket_path: str):
+    """删除之前留下的Unix socket；路径上是其他文件时抛出ValueError，不会误删"""
+    socket_path = os.path.abspath(os.path.expanduser(socket_path))
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise ValueError(f"{socket_path} 已存在且不是socket，请换一个路径")
+    os.remove(socket_path)
+
+
+def create_server(service: DownloadService, host: str = '127.0.0.1', port: int = DEFAULT_PORT,
+                  socket_path: Optional[str] = None) -> socketserver.BaseServer:
+    """创建HTTP服务，指定socket_path时监听Unix socket，只有当前用户可以访问"""
+    from http.server import ThreadingHTTPServer
+    handler = _handler(service)
+    if socket_path:
+        socket_path = os.path.abspath(os.path.expanduser(socket_path))
+        remove_socket(socket_path)
+        # 创建时权限即为0600，不留其他用户可以连接的间隙
+        umask = os.umask(0o177)
+        try:
+            server: socketserver.BaseServer = UnixHTTPServer(socket_path, handler)
+        finally:
+            os.umask(umask)
+        logger.info(f"下载服务: unix://{socket_path}")
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+        server.daemon_threads = True
+        logger.info(f"下载服务: http://{host}:{server.server_address[1]}")
+    return server
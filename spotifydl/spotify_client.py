@@ -0,0 +1,40 @@
+"""
+经过限速的Spotify API客户端
+"""
+from typing import Optional
+
+import spotipy
+from spotipy.exceptions import SpotifyException
+from spotipy.oauth2 import SpotifyClientCredentials
+
+from .ratelimit import AdaptiveRateLimiter, get_limiter
+
+
+class RateLimitedSpotify(spotipy.Spotify):
+    """所有Spotify API请求都经过共享的限速器"""
+
+    def __init__(self, *args, limiter: Optional[AdaptiveRateLimiter] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limiter = limiter or get_limiter('spotify')
+
+    def _internal_call(self, method, url, payload, params):
+        self.limiter.acquire()
+        try:
+            result = super()._internal_call(method, url, payload, params)
+        except SpotifyException as e:
+            if e.http_status == 429:
+                retry_after = (getattr(e, 'headers', None) or {}).get('Retry-After', '')
+                self.limiter.on_throttle(float(retry_after) if str(retry_after).isdigit() else None)
+            raise
+        self.limiter.on_success()
+        return result
+
+
+def create_spotify_client(client_id: str, client_secret: str) -> RateLimitedSpotify:
+    """使用客户端凭证创建Spotify API客户端"""
+    return RateLimitedSpotify(
+        client_credentials_manager=SpotifyClientCredentials(
+            client_id=client_id,
+            client_secret=client_secret
+        )
+    )
@@ -0,0 +1,185 @@
+"""
+使用ffmpeg转换音频格式
+"""
+import base64
+import logging
+import os
+import shutil
+import struct
+import subprocess
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 输出格式对应的ffmpeg编码器
+AUDIO_CODECS = {
+    'mp3': 'libmp3lame',
+    'm4a': 'aac',
+    'aac': 'aac',
+    'opus': 'libopus',
+    'ogg': 'libvorbis',
+    'vorbis': 'libvorbis',
+    'flac': 'flac',
+    'wav': 'pcm_s16le',
+}
+# 无损格式不需要设置码率
+LOSSLESS_FORMATS = frozenset({'flac', 'wav'})
+# 源音频为这些编码时可以直接复制音频流到目标格式，无需重新编码
+PASSTHROUGH_CODECS = {
+    'mp3': {'mp3'},
+    'm4a': {'aac', 'alac'},
+    'aac': {'aac'},
+    'opus': {'opus'},
+    'ogg': {'vorbis'},
+    'vorbis': {'vorbis'},
+    'flac': {'flac'},
+    'wav': {'pcm_s16le'},
+}
+
+# 可以把封面作为附加图片流写入的格式
+ATTACHED_PICTURE_FORMATS = frozenset({'mp3', 'm4a', 'flac'})
+# Ogg容器不支持附加图片流，封面按FLAC图片块编码后写入 METADATA_BLOCK_PICTURE 注释
+VORBIS_COMMENT_FORMATS = frozenset({'opus', 'ogg', 'vorbis'})
+# ADTS格式的AAC只能写入ID3v2文本标签
+ID3_TEXT_FORMATS = frozenset({'aac'})
+
+
+class TranscodeError(RuntimeError):
+    """ffmpeg转换失败"""
+
+
+def _quality_args(format: str, quality: str) -> List[str]:
+    """把 --quality 参数转换为ffmpeg参数：'320k' 为固定码率，0-10 的数字为VBR质量"""
+    if format in LOSSLESS_FORMATS or not quality:
+        return []
+    if quality.isdigit() and int(quality) <= 10:
+        return ['-q:a', quality]
+    return ['-b:a', quality]
+
+
+def probe_audio_codec(path: str) -> Optional[str]:
+    """使用ffprobe读取第一条音频流的编码，失败时返回None"""
+    ffprobe = shutil.which('ffprobe')
+    if not ffprobe:
+        return None
+    result = subprocess.run(
+        [ffprobe, '-v', 'error', '-select_streams', 'a:0', '-show_entries', 'stream=codec_name',
+         '-of', 'default=noprint_wrappers=1:nokey=1', path],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    if result.returncode != 0:
+        return None
+    return result.stdout.decode('utf-8', 'replace').strip() or None
+
+
+def _picture_mime(data: bytes) -> str:
+    return 'image/png' if data.startswith(b'\x89PNG') else 'image/jpeg'
+
+
+def _flac_picture_block(data: bytes) -> str:
+    """封面编码为base64的FLAC图片块（类型3为封面），宽高等字段可以为0"""
+    mime = _picture_mime(data).encode('ascii')
+    description = b'Cover'
+    block = (struct.pack('>II', 3, len(mime)) + mime + struct.pack('>I', len(description)) + description
+             + struct.pack('>IIIII', 0, 0, 0, 0, len(data)) + data)
+    return base64.b64encode(block).decode('ascii')
+
+
+def _ffmetadata(tags: Dict[str, str]) -> bytes:
+    """ffmpeg的FFMETADATA1格式，值中的 = ; # \\ 和换行需要转义"""
+    def escape(value: str) -> str:
+        for char in ('\\', '=', ';', '#', '\n'):
+            value = value.replace(char, '\\' + char)
+        return value
+    lines = [';FFMETADATA1'] + [f"{escape(key)}={escape(value)}" for key, value in tags.items()]
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def _metadata_args(format: str, tags: Dict[str, str], cover: Optional[bytes],
+                   cover_path: Optional[str] = None) -> Tuple[List[str], Optional[bytes]]:
+    """标签和封面对应的ffmpeg参数，以及需要从标准输入传给ffmpeg的数据
+
+    封面较大，不放在命令行中，而是作为第二个输入从标准输入读取：
+    能附加图片流的格式直接读取图片，Ogg格式读取包含全部标签的FFMETADATA文件。
+    封面已在磁盘上时（cover_path），能附加图片流的格式由ffmpeg直接读取该文件。
+    """
+    if cover_path and not cover and format in VORBIS_COMMENT_FORMATS:
+        # 图片块需要base64编码后写入注释，只能读入内存
+        with open(cover_path, 'rb') as f:
+            cover = f.read()
+    if cover and format in VORBIS_COMMENT_FORMATS:
+        tags = dict(tags, METADATA_BLOCK_PICTURE=_flac_picture_block(cover))
+        return ['-f', 'ffmetadata', '-i', 'pipe:0', '-map', '0:a:0', '-map_metadata', '1'], _ffmetadata(tags)
+
+    args = ['-map', '0:a:0']
+    stdin = None
+    if (cover or cover_path) and format in ATTACHED_PICTURE_FORMATS:
+        args = ['-i', 'pipe:0' if cover else cover_path, '-map', '0:a:0', '-map', '1:0', '-c:v', 'copy',
+                '-disposition:v:0', 'attached_pic',
+                '-metadata:s:v', 'title=Album cover', '-metadata:s:v', 'comment=Cover (front)']
+        stdin = cover
+    # 不保留源文件的标签
+    args += ['-map_metadata', '-1']
+    for key, value in tags.items():
+        args += ['-metadata', f"{key}={value}"]
+    if format in ID3_TEXT_FORMATS:
+        args += ['-write_id3v2', '1']
+    return args, stdin
+
+
+def transcode_audio(source_path: str, target_path: str, format: str, quality: str,
+                    passthrough: bool = False, tags: Optional[Dict[str, str]] = None,
+                    cover: Optional[bytes] = None, cover_path: Optional[str] = None) -> bool:
+    """把source_path转换为指定格式和质量，写入target_path
+
+    passthrough为True且源音频编码已符合目标格式时只复制音频流（重新封装），返回True；
+    否则完整转码，返回False。
+    tags（ffmpeg通用的键名，如title、artist）和封面在同一次ffmpeg调用中写入，输出文件只写一次。
+    mp3、m4a、flac的封面为附加图片，opus、ogg写入 METADATA_BLOCK_PICTURE；aac和wav只有文本标签。
+    封面可以是内存中的数据（cover），也可以是磁盘上的文件（cover_path）。
+    """
+    ffmpeg = shutil.which('ffmpeg')
+    if not ffmpeg:
+        raise TranscodeError("未找到ffmpeg，请先安装ffmpeg")
+    codec = AUDIO_CODECS.get(format)
+    if not codec:
+        raise TranscodeError(f"不支持的输出格式: {format}")
+
+    source_codec = probe_audio_codec(source_path) if passthrough else None
+    copied = source_codec in PASSTHROUGH_CODECS.get(format, ())
+    if copied:
+        logger.info(f"源编码 {source_codec} 符合目标格式 {format}，直接复制音频流，不重新编码")
+        codec_args = ['-c:a', 'copy']
+    else:
+        if passthrough:
+            logger.info(f"源编码 {source_codec or '未知'} 不符合目标格式 {format}，需要重新编码")
+        codec_args = ['-c:a', codec, *_quality_args(format, quality)]
+
+    metadata_args, stdin = _metadata_args(format, tags or {}, cover, cover_path)
+    cmd = [ffmpeg, '-hide_banner', '-loglevel', 'error', '-y', '-i', source_path,
+           *metadata_args, *codec_args, target_path]
+    result = subprocess.run(cmd, input=stdin, stdin=None if stdin is not None else subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise TranscodeError(f"ffmpeg转换失败: {result.stderr.decode('utf-8', 'replace').strip()}")
+    return copied
+
+
+class TranscodePool:
+    """独立的转码并发池，与网络下载分开调度
+
+    每次转码都在单独的ffmpeg进程中进行，这里的线程只负责启动进程并等待结果，
+    因此并发数即为同时运行的ffmpeg进程数，默认等于CPU核数。
+    """
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self.max_workers = max_workers or os.cpu_count() or 2
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='transcode')
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """在转码池中执行fn，通常是转码及后续的重命名、记录清单步骤"""
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait=wait)